@@ -13,5 +13,6 @@ setup(
     zip_safe      = False,
     scripts       = [
         'svj/bin/svj-genprod-batch',
+        'svj/bin/svj-genprod-inventory',
         ],
     )
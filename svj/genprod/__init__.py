@@ -28,6 +28,9 @@ RUN_GRIDPACK_DIR = '/tmp/svj/rungridpack'
 RUN_FULLSIM_DIR = '/tmp/svj/runfullsim'
 SVJ_OUTPUT_DIR = '/tmp/svj/output'
 
+# Path to store caches that are meant to be reused between runs
+SVJ_CACHE_DIR = '/tmp/svj/cache'
+
 # Assume running locally by default
 # This variable will be set to True if using the svjgenprod-batch script
 BATCH_MODE = False
@@ -69,6 +72,11 @@ def read_environment():
                 .format(batch_mode)
                 )
 
+    if 'SVJ_CACHE_DIR' in env:
+        global SVJ_CACHE_DIR
+        SVJ_CACHE_DIR = env['SVJ_CACHE_DIR']
+        logger.info('Taking cache dir from SVJ_CACHE_DIR environment variable: {0}'.format(SVJ_CACHE_DIR))
+
 def batch_mode_lpc():
     global BATCH_MODE
     BATCH_MODE = True
@@ -79,11 +87,13 @@ def batch_mode_lpc():
         global RUN_GRIDPACK_DIR
         global RUN_FULLSIM_DIR
         global SVJ_OUTPUT_DIR
+        global SVJ_CACHE_DIR
         MG_MODEL_DIR     = osp.join(scratch_dir, 'svj/models')
         MG_INPUT_DIR     = osp.join(scratch_dir, 'svj/inputs')
         RUN_GRIDPACK_DIR = osp.join(scratch_dir, 'svj/rungridpack')
         RUN_FULLSIM_DIR  = osp.join(scratch_dir, 'svj/runfullsim')
         SVJ_OUTPUT_DIR   = osp.join(scratch_dir, 'output')
+        SVJ_CACHE_DIR    = osp.join(scratch_dir, 'svj/cache')
     except KeyError:
         logger.error(
             'Attempted to setup for batch mode (lpc), but ${_CONDOR_SCRATCH_DIR} is not set.'
@@ -110,11 +120,23 @@ def tarball(outfile=None, dry=False):
 
 from . import utils
 from .config import Config
-from semanager import SEManager
+from . import sebackends
+from semanager import SEManager, SEDirectoryCache
+from . import stageoutqueue
+from .seinventory import SEInventory
+from .gridpackcache import GridpackCache, CompiledProcessCache, ExtractedGridpackCache
 from .gridpackgenerator import GridpackGenerator
+from .gridpackscan import GridpackScan
+from . import lhetools
+from .lheindex import LHEIndex
+from . import lhecolumnar
 from .lhemaker import LHEMaker
 import calc_dark_params as cdp
 
 from .gensimfragment import GenSimFragment
+from .cmsdrivercache import CMSDriverCache
+from .cmsswpool import CMSSWReleasePool
 from .fullsimbase import FullSimRunnerBase
 import fullsimrunners
+from .fullsimchain import FullSimChain
+from .filterefficiency import FilterEfficiencyStore, FilterEfficiencyPilot
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os, json, hashlib, logging, socket
+import os.path as osp
+from time import strftime
+from contextlib import contextmanager
+
+import svj.core
+import svj.genprod
+
+logger = logging.getLogger('root')
+
+
+# Placeholders for the per-job fields of a cmsDriver command; cmsDriver copies them
+# verbatim into the cfg, so the cfg of any job can be rendered by string replacement
+SENTINEL_N_EVENTS = 987654321
+SENTINEL_IN_FILE = 'SVJSENTINELINFILE'
+SENTINEL_OUT_FILE = 'SVJSENTINELOUTFILE.root'
+SENTINEL_OUT_PATH = '/SVJSENTINELOUTDIR/SVJSENTINELOUTFILE.root'
+SENTINEL_CFG_FILE = 'SVJSENTINELCFG.py'
+SENTINEL_WORKDIR = '/SVJSENTINELWORKDIR'
+
+
+@contextmanager
+def sentinel_fields(runner):
+    """
+    Temporarily replaces the per-job fields of runner by sentinels, so that
+    `get_cmsdriver_cmd` returns the command of the template
+    """
+    fields = [ 'in_file', 'n_events', 'out_root_file_basename', 'out_root_file', 'cfg_file_basename' ]
+    original = dict((field, getattr(runner, field)) for field in fields)
+    # cmsDriver chooses the source by the extension of the input file
+    runner.in_file = SENTINEL_IN_FILE + osp.splitext(original['in_file'])[1]
+    runner.n_events = SENTINEL_N_EVENTS
+    runner.out_root_file_basename = SENTINEL_OUT_FILE
+    runner.out_root_file = SENTINEL_OUT_PATH
+    runner.cfg_file_basename = SENTINEL_CFG_FILE
+    try:
+        yield
+    finally:
+        for field, value in original.items():
+            setattr(runner, field, value)
+
+
+def get_replacements(runner):
+    """
+    Returns the (sentinel, value) pairs to render the template for runner. The
+    absolute output path goes first, since it contains the output file sentinel.
+    """
+    return [
+        (SENTINEL_OUT_PATH, runner.out_root_file),
+        (SENTINEL_OUT_FILE, runner.out_root_file_basename),
+        (SENTINEL_IN_FILE + osp.splitext(runner.in_file)[1], runner.in_file),
+        (SENTINEL_CFG_FILE, runner.cfg_file_basename),
+        (SENTINEL_WORKDIR, runner.workdir),
+        (str(SENTINEL_N_EVENTS), str(runner.n_events)),
+        ]
+
+
+def get_pileup_filelists(cmd):
+    """
+    Returns the paths of the `--pileup_input filelist:` files in a cmsDriver command
+    """
+    filelists = []
+    for part in cmd:
+        if not part.startswith('--pileup_input filelist:'): continue
+        filelists.append(part.split('filelist:', 1)[1].strip().strip('"\''))
+    return filelists
+
+
+#____________________________________________________________________
+class CMSDriverCache(object):
+    """
+    Local cache of cfg files generated by `cmsDriver.py --no_exec`.
+
+    cmsDriver is run once with sentinels for the per-job fields (input and output
+    files, number of events, cfg name; see `sentinel_fields`), and its output is
+    stored as a template. The key is a sha1 of the template command, the release,
+    the stage and year, and the contents of the fragment and of any pileup file
+    list (which cmsDriver both inline).
+    Later jobs render the template by replacing the sentinels, skipping cmsDriver;
+    the edits of the cfg (`edit_cmsdriver_output`, rnd service) are applied after
+    rendering as usual.
+    """
+
+    def __init__(self, cache_dir=None):
+        super(CMSDriverCache, self).__init__()
+        self.cache_dir = (
+            osp.join(svj.genprod.SVJ_CACHE_DIR, 'cmsdriver')
+            if cache_dir is None else cache_dir
+            )
+
+    def get_key(self, runner, template_cmd):
+        key_contents = {
+            'cmd' : [ part.replace(runner.workdir, SENTINEL_WORKDIR) for part in template_cmd ],
+            'cmssw_version' : runner.cmssw_version,
+            'arch' : runner.arch,
+            'stage' : runner.stage,
+            'substage' : runner.substage,
+            'year' : runner.year,
+            }
+        fragment = getattr(runner, 'gensimfragment_file', None)
+        if not(fragment is None) and osp.isfile(fragment):
+            key_contents['fragment'] = svj.genprod.gridpackcache.sha1_of_file(fragment)
+        pileup_filelists = [ f for f in get_pileup_filelists(template_cmd) if osp.isfile(f) ]
+        if pileup_filelists:
+            key_contents['pileup_filelists'] = [
+                svj.genprod.gridpackcache.sha1_of_file(f) for f in pileup_filelists
+                ]
+        canonical = json.dumps(key_contents, sort_keys=True)
+        key = hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+        logger.debug('cmsDriver cache key %s for contents:\n%s', key, canonical)
+        return key
+
+    def get_template_file(self, key):
+        return osp.join(self.cache_dir, key + '.py')
+
+    def has(self, key):
+        return osp.isfile(self.get_template_file(key))
+
+    def load(self, key):
+        with open(self.get_template_file(key), 'r') as f:
+            return f.read()
+
+    def store(self, key, template, metadata=None):
+        """
+        Stores the template and a json file with metadata; files are renamed into
+        place, so a partially written template is never picked up
+        """
+        svj.core.utils.create_directory(self.cache_dir)
+        suffix = '.tmp_{0}_{1}'.format(socket.gethostname(), os.getpid())
+        manifest = { 'key' : key, 'created' : strftime('%Y-%m-%d %H:%M:%S') }
+        if metadata: manifest.update(metadata)
+        template_file = self.get_template_file(key)
+        manifest_file = osp.join(self.cache_dir, key + '.json')
+        with open(manifest_file + suffix, 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        os.rename(manifest_file + suffix, manifest_file)
+        with open(template_file + suffix, 'w') as f:
+            f.write(template)
+        os.rename(template_file + suffix, template_file)
+        logger.info('Stored cmsDriver template {0}'.format(template_file))
+
+    def remove(self, key):
+        for path in [ self.get_template_file(key), osp.join(self.cache_dir, key + '.json') ]:
+            if osp.isfile(path):
+                logger.warning('Removing {0}'.format(path))
+                os.remove(path)
+
+    @staticmethod
+    def render(template, runner):
+        contents = template
+        for sentinel, value in get_replacements(runner):
+            contents = contents.replace(sentinel, value)
+        return contents
+
+    def make_template(self, runner, template_cmd):
+        """
+        Runs cmsDriver with the template command and returns its output, with the
+        workdir of this job replaced by a sentinel
+        """
+        cmds = runner.source_cmssw_cmds()
+        cmds.append(template_cmd)
+        svj.core.utils.run_multiple_commands(cmds, env=svj.core.utils.get_clean_env())
+        cfg_file = osp.join(runner.get_run_dir(), SENTINEL_CFG_FILE)
+        with open(cfg_file, 'r') as f:
+            template = f.read()
+        os.remove(cfg_file)
+        return template.replace(runner.workdir, SENTINEL_WORKDIR)
+
+    def cmsdriver(self, runner):
+        """
+        Writes the cmsDriver output for runner to runner.cfg_file, from the cache
+        if possible, and running cmsDriver to fill the cache otherwise
+        """
+        with sentinel_fields(runner):
+            template_cmd = runner.compose_cmsdriver_cmd()
+        key = self.get_key(runner, template_cmd)
+        if self.has(key):
+            logger.info('Rendering {0} from cmsDriver cache entry {1}'.format(runner.cfg_file, key))
+            template = self.load(key)
+        else:
+            logger.info('No cmsDriver cache entry {0}; running cmsDriver'.format(key))
+            template = self.make_template(runner, template_cmd)
+            self.store(key, template, { 'cmd' : template_cmd, 'cmssw_version' : runner.cmssw_version })
+        with open(runner.cfg_file, 'w') as f:
+            f.write(self.render(template, runner))
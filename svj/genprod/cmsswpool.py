@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os, logging
+import os.path as osp
+
+import svj.core
+import svj.genprod
+
+logger = logging.getLogger('root')
+
+
+#____________________________________________________________________
+class CMSSWReleasePool(object):
+    """
+    CMSSW release areas shared by all runners on a node, one per (cmssw_version, arch),
+    in `<pool_dir>/<arch>/<cmssw_version>`.
+
+    Setting up and compiling a release happens under a lock per release. The state
+    of the last build is recorded in the release area (see
+    `utils.compile_cmssw_src_if_needed`), so `scram b` only runs when the sources
+    changed, rather than once per model and stage.
+    """
+
+    def __init__(self, pool_dir=None):
+        super(CMSSWReleasePool, self).__init__()
+        self.pool_dir = (
+            osp.join(svj.genprod.SVJ_CACHE_DIR, 'cmssw')
+            if pool_dir is None else pool_dir
+            )
+
+    def get_area_dir(self, cmssw_version, arch):
+        return osp.join(self.pool_dir, arch)
+
+    def get_release_dir(self, cmssw_version, arch):
+        return osp.join(self.get_area_dir(cmssw_version, arch), cmssw_version)
+
+    def get_cmssw_src(self, cmssw_version, arch):
+        return osp.join(self.get_release_dir(cmssw_version, arch), 'src')
+
+    def get_lock_file(self, cmssw_version, arch):
+        return osp.join(self.get_area_dir(cmssw_version, arch), cmssw_version + '.lock')
+
+    def get_build_state_file(self, cmssw_version, arch):
+        return osp.join(self.get_release_dir(cmssw_version, arch), svj.genprod.utils.CMSSW_BUILD_STATE_BASENAME)
+
+    def is_compiled(self, cmssw_version, arch):
+        return osp.isfile(self.get_build_state_file(cmssw_version, arch))
+
+    def acquire(self, cmssw_version, arch):
+        """
+        Sets up the release if it is not in the pool yet; returns its src directory
+        """
+        area_dir = self.get_area_dir(cmssw_version, arch)
+        svj.core.utils.create_directory(area_dir)
+        with svj.genprod.utils.file_lock(self.get_lock_file(cmssw_version, arch)):
+            if osp.isdir(self.get_cmssw_src(cmssw_version, arch)):
+                logger.info('Reusing {0} from the release pool'.format(cmssw_version))
+            else:
+                logger.info('Setting up {0} in the release pool {1}'.format(cmssw_version, area_dir))
+                svj.core.utils.setup_cmssw(area_dir, cmssw_version, arch)
+        return self.get_cmssw_src(cmssw_version, arch)
+
+    def compile(self, cmssw_version, arch, force=False):
+        """
+        Compiles the release if its sources changed since the last build (or
+        always if force is True); returns what was built, see
+        `utils.compile_cmssw_src_if_needed`
+        """
+        with svj.genprod.utils.file_lock(self.get_lock_file(cmssw_version, arch)):
+            if force: self.invalidate(cmssw_version, arch)
+            return svj.genprod.utils.compile_cmssw_src_if_needed(
+                self.get_cmssw_src(cmssw_version, arch), arch
+                )
+
+    def invalidate(self, cmssw_version, arch):
+        """
+        Forgets the state of the last build, so the next compile is a full scram b
+        """
+        state_file = self.get_build_state_file(cmssw_version, arch)
+        if osp.isfile(state_file): os.remove(state_file)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures the efficiency of the generator-level filters (see
+`GenSimFragment.insert_filters`) per model with a short GEN-only pilot run,
+so production can request just enough LHE events
+"""
+from __future__ import print_function
+
+import os, json, math, logging
+import os.path as osp
+import xml.etree.ElementTree as ET
+from time import strftime
+
+import svj.core
+import svj.genprod
+
+logger = logging.getLogger('root')
+
+
+def parse_job_report(report_file):
+    """
+    Reads the number of events read from the input and written to the output
+    from a cmsRun framework job report. Since the filters sit in the generation
+    path, only events passing them are written. Missing numbers are None.
+    """
+    root = ET.parse(report_file).getroot()
+    def sum_of(path):
+        values = [ int(el.text) for el in root.findall(path) if el.text and el.text.strip() ]
+        return sum(values) if values else None
+    events_read = sum_of('.//InputFile/EventsRead')
+    if events_read is None:
+        for metric in root.iter('Metric'):
+            if metric.get('Name') == 'NumberEvents':
+                events_read = int(float(metric.get('Value')))
+                break
+    events_written = sum_of('.//File/TotalEvents')
+    logger.info(
+        'Job report {0}: {1} events read, {2} events written'
+        .format(report_file, events_read, events_written)
+        )
+    return { 'events_read' : events_read, 'events_written' : events_written }
+
+
+def n_lhe_events_needed(n_target, efficiency, efficiency_error=0., safety_margin=1.05):
+    """
+    Returns the number of LHE events needed to end up with n_target events after the
+    filters. The efficiency is lowered by one standard deviation, and a relative
+    safety_margin is added on top.
+    """
+    efficiency = efficiency - efficiency_error
+    if efficiency <= 0.:
+        raise ValueError('Filter efficiency too small to estimate the number of LHE events')
+    return int(math.ceil(n_target / efficiency * safety_margin))
+
+
+#____________________________________________________________________
+class FilterEfficiencyStore(object):
+    """
+    Json file with the measured filter efficiency per model and year. Counts of
+    multiple pilot runs of the same model are added up.
+    """
+
+    def __init__(self, store_file=None):
+        super(FilterEfficiencyStore, self).__init__()
+        self.store_file = (
+            osp.join(svj.genprod.SVJ_CACHE_DIR, 'filter_efficiencies.json')
+            if store_file is None else store_file
+            )
+
+    @staticmethod
+    def get_key(config):
+        config = svj.genprod.Config.flexible_init(config)
+        return '{0}_{1}'.format(config.get_model_name(), config['year'])
+
+    def _read(self):
+        if not osp.isfile(self.store_file): return {}
+        with open(self.store_file, 'r') as f:
+            return json.load(f)
+
+    def get(self, config):
+        """
+        Returns a dict with n_in, n_out, efficiency and efficiency_error, or None
+        if the model was not measured yet
+        """
+        return self._read().get(self.get_key(config), None)
+
+    def record(self, config, n_in, n_out):
+        """
+        Adds the counts of a pilot run and returns the updated entry
+        """
+        key = self.get_key(config)
+        svj.core.utils.create_directory(osp.dirname(osp.abspath(self.store_file)))
+        with svj.genprod.utils.file_lock(self.store_file + '.lock'):
+            store = self._read()
+            entry = store.get(key, { 'n_in' : 0, 'n_out' : 0 })
+            entry['n_in'] += n_in
+            entry['n_out'] += n_out
+            efficiency = float(entry['n_out']) / entry['n_in'] if entry['n_in'] else 0.
+            entry['efficiency'] = efficiency
+            # Binomial error
+            entry['efficiency_error'] = (
+                math.sqrt(efficiency * (1. - efficiency) / entry['n_in']) if entry['n_in'] else 0.
+                )
+            entry['last_updated'] = strftime('%Y-%m-%d %H:%M:%S')
+            store[key] = entry
+            tmp = self.store_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(store, f, indent=4, sort_keys=True)
+            os.rename(tmp, self.store_file)
+        logger.info(
+            'Filter efficiency for {0}: {1:.4f} +- {2:.4f} ({3}/{4})'
+            .format(key, entry['efficiency'], entry['efficiency_error'], entry['n_out'], entry['n_in'])
+            )
+        return entry
+
+    def n_lhe_events_needed(self, config, n_target, safety_margin=1.05):
+        """
+        Returns the number of LHE events needed for n_target filtered events, based
+        on the stored efficiency of the model; raises a KeyError if it was not measured
+        """
+        entry = self.get(config)
+        if entry is None:
+            raise KeyError(
+                'No filter efficiency stored for {0}; run a FilterEfficiencyPilot first'
+                .format(self.get_key(config))
+                )
+        n = n_lhe_events_needed(n_target, entry['efficiency'], entry['efficiency_error'], safety_margin)
+        logger.info('Need {0} LHE events for {1} events after filters'.format(n, n_target))
+        return n
+
+
+#____________________________________________________________________
+class FilterEfficiencyPilot(object):
+    """
+    Runs a short GEN-only job (`FullSimRunnerGen`) on an .lhe file with a framework
+    job report, and records the filter efficiency from it in a `FilterEfficiencyStore`
+    """
+
+    def __init__(self, config, lhe_file, n_events=1000, seed=None, store=None):
+        super(FilterEfficiencyPilot, self).__init__()
+        self.config = svj.genprod.Config.flexible_init(config)
+        self.lhe_file = lhe_file
+        self.n_events = n_events
+        self.store = FilterEfficiencyStore() if store is None else store
+        self.runner = svj.genprod.fullsimrunners.FullSimRunnerGen.for_year(
+            self.config, lhe_file, n_events, seed=seed
+            )
+        self.runner.write_job_report = True
+
+    def run(self):
+        """
+        Runs the pilot and returns the updated store entry
+        """
+        self.runner.full_chain()
+        counts = parse_job_report(self.runner.job_report_file)
+        n_in = counts['events_read']
+        if n_in is None:
+            # cmsRun stops after maxEvents, i.e. n_events, unless the file is shorter
+            n_in = self.n_events
+            logger.warning(
+                'No number of events read in the job report; assuming n_events = {0}'
+                .format(n_in)
+                )
+        if counts['events_written'] is None:
+            raise ValueError(
+                'No output events in job report {0}'.format(self.runner.job_report_file)
+                )
+        return self.store.record(self.config, n_in, counts['events_written'])
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
-import os, shutil, sys, glob, subprocess, re, logging
+import os, shutil, sys, glob, subprocess, re, logging, json, socket
 import os.path as osp
 from time import strftime
 
@@ -16,6 +16,20 @@ class FullSimRunnerBase(object):
     """Abstract class to subclass specific runners from"""
 
     seed = None
+    # Pass `-j <job_report_file>` to cmsRun to write a framework job report
+    write_job_report = False
+    # Render the cmsDriver output from a CMSDriverCache instead of running cmsDriver
+    use_cmsdriver_cache = False
+    # Use the release areas of a CMSSWReleasePool shared by all models and stages,
+    # and keep the cfg and output files in the workdir of this model
+    use_cmssw_pool = False
+    # Threads and streams for cmsRun; by default as many threads as cores available
+    # to the job (see `utils.detect_available_cores`; at most `utils.LOCAL_MAX_CORES`
+    # outside of batch mode), capped by max_threads.
+    # Override per stage on the class or the instance.
+    n_threads = None
+    n_streams = None
+    max_threads = None
     _create_workdir_called = False
     _force_renew_workdir = False
 
@@ -33,24 +47,59 @@ class FullSimRunnerBase(object):
     def subclass_per_year(cls):
         raise NotImplementedError('Call this only from a subclass')
 
-    def __init__(self, config, in_file, n_events):
+    @classmethod
+    def for_lhe_shards(cls, config, shards, seed=None):
+        """
+        Returns one runner (for the year of the config) per .lhe shard, e.g. as returned
+        by `lhetools.split_lhe` or `LHEIndex.shard`: a list of (path, first_event, n_events).
+        Shard i gets the seed derived by `utils.derive_chunk_seeds` from `seed`
+        (default: svj.genprod.SVJ_SEED), so the outputs of all shards are distinct.
+        """
+        if seed is None: seed = svj.genprod.SVJ_SEED
+        seeds = svj.genprod.utils.derive_chunk_seeds(seed, len(shards))
+        return [
+            cls.for_year(config, path, n_events, seed=shard_seed)
+            for (path, first_event, n_events), shard_seed in zip(shards, seeds)
+            ]
+
+    def __init__(self, config, in_file, n_events, seed=None):
         super(FullSimRunnerBase, self).__init__()
-        self.seed = svj.genprod.SVJ_SEED if self.__class__.seed is None else self.__class__.seed
+        if not(seed is None):
+            self.seed = seed
+        else:
+            self.seed = svj.genprod.SVJ_SEED if self.__class__.seed is None else self.__class__.seed
         self.config = svj.genprod.Config.flexible_init(config)
         self.year = self.config['year']
         self.model_name = self.config.get_model_name()
+        self.in_file = osp.abspath(in_file)
+        self.n_events = n_events
+        self.define_paths()
 
+    def define_paths(self):
+        """
+        Sets the paths that depend on the model, seed and number of events.
+        Split function from init so that it's possible to tweak e.g. the seed
+        and simply re-call define_paths.
+        """
         self.run_name = 'fullsim_' + self.model_name
         self.fullsim_dir = svj.genprod.RUN_FULLSIM_DIR
         self.workdir = osp.join(self.fullsim_dir, self.run_name)
         self.pileup_filelist_basename = 'pileup_filelist_{0}.txt'.format(self.year)
 
-        self.in_file = osp.abspath(in_file)
-        self.n_events = n_events
+        self.cmssw_pool = svj.genprod.CMSSWReleasePool() if self.use_cmssw_pool else None
+
         self.cfg_file_basename = '{0}_{1}_N{2}_seed{3}.py'.format(self.model_name, self.substage, self.n_events, self.seed)
-        self.cfg_file = osp.join(self.get_cmssw_src(), self.cfg_file_basename)
+        self.cfg_file = osp.join(self.get_run_dir(), self.cfg_file_basename)
         self.out_root_file_basename = '{0}_{1}_N{2}_seed{3}.root'.format(self.model_name, self.substage, self.n_events, self.seed)
-        self.out_root_file = osp.join(self.get_cmssw_src(), self.out_root_file_basename)
+        self.out_root_file = osp.join(self.get_run_dir(), self.out_root_file_basename)
+        self.job_report_file = osp.join(
+            self.get_run_dir(),
+            '{0}_{1}_N{2}_seed{3}_report.xml'.format(self.model_name, self.substage, self.n_events, self.seed)
+            )
+        self.job_info_file = osp.join(
+            self.get_run_dir(),
+            '{0}_{1}_N{2}_seed{3}_jobinfo.json'.format(self.model_name, self.substage, self.n_events, self.seed)
+            )
 
     def create_workdir(self, dry=False):
         """
@@ -64,7 +113,10 @@ class FullSimRunnerBase(object):
 
     def setup_cmssw(self):
         self.create_workdir()
-        svj.core.utils.setup_cmssw(self.workdir, self.cmssw_version, self.arch)
+        if self.cmssw_pool is None:
+            svj.core.utils.setup_cmssw(self.workdir, self.cmssw_version, self.arch)
+        else:
+            self.cmssw_pool.acquire(self.cmssw_version, self.arch)
 
     def copy_pileup_filelist(self):
         file_list = os.path.join(svj.genprod.SVJ_INPUT_DIR, 'pileupfilelists', self.pileup_filelist_basename)
@@ -72,10 +124,25 @@ class FullSimRunnerBase(object):
         shutil.copy(file_list, osp.join(self.workdir, osp.basename(file_list)))
 
     def get_cmssw_src(self, stage=None):
-        return osp.join(self.workdir, self.cmssw_version, 'src')
+        if self.cmssw_pool is None:
+            return osp.join(self.workdir, self.cmssw_version, 'src')
+        return self.cmssw_pool.get_cmssw_src(self.cmssw_version, self.arch)
+
+    def get_run_dir(self):
+        """
+        Directory in which cmsDriver and cmsRun run, and the cfg and output files live
+        """
+        return self.get_cmssw_src() if self.cmssw_pool is None else self.workdir
 
     def compile_cmssw(self):
-        svj.core.utils.compile_cmssw_src(self.get_cmssw_src(), self.arch)
+        """
+        Builds the release, skipping what is not needed since the last build
+        (see `utils.compile_cmssw_src_if_needed`)
+        """
+        if self.cmssw_pool is None:
+            svj.genprod.utils.compile_cmssw_src_if_needed(self.get_cmssw_src(), self.arch)
+        else:
+            self.cmssw_pool.compile(self.cmssw_version, self.arch)
 
     def source_cmssw_cmds(self, cmssw_src=None):
         """
@@ -91,14 +158,75 @@ class FullSimRunnerBase(object):
             'cd {0}'.format(cmssw_src),
             'eval `scramv1 runtime -sh`',
             ]
+        if self.get_run_dir() != cmssw_src:
+            cmds.append('cd {0}'.format(self.get_run_dir()))
         return cmds
 
     def get_cmsdriver_cmd(self):
         raise NotImplementedError('Use this method only in a subclass')
 
+    def get_threading(self):
+        """
+        Returns a dict with the number of threads and streams for cmsRun, and where
+        the number of threads came from. Determined once per runner.
+        """
+        if getattr(self, '_threading', None) is None:
+            if self.n_threads:
+                n_threads, source = self.n_threads, 'override'
+            else:
+                n_threads, source = svj.genprod.utils.detect_available_cores()
+                if self.max_threads and n_threads > self.max_threads:
+                    n_threads, source = self.max_threads, 'max_threads'
+            self._threading = {
+                'n_threads' : n_threads,
+                # cmsRun uses as many streams as threads if not specified
+                'n_streams' : self.n_streams if self.n_streams else n_threads,
+                'n_threads_source' : source,
+                }
+            logger.info(
+                'Using {0} threads and {1} streams for {2} (from {3})'
+                .format(n_threads, self._threading['n_streams'], self.substage, source)
+                )
+        return self._threading
+
+    def compose_cmsdriver_cmd(self):
+        """
+        Returns the cmsDriver command with the threading options added
+        """
+        cmd = list(self.get_cmsdriver_cmd())
+        threading = self.get_threading()
+        if threading['n_threads'] > 1:
+            cmd.append('--nThreads {0}'.format(threading['n_threads']))
+        if self.n_streams:
+            cmd.append('--nStreams {0}'.format(threading['n_streams']))
+        return cmd
+
+    def write_job_info(self):
+        """
+        Records the threading settings and some context of this job in job_info_file
+        """
+        job_info = dict(self.get_threading())
+        job_info.update({
+            'host' : socket.gethostname(),
+            'stage' : self.stage,
+            'substage' : self.substage,
+            'cmssw_version' : self.cmssw_version,
+            'arch' : self.arch,
+            'n_events' : self.n_events,
+            'seed' : self.seed,
+            'date' : strftime('%Y-%m-%d %H:%M:%S'),
+            })
+        svj.core.utils.create_directory(osp.dirname(self.job_info_file))
+        with open(self.job_info_file, 'w') as f:
+            json.dump(job_info, f, indent=4, sort_keys=True)
+
     def cmsdriver(self):
+        self.write_job_info()
+        if self.use_cmsdriver_cache:
+            svj.genprod.CMSDriverCache().cmsdriver(self)
+            return
         cmds = self.source_cmssw_cmds()
-        cmds.append(self.get_cmsdriver_cmd())
+        cmds.append(self.compose_cmsdriver_cmd())
         svj.core.utils.run_multiple_commands(cmds, env=svj.core.utils.get_clean_env())
 
     def edit_cmsdriver_output(self):
@@ -134,13 +262,25 @@ class FullSimRunnerBase(object):
                 )
         self._overwrite_cmsdriver_output(contents)
 
+    def get_cmsrun_cmd(self):
+        if self.write_job_report:
+            return 'cmsRun -j {0} {1}'.format(self.job_report_file, self.cfg_file_basename)
+        return 'cmsRun {0}'.format(self.cfg_file_basename)
+
     def cmsrun(self):
         cmds = self.source_cmssw_cmds()
-        cmds.append('cmsRun {0}'.format(self.cfg_file_basename))
+        cmds.append(self.get_cmsrun_cmd())
         svj.core.utils.run_multiple_commands(cmds, env=svj.core.utils.get_clean_env())
 
-    def full_chain(self):
+    def prepare(self):
+        """
+        Everything that needs to happen before cmsDriver; overwrite in subclasses
+        that need more than a CMSSW release (fragments, pileup file lists, ...)
+        """
         self.setup_cmssw()
+
+    def full_chain(self):
+        self.prepare()
         self.cmsdriver()
         self.edit_cmsdriver_output()
         self.edit_cmsdriver_rnd_service()
@@ -173,18 +313,18 @@ class FullSimRunnerBase(object):
         if not dry:
             shutil.move(self.out_root_file, dst)
 
-    def stageout(self, stageout_directory=None):
+    def get_stageout_dst(self, stageout_directory=None):
         """
-        Stages out a file to the lpc SE
+        Returns the path on the SE to stage out the output to; without a
+        stageout_directory, something reasonable is made up
         """
+        if svj.genprod.BATCH_MODE:
+            condor_cluster = os.environ['CONDOR_CLUSTER_NUMBER']
+            condor_process_id = '_{:04d}'.format(int(os.environ['CONDOR_PROCESS_ID']))
+        else:
+            condor_cluster = 'local'
+            condor_process_id = ''
         if stageout_directory is None:
-            # Make something reasonable
-            if svj.genprod.BATCH_MODE:
-                condor_cluster = os.environ['CONDOR_CLUSTER_NUMBER']
-                condor_process_id = '_{:04d}'.format(int(os.environ['CONDOR_PROCESS_ID']))
-            else:
-                condor_cluster = 'local'
-                condor_process_id = ''
             datestr = os.environ.get('CLUSTER_SUBMISSION_TIMESTAMP_SHORT', strftime('%y-%m-%d'))
             stageout_directory = (
                 '/store/user/{user}/semivis/{condor_cluster}_{datestr}_{substage}_{model_name}'
@@ -196,7 +336,18 @@ class FullSimRunnerBase(object):
                     model_name = self.model_name
                     )
                 )
-        dst = osp.join(stageout_directory, 'N{0}{1}_seed{2}.root'.format(self.n_events, condor_process_id, self.seed))
-        semanager = svj.genprod.SEManager()
-        semanager.copy_to_se(self.out_root_file, dst, create_parent_directory=True)
+        return osp.join(stageout_directory, 'N{0}{1}_seed{2}.root'.format(self.n_events, condor_process_id, self.seed))
+
+    def stageout(self, stageout_directory=None, blocking=True):
+        """
+        Stages out a file to the lpc SE. With blocking=False, the transfer is queued
+        on the background stageout queue and its transfer id is returned immediately;
+        call `svj.genprod.stageoutqueue.wait_all()` before the job ends.
+        """
+        dst = self.get_stageout_dst(stageout_directory)
+        if blocking:
+            semanager = svj.genprod.SEManager()
+            semanager.copy_to_se(self.out_root_file, dst, create_parent_directory=True)
+        else:
+            return svj.genprod.stageoutqueue.get_stageout_queue().put(self.out_root_file, dst)
 
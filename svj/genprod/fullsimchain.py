@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os, logging
+import os.path as osp
+from collections import OrderedDict
+
+import svj.core
+import svj.genprod
+logger = logging.getLogger('root')
+from .fullsimbase import FullSimRunnerBase
+
+
+def parse_cmsdriver_cmd(cmd):
+    """
+    Splits a cmsDriver command as returned by `get_cmsdriver_cmd` (a list like
+    ['cmsDriver.py step1', '--mc', '-n 10', ...]) in its first element and an
+    OrderedDict of option -> value (None for flags)
+    """
+    options = OrderedDict()
+    for part in cmd[1:]:
+        key, _, value = part.partition(' ')
+        options[key] = value if value else None
+    return cmd[0], options
+
+
+def _overrides(runner, method_name):
+    """
+    Whether the class of runner overrides method_name of FullSimRunnerBase
+    """
+    method = getattr(type(runner), method_name)
+    base_method = getattr(FullSimRunnerBase, method_name)
+    return getattr(method, '__func__', method) is not getattr(base_method, '__func__', base_method)
+
+
+def can_merge_steps(runner, next_runner):
+    """
+    Whether next_runner (which reads the output of runner) can run in the same
+    cmsRun process: same release, conditions and era, and no edits of the
+    cmsDriver output that would only apply to one of the steps
+    """
+    if (runner.cmssw_version, runner.arch) != (next_runner.cmssw_version, next_runner.arch):
+        return False
+    if _overrides(runner, 'edit_cmsdriver_output') or _overrides(next_runner, 'edit_cmsdriver_output'):
+        return False
+    try:
+        _, options = parse_cmsdriver_cmd(runner.get_cmsdriver_cmd())
+        _, next_options = parse_cmsdriver_cmd(next_runner.get_cmsdriver_cmd())
+    except NotImplementedError:
+        return False
+    for key in [ '--conditions', '--era', '--scenario' ]:
+        if options.get(key) != next_options.get(key): return False
+    return True
+
+
+#____________________________________________________________________
+class FullSimRunnerMergedSteps(FullSimRunnerBase):
+    """
+    Runs the steps of several consecutive runners that share a release, conditions
+    and era in one cmsDriver configuration, so only the final output is written.
+    """
+
+    # Options taken from the first step; other options are taken from the last step
+    options_from_first_step = [ '--filein', '--pileup_input', '--datamix', '--beamspot', '--geometry' ]
+
+    def __init__(self, runners):
+        self.runners = runners
+        self.cmssw_version = runners[0].cmssw_version
+        self.arch = runners[0].arch
+        self.stage = runners[-1].stage
+        self.substage = '_'.join(runner.substage for runner in runners)
+        super(FullSimRunnerMergedSteps, self).__init__(
+            runners[0].config, runners[0].in_file, runners[0].n_events, seed=runners[0].seed
+            )
+        # The output is that of the last step
+        self.out_root_file_basename = runners[-1].out_root_file_basename
+        self.out_root_file = runners[-1].out_root_file
+
+    def prepare(self):
+        for runner in self.runners:
+            runner.prepare()
+
+    def get_cmsdriver_cmd(self):
+        parsed = [ parse_cmsdriver_cmd(runner.get_cmsdriver_cmd()) for runner in self.runners ]
+        head, options = parsed[0][0], OrderedDict(parsed[0][1])
+        for _, step_options in parsed[1:]:
+            for key, value in step_options.items():
+                if key == '--step':
+                    options[key] = options[key] + ',' + value
+                elif key in self.options_from_first_step:
+                    if not key in options: options[key] = value
+                else:
+                    options[key] = value
+        options['--fileout'] = 'file:{0}'.format(self.out_root_file_basename)
+        options['--python_filename'] = self.cfg_file_basename
+        return [ head ] + [ key if value is None else '{0} {1}'.format(key, value) for key, value in options.items() ]
+
+
+#____________________________________________________________________
+class FullSimChain(object):
+    """
+    Runs a sequence of runner classes (e.g. AOD step1, AOD step2, MiniAOD) on one
+    input file, every stage reading the output of the previous one.
+
+    Consecutive stages that share a CMSSW release are run together: if their
+    conditions and era are the same, they are merged into one cmsRun configuration
+    (see `FullSimRunnerMergedSteps`); otherwise their cmsDriver and cmsRun commands
+    run in one shell session each. Intermediate outputs are removed as soon as the
+    next stage is done with them, unless keep_intermediate_files is True.
+
+    Only the output of the final stage is staged out by `stageout`, after the whole
+    chain ran, so by default no transfer overlaps with processing. With
+    stageout_intermediate_files set, the output of every group of stages (i.e. of
+    every release) is queued on the background stageout queue as soon as the group
+    is done, so it is transferred while the next group runs; it is removed only once
+    its transfer is done. Steps merged in one cmsRun write no intermediate output,
+    so there is nothing to stage out between them.
+    """
+
+    def __init__(self, config, in_file, n_events, runner_classes, seed=None):
+        super(FullSimChain, self).__init__()
+        self.config = svj.genprod.Config.flexible_init(config)
+        self.runners = []
+        for Runner in runner_classes:
+            runner = Runner.for_year(self.config, in_file, n_events, seed=seed)
+            self.runners.append(runner)
+            in_file = runner.out_root_file
+        self.merge_steps = True
+        self.keep_intermediate_files = False
+        self.stageout_intermediate_files = False
+        self.stageout_directory = None
+        # Intermediate out_root_file -> id of its transfer on the stageout queue
+        self._intermediate_transfers = {}
+
+    @property
+    def final_runner(self):
+        return self.runners[-1]
+
+    @property
+    def out_root_file(self):
+        return self.final_runner.out_root_file
+
+    def get_groups(self):
+        """
+        Returns lists of consecutive runners with the same release and arch
+        """
+        groups = []
+        for runner in self.runners:
+            if groups and (groups[-1][-1].cmssw_version, groups[-1][-1].arch) == (runner.cmssw_version, runner.arch):
+                groups[-1].append(runner)
+            else:
+                groups.append([runner])
+        return groups
+
+    def merge_group(self, group):
+        """
+        Replaces runs of mergeable runners in a group by a FullSimRunnerMergedSteps
+        """
+        merged = [ [group[0]] ]
+        for runner in group[1:]:
+            if self.merge_steps and can_merge_steps(merged[-1][-1], runner):
+                merged[-1].append(runner)
+            else:
+                merged.append([runner])
+        return [ steps[0] if len(steps) == 1 else FullSimRunnerMergedSteps(steps) for steps in merged ]
+
+    def run(self):
+        for group in self.get_groups():
+            runners = self.merge_group(group)
+            logger.info(
+                'Running {0} in {1}'
+                .format(', '.join(r.substage for r in runners), runners[0].cmssw_version)
+                )
+            if len(runners) == 1:
+                runners[0].full_chain()
+                self.remove_intermediate_input(runners[0])
+            else:
+                self.run_in_one_session(runners)
+            if self.stageout_intermediate_files and runners[-1].out_root_file != self.out_root_file:
+                self._intermediate_transfers[runners[-1].out_root_file] = runners[-1].stageout(
+                    self.stageout_directory, blocking=False
+                    )
+
+    def run_in_one_session(self, runners):
+        for runner in runners:
+            runner.prepare()
+        cmds = runners[0].source_cmssw_cmds()
+        for runner in runners:
+            if runner.use_cmsdriver_cache:
+                runner.cmsdriver()
+                continue
+            cmds.append(runner.compose_cmsdriver_cmd())
+            runner.write_job_info()
+        if len(cmds) > len(runners[0].source_cmssw_cmds()):
+            svj.core.utils.run_multiple_commands(cmds, env=svj.core.utils.get_clean_env())
+        for runner in runners:
+            runner.edit_cmsdriver_output()
+            runner.edit_cmsdriver_rnd_service()
+        cmds = runners[0].source_cmssw_cmds()
+        for runner in runners:
+            cmds.append(runner.get_cmsrun_cmd())
+            # Inputs that are being staged out are removed once their transfer is done
+            if self.is_intermediate(runner.in_file) and not runner.in_file in self._intermediate_transfers:
+                cmds.append('rm {0}'.format(runner.in_file))
+        svj.core.utils.run_multiple_commands(cmds, env=svj.core.utils.get_clean_env())
+        for runner in runners:
+            self.remove_intermediate_input(runner)
+
+    def is_intermediate(self, path):
+        if self.keep_intermediate_files: return False
+        return path in [ runner.out_root_file for runner in self.runners[:-1] ]
+
+    def remove_intermediate_input(self, runner):
+        if self.is_intermediate(runner.in_file) and osp.isfile(runner.in_file):
+            if runner.in_file in self._intermediate_transfers:
+                status = svj.genprod.stageoutqueue.get_stageout_queue().wait(
+                    self._intermediate_transfers[runner.in_file]
+                    )
+                if status != 'done':
+                    logger.error('Stageout of {0} failed; not removing it'.format(runner.in_file))
+                    return
+            logger.info('Removing intermediate file {0}'.format(runner.in_file))
+            os.remove(runner.in_file)
+
+    def copy_to_output(self, output_dir=None, dry=False):
+        self.final_runner.copy_to_output(output_dir, dry)
+
+    def move_to_output(self, output_dir=None, dry=False):
+        self.final_runner.move_to_output(output_dir, dry)
+
+    def stageout(self, stageout_directory=None, blocking=True):
+        """
+        Stages out the final output. If blocking, this also waits for the queued
+        stageouts of intermediate outputs, so the job can end once it returns.
+        """
+        transfer_id = self.final_runner.stageout(stageout_directory, blocking)
+        if blocking and self._intermediate_transfers:
+            svj.genprod.stageoutqueue.wait_all()
+        return transfer_id
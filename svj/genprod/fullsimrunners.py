@@ -25,29 +25,49 @@ class FullSimRunnerGenSim(FullSimRunnerBase):
             2018: FullSimRunnerGenSim2018,
             }
 
-    def __init__(self, *args, **kwargs):
-        super(FullSimRunnerGenSim, self).__init__(*args, **kwargs)
-        self.gensimfragment_basename = 'SVJGenSimFragment.py'
+    def define_paths(self):
+        super(FullSimRunnerGenSim, self).define_paths()
+        if self.cmssw_pool is None:
+            self.gensimfragment_basename = 'SVJGenSimFragment.py'
+        else:
+            # The release is shared with other models
+            self.gensimfragment_basename = 'SVJGenSimFragment_{0}.py'.format(self.model_name)
         self.gensimfragment_dir = osp.join(self.get_cmssw_src(), 'Configuration/GenProduction/python')
         self.gensimfragment_file = osp.join(self.gensimfragment_dir, self.gensimfragment_basename)
 
-    def full_chain(self):
+    def prepare(self):
         self.setup_cmssw()
+        self.prepare_in_file()
         self.add_gensimfragment()
-        self.cmsdriver()
-        self.edit_cmsdriver_output()
-        self.edit_cmsdriver_rnd_service()
-        self.cmsrun()
+
+    def prepare_in_file(self):
+        """
+        The LHESource cannot read compressed .lhe files; decompresses a .lhe.gz or
+        .lhe.zst in_file into the workdir and uses that as the input instead
+        """
+        if svj.genprod.lhetools.get_compression(self.in_file) is None: return
+        dst = osp.join(
+            self.workdir,
+            svj.genprod.lhetools.strip_compression_extension(osp.basename(self.in_file))
+            )
+        self.in_file = svj.genprod.lhetools.decompress_lhe(self.in_file, dst)
 
     def add_gensimfragment(self):
         """
-        Creates the gensimfragment
+        Creates the gensimfragment; the release is only rebuilt as far as needed
+        (usually just `scram b python`, or nothing if the fragment did not change)
         """
         svj.core.utils.create_directory(self.gensimfragment_dir)
-        gensimfragment = svj.genprod.GenSimFragment(self.config)
+        gensimfragment = self.make_gensimfragment()
         gensimfragment.to_file(self.gensimfragment_file)
         self.compile_cmssw()
 
+    def make_gensimfragment(self):
+        """
+        Overwrite this method to tweak the fragment for a specific release
+        """
+        return svj.genprod.GenSimFragment(self.config)
+
     def edit_cmsdriver_output(self):
         """
         Takes the cfg file generated by cmsDriver.py, edits some lines, and re-saves
@@ -239,12 +259,9 @@ class FullSimRunnerAOD(FullSimRunnerBase):
         2018: FullSimRunnerAOD2018,
         }
 
-    def full_chain(self):
+    def prepare(self):
         self.setup_cmssw()
         self.copy_pileup_filelist()
-        self.cmsdriver()
-        self.edit_cmsdriver_rnd_service()
-        self.cmsrun()
 
 
 class FullSimRunnerAOD2016(FullSimRunnerAOD):
@@ -375,6 +392,66 @@ class FullSimRunnerMiniAOD2018(FullSimRunnerMiniAOD):
         raise NotImplementedError
 
 
+#____________________________________________________________________
+class FullSimRunnerNanoGEN(FullSimRunnerGenSim):
+    """
+    Generator-level NanoAOD straight from the .lhe file: GEN and NANOGEN in one
+    cmsDriver step, skipping SIM, the AOD steps and MiniAOD.
+    All years use the same UL release, which has the dark quark/Z2 filter plug-ins.
+    """
+    stage = 'nanogen'
+    substage = 'NanoGEN'
+    cmssw_version = 'CMSSW_10_6_26'
+    arch = 'slc7_amd64_gcc700'
+
+    @classmethod
+    def subclass_per_year(cls):
+        return {
+            2016: FullSimRunnerNanoGEN2016,
+            2017: FullSimRunnerNanoGEN2017,
+            2018: FullSimRunnerNanoGEN2018,
+            }
+
+    def make_gensimfragment(self):
+        gensimfragment = super(FullSimRunnerNanoGEN, self).make_gensimfragment()
+        # Also for 2016, since this release has the unsmeared HepMC product
+        gensimfragment.unsmeared_hepmc = True
+        return gensimfragment
+
+    def get_cmsdriver_cmd(self):
+        return [
+            'cmsDriver.py Configuration/GenProduction/python/{0}'.format(self.gensimfragment_basename),
+            '--filein file:{0}'.format(self.in_file),
+            '--fileout file:{0}'.format(self.out_root_file_basename),
+            '--mc',
+            '--eventcontent NANOAODGEN',
+            '--datatier NANOAOD',
+            '--conditions {0}'.format(self.conditions),
+            '--beamspot {0}'.format(self.beamspot),
+            '--step GEN,NANOGEN',
+            '--era {0}'.format(self.era),
+            '--customise Configuration/DataProcessing/Utils.addMonitoring',
+            '--python_filename {0}'.format(self.cfg_file_basename),
+            '--no_exec',
+            '-n {0}'.format(self.n_events),
+            ]
+
+class FullSimRunnerNanoGEN2016(FullSimRunnerNanoGEN):
+    conditions = '106X_mcRun2_asymptotic_v17'
+    beamspot = 'Realistic25ns13TeV2016Collision'
+    era = 'Run2_2016'
+
+class FullSimRunnerNanoGEN2017(FullSimRunnerNanoGEN):
+    conditions = '106X_mc2017_realistic_v9'
+    beamspot = 'Realistic25ns13TeVEarly2017Collision'
+    era = 'Run2_2017'
+
+class FullSimRunnerNanoGEN2018(FullSimRunnerNanoGEN):
+    conditions = '106X_upgrade2018_realistic_v16_L1v1'
+    beamspot = 'Realistic25ns13TeVEarly2018Collision'
+    era = 'Run2_2018'
+
+
 #____________________________________________________________________
 class FullSimRunnerNanoAOD(FullSimRunnerBase):
     stage = 'nano'
@@ -47,6 +47,9 @@ class GenSimFragment(object):
         self.alpha_d = self.config['alpha_d']
         self.process_type = self.config['process_type']
         self.year = self.config['year']
+        # Whether the filters read the HepMC product ('generator', 'unsmeared');
+        # releases used for 2016 GEN-SIM only have the 'generator' one
+        self.unsmeared_hepmc = (self.year != 2016)
 
 
     def set_dark_params(self):
@@ -327,7 +330,7 @@ class GenSimFragment(object):
             .format(
                 two_n_dmatter=2*self.n_f,
                 extra_dmatter=', 53' if self.n_f == 2 else '',
-                smear='' if self.year == 2016 else ', "unsmeared"'
+                smear=', "unsmeared"' if self.unsmeared_hepmc else ''
                 )
             )
         logger.info("Extra filters added to gen fragment")
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os, shutil, glob, json, hashlib, logging, socket, uuid, errno
+import os.path as osp
+from time import strftime
+from contextlib import contextmanager
+
+import svj.core
+import svj.genprod
+
+logger = logging.getLogger('root')
+
+
+def sha1_of_file(path, blocksize=1024*1024):
+    """
+    Computes the sha1 hexdigest of a file without reading it into memory at once
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def hash_directory(directory, ignore_extensions=('.pyc', '.tar')):
+    """
+    Returns a dict of relative path -> sha1 for all files in directory.
+    Compiled python files and tarballs (which contain timestamps) are skipped.
+    """
+    hashes = {}
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [ d for d in dirs if d != '__pycache__' ]
+        for file in files:
+            if file.endswith(ignore_extensions): continue
+            path = osp.join(root, file)
+            hashes[osp.relpath(path, directory)] = sha1_of_file(path)
+    return hashes
+
+
+def link_or_copy(src, dst):
+    """
+    Tries to hardlink src to dst, and falls back to a copy if that fails
+    (e.g. when src and dst are on different filesystems)
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def make_working_copy(src, dst, link_mode='reflink'):
+    """
+    Copies the directory src to dst (which should not exist yet).
+    link_mode 'reflink' makes a copy-on-write copy where the filesystem supports it
+    and a regular copy otherwise; 'hardlink' hardlinks all files, which is faster but
+    only safe if no file is modified in place afterwards.
+    """
+    if link_mode == 'reflink':
+        cmd = [ 'cp', '-a', '--reflink=auto', src, dst ]
+    elif link_mode == 'hardlink':
+        cmd = [ 'cp', '-al', src, dst ]
+    else:
+        raise ValueError('Unknown link_mode {0}'.format(link_mode))
+    logger.info('Making working copy {0} ==> {1} ({2})'.format(src, dst, link_mode))
+    svj.core.utils.run_command(cmd)
+    return dst
+
+
+#____________________________________________________________________
+class GridpackCache(object):
+    """
+    Local content-addressed cache for gridpacks.
+
+    The key is a sha1 of the canonical (sorted) json dump of the config, the lhaid,
+    the contents of the rendered model and input cards, and the
+    `gridpack_generation.sh` script of the genproductions installation.
+    Every entry is a directory `<cache_dir>/<key>` containing the tarball, the log
+    file, and a `manifest.json` describing what was stored.
+    """
+
+    manifest_basename = 'manifest.json'
+
+    def __init__(self, cache_dir=None):
+        super(GridpackCache, self).__init__()
+        self.cache_dir = (
+            osp.join(svj.genprod.SVJ_CACHE_DIR, 'gridpacks')
+            if cache_dir is None else cache_dir
+            )
+
+    def get_key(self, config, lhaid, model_dir, input_dir, genprod_dir=None):
+        """
+        Computes the cache key for a gridpack. Should be called after the model
+        and input directories are filled in.
+        """
+        key_contents = {
+            'config' : dict(config),
+            'lhaid' : lhaid,
+            'model_cards' : hash_directory(model_dir),
+            'input_cards' : hash_directory(input_dir),
+            }
+        if not(genprod_dir is None):
+            script = osp.join(genprod_dir, 'gridpack_generation.sh')
+            if osp.isfile(script):
+                key_contents['gridpack_generation.sh'] = sha1_of_file(script)
+        canonical = json.dumps(key_contents, sort_keys=True, default=str)
+        key = hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+        logger.debug('Gridpack cache key %s for contents:\n%s', key, canonical)
+        return key
+
+    def get_entry_dir(self, key):
+        return osp.join(self.cache_dir, key)
+
+    def has(self, key):
+        return osp.isfile(osp.join(self.get_entry_dir(key), self.manifest_basename))
+
+    def read_manifest(self, key):
+        with open(osp.join(self.get_entry_dir(key), self.manifest_basename), 'r') as f:
+            return json.load(f)
+
+    def fetch(self, key, dst_dir):
+        """
+        Hardlinks (or copies) the cached files for `key` into dst_dir.
+        Returns the list of restored paths.
+        """
+        entry_dir = self.get_entry_dir(key)
+        manifest = self.read_manifest(key)
+        restored = []
+        for basename in manifest['files']:
+            src = osp.join(entry_dir, basename)
+            dst = osp.join(dst_dir, basename)
+            if osp.exists(dst):
+                logger.warning('Removing previously existing {0}'.format(dst))
+                os.remove(dst)
+            logger.info('Restoring from gridpack cache: {0} ==> {1}'.format(src, dst))
+            link_or_copy(src, dst)
+            restored.append(dst)
+        return restored
+
+    def store(self, key, srcs, metadata=None):
+        """
+        Stores the files `srcs` under `key`. Files are first put in a temporary
+        directory which is then renamed, so a partially written entry is never
+        picked up by `has`.
+        """
+        srcs = [ src for src in srcs if osp.isfile(src) ]
+        if len(srcs) == 0:
+            logger.warning('No files to store in gridpack cache for key {0}'.format(key))
+            return
+        svj.core.utils.create_directory(self.cache_dir)
+        entry_dir = self.get_entry_dir(key)
+        tmp_dir = entry_dir + '.tmp_{0}_{1}'.format(socket.gethostname(), os.getpid())
+        svj.core.utils.create_directory(tmp_dir, force=True)
+        for src in srcs:
+            logger.info('Storing in gridpack cache: {0} ==> {1}'.format(src, entry_dir))
+            link_or_copy(src, osp.join(tmp_dir, osp.basename(src)))
+        manifest = {
+            'key' : key,
+            'files' : [ osp.basename(src) for src in srcs ],
+            'created' : strftime('%Y-%m-%d %H:%M:%S'),
+            }
+        if metadata: manifest.update(metadata)
+        with open(osp.join(tmp_dir, self.manifest_basename), 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True, default=str)
+        if osp.isdir(entry_dir):
+            logger.warning('Replacing existing gridpack cache entry {0}'.format(entry_dir))
+            shutil.rmtree(entry_dir)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process stored the same key in the meantime; keep theirs
+            if not self.has(key): raise
+            logger.warning('Gridpack cache entry {0} was created concurrently'.format(entry_dir))
+            shutil.rmtree(tmp_dir)
+
+    def remove(self, key):
+        entry_dir = self.get_entry_dir(key)
+        if osp.isdir(entry_dir):
+            logger.warning('Removing gridpack cache entry {0}'.format(entry_dir))
+            shutil.rmtree(entry_dir)
+
+
+#____________________________________________________________________
+class CompiledProcessCache(object):
+    """
+    Keeps compiled MadGraph process directories, so that scan points that only
+    differ in the mediator and dark quark masses can reuse them.
+
+    The key covers everything that goes into the compiled matrix elements: the
+    unrendered model and input templates, the year and lhaid, the number of events
+    in the run card and the genproductions `gridpack_generation.sh`.
+    Masses only enter via `param_card.dat`, which MadGraph reads at run time.
+
+    Every entry `<cache_dir>/<key>` holds a genproductions working copy in which
+    the first (seed) gridpack was generated without cleaning up, plus a
+    `manifest.json` pointing to its compiled MadGraph process and work directories.
+    `gridpack_generation.sh` removes the `processtmp` directory it compiles in, so
+    the process is usually the `madevent` directory of the pilot run gridpack that
+    the script unpacks in `<name>_gridpack/work/process`; `processtmp` is only used
+    if it is still there. Processes are never moved after compilation, since
+    MadGraph stores absolute paths.
+    """
+
+    manifest_basename = 'manifest.json'
+
+    def __init__(self, cache_dir=None):
+        super(CompiledProcessCache, self).__init__()
+        self.cache_dir = (
+            osp.join(svj.genprod.SVJ_CACHE_DIR, 'processes')
+            if cache_dir is None else cache_dir
+            )
+
+    def get_key(self, template_model_dir, template_input_dir, year, lhaid, n_events, genprod_dir=None):
+        key_contents = {
+            'model_templates' : hash_directory(template_model_dir),
+            'input_templates' : hash_directory(template_input_dir),
+            'year' : year,
+            'lhaid' : lhaid,
+            'n_events' : n_events,
+            }
+        if not(genprod_dir is None):
+            script = osp.join(genprod_dir, 'gridpack_generation.sh')
+            if osp.isfile(script):
+                key_contents['gridpack_generation.sh'] = sha1_of_file(script)
+        canonical = json.dumps(key_contents, sort_keys=True, default=str)
+        key = hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+        logger.debug('Compiled process cache key %s for contents:\n%s', key, canonical)
+        return key
+
+    def get_entry_dir(self, key):
+        return osp.join(self.cache_dir, key)
+
+    def get_lock_file(self, key):
+        return osp.join(self.cache_dir, key + '.lock')
+
+    def get_genprod_dir(self, key):
+        return osp.join(self.get_entry_dir(key), 'genproductions')
+
+    def has(self, key):
+        return osp.isfile(osp.join(self.get_entry_dir(key), self.manifest_basename))
+
+    def read_manifest(self, key):
+        with open(osp.join(self.get_entry_dir(key), self.manifest_basename), 'r') as f:
+            return json.load(f)
+
+    def create_entry(self, key, genprod_dir, model_names=()):
+        """
+        Creates a fresh entry with a working copy of the genproductions directory,
+        in which the seed gridpack should be generated. Returns the working copy.
+        """
+        self.remove(key)
+        svj.core.utils.create_directory(self.get_entry_dir(key))
+        return svj.genprod.gridpackscan.create_genprod_working_copy(
+            genprod_dir, self.get_genprod_dir(key), model_names=model_names
+            )
+
+    @staticmethod
+    def is_process_dir(path):
+        return (
+            osp.isfile(osp.join(path, 'bin', 'generate_events'))
+            and osp.isdir(osp.join(path, 'SubProcesses'))
+            )
+
+    def find_process_dir(self, seed_dir):
+        """
+        Returns (process_dir, work_dir, cmssw_src) of the seed gridpack generation
+        directory; process_dir and work_dir are None if no compiled process is found
+        """
+        processtmp_dir = None
+        process_dir = None
+        cmssw_src = None
+        for root, dirs, files in os.walk(seed_dir):
+            if '.SCRAM' in dirs and cmssw_src is None:
+                cmssw_src = osp.join(root, 'src')
+            # processtmp is only left if the script did not clean up
+            if 'processtmp' in dirs and processtmp_dir is None and self.is_process_dir(osp.join(root, 'processtmp')):
+                processtmp_dir = osp.join(root, 'processtmp')
+            if 'process' in dirs and process_dir is None and self.is_process_dir(osp.join(root, 'process', 'madevent')):
+                process_dir = osp.join(root, 'process', 'madevent')
+        if not(processtmp_dir is None):
+            return processtmp_dir, osp.dirname(processtmp_dir), cmssw_src
+        if not(process_dir is None):
+            return process_dir, osp.dirname(osp.dirname(process_dir)), cmssw_src
+        return None, None, cmssw_src
+
+    def register(self, key, seed_model_name, seed_tarball):
+        """
+        Finds the compiled process of the seed gridpack in the entry and writes
+        the manifest. Raises if the gridpack generation directory is incomplete.
+        """
+        seed_dir = osp.join(self.get_genprod_dir(key), seed_model_name)
+        process_dir, work_dir, cmssw_src = self.find_process_dir(seed_dir)
+        if process_dir is None:
+            self.remove(key)
+            raise RuntimeError(
+                'Could not find a compiled process (processtmp or process/madevent) in {0}; '
+                'cannot reuse it for other mass points'
+                .format(seed_dir)
+                )
+        manifest = {
+            'key' : key,
+            'seed_model_name' : seed_model_name,
+            'seed_tarball' : osp.basename(seed_tarball),
+            'process_dir' : process_dir,
+            'work_dir' : work_dir,
+            'cmssw_src' : cmssw_src,
+            'created' : strftime('%Y-%m-%d %H:%M:%S'),
+            }
+        logger.info('Registering compiled process {0}'.format(process_dir))
+        with open(osp.join(self.get_entry_dir(key), self.manifest_basename), 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        return manifest
+
+    def remove(self, key):
+        entry_dir = self.get_entry_dir(key)
+        if osp.isdir(entry_dir):
+            logger.warning('Removing compiled process cache entry {0}'.format(entry_dir))
+            shutil.rmtree(entry_dir)
+
+
+#____________________________________________________________________
+class ExtractedGridpackCache(object):
+    """
+    Node-local cache of extracted gridpacks, keyed by the sha1 of the tarball, so that
+    LHE jobs running off the same gridpack share one pristine extraction.
+
+    Every entry `<cache_dir>/<sha1>` contains the extraction in `pristine/` and a
+    `holders.json` with the jobs currently using it; all modifications of an entry
+    happen under a file lock `<cache_dir>/<sha1>.lock`. Jobs never run in the pristine
+    directory, but in a working copy made with `make_working_copy`.
+    Entries without (live) holders can be removed with `prune`.
+    """
+
+    def __init__(self, cache_dir=None, link_mode='reflink'):
+        super(ExtractedGridpackCache, self).__init__()
+        self.cache_dir = (
+            osp.join(svj.genprod.SVJ_CACHE_DIR, 'extracted')
+            if cache_dir is None else cache_dir
+            )
+        self.link_mode = link_mode
+        self.checksums_file = osp.join(self.cache_dir, 'checksums.json')
+
+    def get_lock_file(self, key):
+        return osp.join(self.cache_dir, key + '.lock')
+
+    def get_pristine_dir(self, key):
+        return osp.join(self.cache_dir, key, 'pristine')
+
+    def get_holders_file(self, key):
+        return osp.join(self.cache_dir, key, 'holders.json')
+
+    def get_key(self, tarball):
+        """
+        Returns the sha1 of the tarball. Checksums are remembered per (path, size,
+        mtime), so a tarball is only read once.
+        Tarballs on the SE are assumed immutable and keyed by their url.
+        """
+        if tarball.startswith('root://'):
+            return hashlib.sha1(tarball.encode('utf-8')).hexdigest()
+        path = osp.realpath(tarball)
+        stat = os.stat(path)
+        signature = '{0}:{1}:{2}'.format(path, stat.st_size, int(stat.st_mtime))
+        with svj.genprod.utils.file_lock(self.checksums_file + '.lock'):
+            checksums = {}
+            if osp.isfile(self.checksums_file):
+                with open(self.checksums_file, 'r') as f:
+                    checksums = json.load(f)
+            if not signature in checksums:
+                logger.info('Computing checksum of {0}'.format(path))
+                checksums[signature] = sha1_of_file(path)
+                with open(self.checksums_file, 'w') as f:
+                    json.dump(checksums, f, indent=4, sort_keys=True)
+        return checksums[signature]
+
+    def _read_holders(self, key):
+        holders_file = self.get_holders_file(key)
+        if not osp.isfile(holders_file): return []
+        with open(holders_file, 'r') as f:
+            return json.load(f)
+
+    def _write_holders(self, key, holders):
+        with open(self.get_holders_file(key), 'w') as f:
+            json.dump(holders, f, indent=4)
+
+    @staticmethod
+    def _is_alive(holder):
+        """
+        Holders are 'host:pid:token'; a holder is considered dead if it is on this
+        host and its process does not exist anymore
+        """
+        host, pid, token = holder.split(':')
+        if host != socket.gethostname(): return True
+        try:
+            os.kill(int(pid), 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+
+    def acquire(self, tarball):
+        """
+        Makes sure the tarball is extracted in the cache and registers the caller as
+        a holder. Returns (key, holder, pristine_dir); pass key and holder to `release`.
+        """
+        key = self.get_key(tarball)
+        pristine_dir = self.get_pristine_dir(key)
+        holder = '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        with svj.genprod.utils.file_lock(self.get_lock_file(key)):
+            if not osp.isdir(pristine_dir):
+                tmp_dir = pristine_dir + '.tmp'
+                svj.core.utils.create_directory(tmp_dir, force=True)
+                logger.warning('Extracting {0} into cache {1}'.format(tarball, tmp_dir))
+                svj.genprod.utils.extract_tarball(tarball, tmp_dir)
+                os.rename(tmp_dir, pristine_dir)
+            else:
+                logger.info('Using cached extraction {0} of {1}'.format(pristine_dir, tarball))
+            holders = [ h for h in self._read_holders(key) if self._is_alive(h) ]
+            holders.append(holder)
+            self._write_holders(key, holders)
+            logger.info('{0} now has {1} holder(s)'.format(pristine_dir, len(holders)))
+        return key, holder, pristine_dir
+
+    def release(self, key, holder):
+        with svj.genprod.utils.file_lock(self.get_lock_file(key)):
+            holders = [ h for h in self._read_holders(key) if h != holder and self._is_alive(h) ]
+            self._write_holders(key, holders)
+            logger.info('{0} now has {1} holder(s)'.format(self.get_pristine_dir(key), len(holders)))
+
+    @contextmanager
+    def working_copy(self, tarball, dst):
+        """
+        Context manager that provides a working copy of the extracted tarball in dst,
+        and releases the cache entry afterwards (the working copy itself is kept)
+        """
+        key, holder, pristine_dir = self.acquire(tarball)
+        try:
+            if osp.isdir(dst):
+                logger.warning('Removing previously existing {0}'.format(dst))
+                shutil.rmtree(dst)
+            svj.core.utils.create_directory(osp.dirname(dst))
+            make_working_copy(pristine_dir, dst, self.link_mode)
+            yield dst
+        finally:
+            self.release(key, holder)
+
+    def prune(self):
+        """
+        Removes all extracted gridpacks that have no live holders
+        """
+        for key in os.listdir(self.cache_dir) if osp.isdir(self.cache_dir) else []:
+            if not osp.isdir(osp.join(self.cache_dir, key)): continue
+            with svj.genprod.utils.file_lock(self.get_lock_file(key)):
+                holders = [ h for h in self._read_holders(key) if self._is_alive(h) ]
+                if holders: continue
+                logger.warning('Removing unused extracted gridpack {0}'.format(key))
+                shutil.rmtree(osp.join(self.cache_dir, key))
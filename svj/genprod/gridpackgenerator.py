@@ -40,6 +40,17 @@ class GridpackGenerator(object):
         This produces the actual tarball, in the CMSSW genproductions directory.
         Use the method `move_to_output` to move the tarball to a sensible location.
 
+    If `use_gridpack_cache` is True (default), the tarball and log are looked up in the
+    local `GridpackCache` before `compile_gridpack` is called. On a hit the cached files
+    are restored into the CMSSW genproductions directory and compilation is skipped;
+    on a miss the freshly compiled tarball and log are stored in the cache.
+
+    If `reuse_compiled_process` is True, `compile_gridpack_reusing_process` is used
+    instead of `compile_gridpack`: the MadGraph process is compiled once per set of
+    templates/year, and other mass points only swap the param card and redo the
+    integration. See `CompiledProcessCache`. This is off by default: rerunning the
+    integration in the unpacked pilot run process and repacking the tarball has not
+    been validated against a real gridpack yet, so check the tarballs it makes.
 
 
     """
@@ -52,6 +63,10 @@ class GridpackGenerator(object):
         self.force_renew_input_dir = True
         self.force_renew_gridpack_dir = True
         self.cleanup_gp_generation_dir = True
+        self.use_gridpack_cache = True
+        self.reuse_compiled_process = False
+        # Number of cores MadGraph may use; None leaves it to gridpack_generation.sh
+        self.n_cores = None
         self.mg_model_dir = svj.genprod.MG_MODEL_DIR
         self.mg_input_dir = svj.genprod.MG_INPUT_DIR
         self.mg_genprod_dir = svj.genprod.MG_GENPROD_DIR
@@ -110,7 +125,54 @@ class GridpackGenerator(object):
         """
         self.setup_model_dir()
         self.setup_input_dir()
-        self.compile_gridpack()
+        if not self.use_gridpack_cache:
+            self._compile()
+            return
+        cache = svj.genprod.GridpackCache()
+        key = self.get_gridpack_cache_key(cache)
+        if cache.has(key):
+            logger.info('Found gridpack for {0} in cache (key {1})'.format(self.model_name, key))
+            self.restore_from_gridpack_cache(cache, key)
+        else:
+            logger.info('No gridpack for {0} in cache (key {1}); compiling'.format(self.model_name, key))
+            self._compile()
+            cache.store(
+                key,
+                self._get_output_files_and_dirs(),
+                metadata = { 'model_name' : self.model_name, 'config' : dict(self.config) }
+                )
+
+    def _compile(self):
+        if self.reuse_compiled_process:
+            logger.warning(
+                'Reusing compiled MadGraph processes is not validated on real gridpacks yet; '
+                'check the produced tarball'
+                )
+            self.compile_gridpack_reusing_process()
+        else:
+            self.compile_gridpack()
+
+    def get_gridpack_cache_key(self, cache):
+        """
+        Returns the cache key for this gridpack. Requires the model and input
+        directories to be filled in.
+        """
+        return cache.get_key(
+            self.config,
+            lhaIDs[self.year],
+            self.new_model_dir,
+            self.new_input_dir,
+            genprod_dir = self.mg_genprod_dir
+            )
+
+    def restore_from_gridpack_cache(self, cache, key):
+        """
+        Puts the cached tarball and log in the CMSSW genproductions directory, so that
+        they are in the same place as after `compile_gridpack`
+        """
+        for dst in cache.fetch(key, self.mg_genprod_dir):
+            if dst.endswith('.log'):
+                self.logfile = osp.abspath(dst)
 
     def setup_model_dir(self):
         self.create_model_dir()
@@ -231,14 +293,20 @@ class GridpackGenerator(object):
             for var in to_unset:
                 if var in env: del env[var]
 
-            cmd = [
-                    'source /cvmfs/cms.cern.ch/cmsset_default.sh',
+            cmd = [ 'source /cvmfs/cms.cern.ch/cmsset_default.sh' ]
+            if not(self.n_cores is None):
+                logger.info('Limiting gridpack generation to {0} cores'.format(self.n_cores))
+                cmd.extend([
+                    'export NB_CORE={0}'.format(self.n_cores),
+                    'export OMP_NUM_THREADS={0}'.format(self.n_cores),
+                    ])
+            cmd.append(
                     ['bash',
                         'gridpack_generation.sh',
                         self.model_name,
                         input_cards_dir_relative,
-                        ],
-                    ]
+                        ]
+                    )
             try:
                 svj.core.utils.run_multiple_commands(cmd, env=svj.core.utils.get_clean_env())
                 if self.cleanup_gp_generation_dir:
@@ -257,6 +325,117 @@ class GridpackGenerator(object):
                     logger.warning('File {0} does not exist'.format(self.logfile))
                 raise
 
+    def compile_gridpack_reusing_process(self):
+        """
+        Like `compile_gridpack`, but reuses a compiled MadGraph process if one exists
+        for the same templates and year.
+
+        If there is none yet, the gridpack is generated as usual, but inside a
+        genproductions working copy in the `CompiledProcessCache` and without
+        cleaning up, so that the compiled process stays available.
+        Otherwise `integrate_in_compiled_process` is called.
+
+        Points that share a compiled process run one at a time (the process
+        directory is locked), since MadGraph writes into it.
+        """
+        cache = svj.genprod.CompiledProcessCache()
+        key = cache.get_key(
+            self.template_model_dir, self.template_input_dir,
+            self.year, lhaIDs[self.year], self.n_events,
+            genprod_dir = self.mg_genprod_dir
+            )
+        with svj.genprod.utils.file_lock(cache.get_lock_file(key)):
+            if cache.has(key):
+                logger.info('Reusing compiled process {0} for {1}'.format(key, self.model_name))
+                self.integrate_in_compiled_process(cache.read_manifest(key))
+            else:
+                logger.info('No compiled process {0} yet; compiling with {1}'.format(key, self.model_name))
+                self.compile_process_for_reuse(cache, key)
+
+    def compile_process_for_reuse(self, cache, key):
+        """
+        Runs `compile_gridpack` in a working copy inside the cache entry for `key`,
+        keeps the gridpack generation directory, and copies the tarball and log
+        to the regular genproductions directory.
+        """
+        mg_genprod_dir = self.mg_genprod_dir
+        cleanup_gp_generation_dir = self.cleanup_gp_generation_dir
+        self.mg_genprod_dir = cache.create_entry(key, mg_genprod_dir, model_names=[ self.model_name ])
+        self.cleanup_gp_generation_dir = False
+        try:
+            self.compile_gridpack()
+            outputs = [ f for f in self._get_output_files_and_dirs() if osp.isfile(f) ]
+        finally:
+            self.mg_genprod_dir = mg_genprod_dir
+            self.cleanup_gp_generation_dir = cleanup_gp_generation_dir
+        tarballs = [ f for f in outputs if f.endswith('_tarball.tar.xz') ]
+        if len(tarballs) != 1:
+            raise RuntimeError(
+                'Expected exactly one tarball after gridpack generation, found {0}'
+                .format(tarballs)
+                )
+        for src in outputs:
+            dst = osp.join(self.mg_genprod_dir, osp.basename(src))
+            logger.info('Moving {0} ==> {1}'.format(src, dst))
+            shutil.move(src, dst)
+            if dst.endswith('.log'): self.logfile = osp.abspath(dst)
+        cache.register(key, self.model_name, tarballs[0])
+
+    def integrate_in_compiled_process(self, manifest):
+        """
+        Produces the tarball for this mass point from a previously compiled process:
+        the param card in the compiled process is replaced, survey/refine are rerun to
+        make a new MadGraph gridpack, and the CMSSW tarball is repacked with the new
+        `process` and `InputCards` directories, reusing `mgbasedir` and
+        `runcmsgrid.sh` of the seed gridpack.
+        """
+        process_dir = manifest['process_dir']
+        work_dir = manifest['work_dir']
+        param_card = osp.join(self.new_model_dir, 'param_card.dat')
+        tarball = osp.join(
+            self.mg_genprod_dir,
+            manifest['seed_tarball'].replace(manifest['seed_model_name'], self.model_name, 1)
+            )
+        self.logfile = osp.join(self.mg_genprod_dir, self.model_name + '.log')
+        # Use the edited me5_configuration.txt from the seed gridpack
+        me5_configuration = 'process/madevent/Cards/me5_configuration.txt'
+
+        cmd = [ 'source /cvmfs/cms.cern.ch/cmsset_default.sh', 'set -o pipefail' ]
+        if manifest['cmssw_src']:
+            cmd.extend([
+                'cd {0}'.format(manifest['cmssw_src']),
+                'eval `scramv1 runtime -sh`',
+                ])
+        cmd.extend([
+            'cd {0}'.format(process_dir),
+            'rm -rf Events/pilotrun* pilotrun_gridpack.tar.gz',
+            'cp {0} Cards/param_card.dat'.format(param_card),
+            'echo "done" > makegrid.dat',
+            'echo "set gridpack True" >> makegrid.dat',
+            'cat makegrid.dat | ./bin/generate_events pilotrun{0} 2>&1 | tee {1}'.format(
+                '' if self.n_cores is None else ' --nb_core={0}'.format(self.n_cores),
+                self.logfile
+                ),
+            'cd {0}'.format(work_dir),
+            'rm -rf process_svj InputCards_svj',
+            'mkdir process_svj InputCards_svj',
+            'tar -xzf {0}/pilotrun_gridpack.tar.gz -C process_svj'.format(process_dir),
+            'cp {0} process_svj/{1}'.format(me5_configuration, me5_configuration.replace('process/', '', 1)),
+            'cp {0}/*.dat InputCards_svj/'.format(self.new_input_dir),
+            (
+                'XZ_OPT="--lzma2=preset=9,dict=512MiB" tar -cJpsf {0}'
+                ' --transform "s,^process_svj,process,;s,^InputCards_svj,InputCards,"'
+                ' mgbasedir process_svj runcmsgrid.sh gridpack_generation*.log InputCards_svj'
+                .format(tarball)
+                ),
+            'rm -rf process_svj InputCards_svj',
+            ])
+        logger.info(
+            'Integrating {0} in compiled process {1}'
+            .format(self.model_name, process_dir)
+            )
+        svj.core.utils.run_multiple_commands(cmd, env=svj.core.utils.get_clean_env())
+
     def get_mg_crosssection(self):
         return svj.genprod.utils.get_mg_crosssection_from_logfile(self.logfile)
 
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os, shutil, glob, logging, multiprocessing, traceback
+import os.path as osp
+
+import svj.core
+import svj.genprod
+
+logger = logging.getLogger('root')
+
+
+def create_genprod_working_copy(genprod_dir, dst, model_names=()):
+    """
+    Creates a lightweight copy of the CMSSW genproductions MadGraph directory:
+    every top-level entry is symlinked, except logs, tarballs and the outputs of
+    previous gridpack runs of model_names (which start with the model name).
+    `gridpack_generation.sh` writes its work directory and log in the cwd, so
+    each working copy can run a gridpack generation without colliding with others.
+    """
+    svj.core.utils.create_directory(dst, force=True)
+    model_names = tuple(model_names)
+    for src in glob.glob(osp.join(genprod_dir, '*')):
+        basename = osp.basename(src)
+        if basename.endswith(('.log', '.tar.xz')) or (model_names and basename.startswith(model_names)):
+            continue
+        os.symlink(osp.abspath(src), osp.join(dst, basename))
+    logger.info('Created genproductions working copy {0}'.format(dst))
+    return dst
+
+
+def _run_gridpack_generation_isolated(job):
+    """
+    Worker for GridpackScan; runs in a separate process. Returns a dict with the
+    model_name, the log file and an error message (None if successful), so that one
+    failing mass point does not stop the other ones.
+    """
+    config = svj.genprod.Config(job['config'])
+    result = { 'model_name' : None, 'logfile' : None, 'error' : None }
+    try:
+        gridpack_generator = svj.genprod.GridpackGenerator(config)
+        result['model_name'] = gridpack_generator.model_name
+        gridpack_generator.mg_genprod_dir = create_genprod_working_copy(
+            job['genprod_dir'],
+            osp.join(job['scan_dir'], gridpack_generator.model_name),
+            model_names=job['model_names']
+            )
+        gridpack_generator.n_cores = job['cores_per_job']
+        gridpack_generator.run_gridpack_generation()
+        output_dir = None if job['output_dir'] is None else osp.join(job['output_dir'], gridpack_generator.model_name)
+        gridpack_generator.move_to_output(output_dir=output_dir)
+        result['logfile'] = gridpack_generator.logfile
+        shutil.rmtree(gridpack_generator.mg_genprod_dir)
+    except Exception:
+        result['error'] = traceback.format_exc()
+        logger.error(
+            'Gridpack generation failed for {0}:\n{1}'
+            .format(result['model_name'], result['error'])
+            )
+    return result
+
+
+#____________________________________________________________________
+class GridpackScan(object):
+    """
+    Generates gridpacks for a list of configs concurrently on a process pool.
+
+    Every job gets its own working copy of the genproductions directory (see
+    `create_genprod_working_copy`) and at most `cores_per_job` cores.
+    By default as many jobs run in parallel as fit in the available cores.
+    Every worker process handles only one config, since the model's
+    `write_param_card` module is imported by GridpackGenerator.
+    """
+
+    def __init__(self, configs, cores_per_job=1, n_workers=None, output_dir=None):
+        super(GridpackScan, self).__init__()
+        self.configs = [ svj.genprod.Config.flexible_init(config) for config in configs ]
+        for config in self.configs: config.basic_checks()
+        self.cores_per_job = cores_per_job
+        if n_workers is None:
+            n_workers = max(1, multiprocessing.cpu_count() // self.cores_per_job)
+        self.n_workers = max(1, min(n_workers, len(self.configs)))
+        self.output_dir = output_dir
+        self.genprod_dir = svj.genprod.MG_GENPROD_DIR
+        self.scan_dir = osp.join(svj.genprod.RUN_GRIDPACK_DIR, 'scan')
+
+    def get_jobs(self):
+        model_names = [ config.get_model_name() for config in self.configs ]
+        return [
+            {
+                'config' : dict(config),
+                'genprod_dir' : self.genprod_dir,
+                'scan_dir' : self.scan_dir,
+                'cores_per_job' : self.cores_per_job,
+                'output_dir' : self.output_dir,
+                'model_names' : model_names,
+                }
+            for config in self.configs
+            ]
+
+    def run(self):
+        """
+        Runs all gridpack generations and returns the list of results (see
+        `_run_gridpack_generation_isolated`)
+        """
+        if self.genprod_dir is None:
+            raise RuntimeError(
+                '$MG_GENPROD_DIR not set; cannot generate gridpacks'
+                )
+        svj.core.utils.create_directory(self.scan_dir)
+        jobs = self.get_jobs()
+        logger.info(
+            'Generating {0} gridpacks with {1} workers, {2} cores per job'
+            .format(len(jobs), self.n_workers, self.cores_per_job)
+            )
+        pool = multiprocessing.Pool(self.n_workers, maxtasksperchild=1)
+        try:
+            results = []
+            for result in pool.imap_unordered(_run_gridpack_generation_isolated, jobs):
+                logger.info(
+                    '{0} finished ({1}/{2}){3}'
+                    .format(
+                        result['model_name'], len(results)+1, len(jobs),
+                        '' if result['error'] is None else ' with errors'
+                        )
+                    )
+                results.append(result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        failed = [ r['model_name'] for r in results if not(r['error'] is None) ]
+        if failed:
+            logger.error('Gridpack generation failed for: {0}'.format(', '.join(map(str, failed))))
+        return results
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Converts .lhe files to columnar numpy arrays for quick validation of the
+generated kinematics, without ROOT or CMSSW
+"""
+from __future__ import print_function
+
+import os, glob, logging, multiprocessing
+import os.path as osp
+
+import svj.core
+import svj.genprod
+
+logger = logging.getLogger('root')
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        logger.error(
+            'numpy is not installed; install it with '
+            '\'pip install numpy\' to use the columnar LHE tools.'
+            )
+        raise
+    return numpy
+
+
+# Columns of the particle lines and the event header lines, in LHE order
+PARTICLE_FIELDS = [
+    ('pid', 'i4'), ('status', 'i2'), ('mother1', 'i4'), ('mother2', 'i4'),
+    ('color1', 'i4'), ('color2', 'i4'),
+    ('px', 'f8'), ('py', 'f8'), ('pz', 'f8'), ('e', 'f8'), ('m', 'f8'),
+    ('lifetime', 'f4'), ('spin', 'f4'),
+    ]
+EVENT_FIELDS = [
+    ('n_particles', 'i4'), ('process_id', 'i4'), ('weight', 'f8'),
+    ('scale', 'f8'), ('aqed', 'f8'), ('aqcd', 'f8'),
+    ]
+
+MEDIATOR_PID = 5000001
+DARK_QUARK_PID = 4900101
+# Quarks and gluons
+PARTON_PIDS = [ 1, 2, 3, 4, 5, 6, 21 ]
+
+
+def parse_event_chunk(chunk):
+    """
+    Parses a chunk of complete <event> blocks (see `lhetools.iter_event_chunks`).
+    Returns (event_values, particle_values): 2D float arrays with one row per event
+    header line and one row per particle line respectively.
+    Lines after the particle lines (<mgrwt>, <rwgt>, comments) are skipped.
+    """
+    np = _import_numpy()
+    lines = chunk.split(b'\n')
+    starts = [ i for i, line in enumerate(lines) if line.lstrip().startswith(b'<event') ]
+    n_event_fields = len(EVENT_FIELDS)
+    event_values = np.fromstring(b' '.join(lines[i+1] for i in starts), sep=' ')
+    if event_values.size != n_event_fields * len(starts):
+        raise ValueError('Could not parse the event header lines')
+    event_values = event_values.reshape(-1, n_event_fields)
+    particle_lines = []
+    for i, n in zip(starts, event_values[:,0].astype(int)):
+        particle_lines.extend(lines[i+2:i+2+n])
+    n_particle_fields = len(PARTICLE_FIELDS)
+    particle_values = np.fromstring(b' '.join(particle_lines), sep=' ')
+    if particle_values.size != n_particle_fields * len(particle_lines):
+        raise ValueError('Could not parse the particle lines')
+    return event_values, particle_values.reshape(-1, n_particle_fields)
+
+
+def _to_structured(values, fields):
+    np = _import_numpy()
+    out = np.empty(values.shape[0], dtype=fields)
+    for i, (name, dtype) in enumerate(fields):
+        out[name] = values[:,i]
+    return out
+
+
+#____________________________________________________________________
+class LHEColumns(object):
+    """
+    Jagged columnar representation of the events in an .lhe file: `particles` has
+    one row per particle, `events` one row per event, and the particles of event i
+    are rows offsets[i] up to offsets[i+1].
+
+    `particles` and `events` are numpy structured arrays after `from_lhe`, or dicts of
+    (memory-mapped) column arrays after `load`; columns are accessed as
+    particles['pid'] in both cases.
+    """
+
+    def __init__(self, particles, events, offsets, lhe_file=None):
+        super(LHEColumns, self).__init__()
+        self.particles = particles
+        self.events = events
+        self.offsets = offsets
+        self.lhe_file = lhe_file
+
+    @classmethod
+    def from_lhe(cls, lhe_file, chunk_size=None, n_workers=1):
+        """
+        Parses lhe_file (which may be compressed) in a streaming pass. Parsing the
+        numbers dominates, so with n_workers > 1 the chunks are parsed on a process pool.
+        """
+        np = _import_numpy()
+        logger.info('Converting {0} to columns'.format(lhe_file))
+        event_chunks = []
+        particle_chunks = []
+        pool = multiprocessing.Pool(n_workers) if n_workers > 1 else None
+        try:
+            with svj.genprod.lhetools.open_lhe(lhe_file, 'rb') as f:
+                svj.genprod.lhetools.read_header_and_init(f)
+                chunks = svj.genprod.lhetools.iter_event_chunks(f, chunk_size)
+                results = (
+                    (parse_event_chunk(chunk) for chunk in chunks) if pool is None
+                    else pool.imap(parse_event_chunk, chunks)
+                    )
+                for event_values, particle_values in results:
+                    event_chunks.append(_to_structured(event_values, EVENT_FIELDS))
+                    particle_chunks.append(_to_structured(particle_values, PARTICLE_FIELDS))
+        finally:
+            if not(pool is None):
+                pool.terminate()
+                pool.join()
+        events = np.concatenate(event_chunks) if event_chunks else np.empty(0, dtype=EVENT_FIELDS)
+        particles = np.concatenate(particle_chunks) if particle_chunks else np.empty(0, dtype=PARTICLE_FIELDS)
+        offsets = np.zeros(len(events)+1, dtype='i8')
+        np.cumsum(events['n_particles'], out=offsets[1:])
+        logger.info('Converted {0} events, {1} particles'.format(len(events), len(particles)))
+        return cls(particles, events, offsets, lhe_file)
+
+    def _get_columns(self):
+        columns = { 'offsets' : self.offsets }
+        for name, dtype in PARTICLE_FIELDS: columns['particles.' + name] = self.particles[name]
+        for name, dtype in EVENT_FIELDS: columns['events.' + name] = self.events[name]
+        return columns
+
+    def save(self, dst):
+        """
+        Saves to a single .npz file if dst ends with .npz, and otherwise to one
+        .npy file per column in the directory dst, which `load` can memory-map
+        """
+        np = _import_numpy()
+        columns = self._get_columns()
+        if dst.endswith('.npz'):
+            svj.core.utils.create_directory(osp.dirname(osp.abspath(dst)))
+            np.savez(dst, **columns)
+        else:
+            svj.core.utils.create_directory(dst)
+            for name, column in columns.items():
+                np.save(osp.join(dst, name + '.npy'), np.ascontiguousarray(column))
+        logger.info('Saved columns to {0}'.format(dst))
+
+    @classmethod
+    def load(cls, src, mmap=True):
+        """
+        Loads columns saved by `save`; columns in a directory are memory-mapped
+        unless mmap is False
+        """
+        np = _import_numpy()
+        if src.endswith('.npz'):
+            npz = np.load(src)
+            columns = dict((name, npz[name]) for name in npz.files)
+        else:
+            columns = dict(
+                (osp.basename(path)[:-len('.npy')], np.load(path, mmap_mode='r' if mmap else None))
+                for path in glob.glob(osp.join(src, '*.npy'))
+                )
+        particles = dict(
+            (name.split('.',1)[1], column) for name, column in columns.items()
+            if name.startswith('particles.')
+            )
+        events = dict(
+            (name.split('.',1)[1], column) for name, column in columns.items()
+            if name.startswith('events.')
+            )
+        return cls(particles, events, columns['offsets'])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_event(self, i):
+        """
+        Returns a dict of the particle columns of event i
+        """
+        start, stop = self.offsets[i], self.offsets[i+1]
+        return dict((name, self.particles[name][start:stop]) for name, dtype in PARTICLE_FIELDS)
+
+    def event_index(self):
+        """
+        Returns the event number of every particle
+        """
+        np = _import_numpy()
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def pt(self):
+        np = _import_numpy()
+        return np.hypot(self.particles['px'], self.particles['py'])
+
+    def _sum_per_event(self, values):
+        np = _import_numpy()
+        if len(self) == 0: return np.zeros(0, dtype=values.dtype)
+        # Every event has at least one particle, so all segments are non-empty
+        return np.add.reduceat(values, self.offsets[:-1])
+
+    def _max_per_event(self, values):
+        np = _import_numpy()
+        if len(self) == 0: return np.zeros(0, dtype=values.dtype)
+        return np.maximum.reduceat(values, self.offsets[:-1])
+
+    def mediator_mass(self, mediator_pid=MEDIATOR_PID):
+        """
+        Returns the masses of all mediators (one per event for s-channel)
+        """
+        np = _import_numpy()
+        return np.asarray(self.particles['m'])[np.abs(self.particles['pid']) == mediator_pid]
+
+    def multiplicity(self, pids, status=1):
+        """
+        Returns the number of particles per event with |pid| in pids and the given status
+        """
+        np = _import_numpy()
+        mask = np.in1d(np.abs(self.particles['pid']), pids)
+        if not(status is None): mask &= (self.particles['status'] == status)
+        return self._sum_per_event(mask.astype('i4'))
+
+    def dark_quark_multiplicity(self, dark_quark_pids=(DARK_QUARK_PID,)):
+        return self.multiplicity(dark_quark_pids)
+
+    def leading_pt(self, pids=None, status=1):
+        """
+        Returns the highest pT per event of outgoing particles with |pid| in pids
+        (default: quarks, gluons and dark quarks); 0 if an event has none
+        """
+        np = _import_numpy()
+        if pids is None: pids = PARTON_PIDS + [ DARK_QUARK_PID ]
+        mask = np.in1d(np.abs(self.particles['pid']), pids)
+        if not(status is None): mask &= (self.particles['status'] == status)
+        return self._max_per_event(np.where(mask, self.pt(), 0.))
+
+    def summary(self, mediator_pid=MEDIATOR_PID, dark_quark_pids=(DARK_QUARK_PID,)):
+        """
+        Returns a dict of summary statistics of the kinematics
+        """
+        np = _import_numpy()
+        def describe(values):
+            values = np.asarray(values, dtype='f8')
+            if values.size == 0: return None
+            q = np.percentile(values, [ 16., 50., 84. ])
+            return {
+                'mean' : float(values.mean()),
+                'std' : float(values.std()),
+                'min' : float(values.min()),
+                'max' : float(values.max()),
+                'q16' : float(q[0]), 'median' : float(q[1]), 'q84' : float(q[2]),
+                }
+        weights = np.asarray(self.events['weight'])
+        summary = {
+            'n_events' : len(self),
+            'n_particles' : int(self.offsets[-1]) if len(self.offsets) else 0,
+            'sum_of_weights' : float(weights.sum()),
+            'mediator_mass' : describe(self.mediator_mass(mediator_pid)),
+            'dark_quark_multiplicity' : describe(self.dark_quark_multiplicity(dark_quark_pids)),
+            'leading_parton_pt' : describe(self.leading_pt()),
+            }
+        return summary
+
+
+def convert_lhe(lhe_file, dst=None, chunk_size=None, n_workers=1):
+    """
+    Converts lhe_file to columns saved in dst (default: a directory of .npy
+    columns next to the .lhe file) and returns the LHEColumns
+    """
+    if dst is None:
+        dst = osp.splitext(svj.genprod.lhetools.strip_compression_extension(lhe_file))[0] + '_columns'
+    columns = LHEColumns.from_lhe(lhe_file, chunk_size, n_workers)
+    columns.save(dst)
+    return columns
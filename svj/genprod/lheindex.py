@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os, re, json, logging, mmap
+import os.path as osp
+import array as array_module
+from array import array
+
+import svj.core
+import svj.genprod
+
+logger = logging.getLogger('root')
+
+# 8-byte signed integers, so offsets past 2 GB fit; python 2 has no 'q', but 'l'
+# is 8 bytes on 64-bit linux
+OFFSET_TYPECODE = 'q' if 'q' in getattr(array_module, 'typecodes', '') else 'l'
+
+INDEX_MAGIC = 'svj-lhe-index'
+INDEX_VERSION = 1
+
+
+#____________________________________________________________________
+class LHEIndex(object):
+    """
+    Byte-offset index of an .lhe file: the offset and length of the <init> block and
+    of every <event> block, stored in compact arrays.
+
+    The index is built in one pass over the file and saved in a sidecar file
+    (default: `<lhe_file>.idx`): one line of json metadata followed by the raw
+    start and end offset arrays. On top of it, events can be read by number in O(1),
+    and contiguous event ranges can be written out as valid .lhe files (`write_subset`,
+    `shard`) by copying byte ranges, without parsing any event.
+    """
+
+    def __init__(self, lhe_file, init_offset, init_length, starts, ends, index_file=None):
+        super(LHEIndex, self).__init__()
+        self.lhe_file = lhe_file
+        self.index_file = self.default_index_file(lhe_file) if index_file is None else index_file
+        self.init_offset = init_offset
+        self.init_length = init_length
+        self.starts = starts
+        self.ends = ends
+
+    @staticmethod
+    def default_index_file(lhe_file):
+        return lhe_file + '.idx'
+
+    @classmethod
+    def for_file(cls, lhe_file, index_file=None):
+        """
+        Loads the index of lhe_file if it exists and is up to date, and builds it otherwise
+        """
+        if index_file is None: index_file = cls.default_index_file(lhe_file)
+        if osp.isfile(index_file):
+            try:
+                return cls.load(lhe_file, index_file)
+            except ValueError as e:
+                logger.warning('Rebuilding index: {0}'.format(e))
+        return cls.build(lhe_file, index_file)
+
+    @classmethod
+    def build(cls, lhe_file, index_file=None, save=True):
+        """
+        Scans lhe_file once and returns its index, which is saved unless save=False
+        """
+        logger.info('Building event index of {0}'.format(lhe_file))
+        svj.genprod.lhetools.check_uncompressed(lhe_file)
+        starts = array(OFFSET_TYPECODE)
+        ends = array(OFFSET_TYPECODE)
+        with open(lhe_file, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                match = re.compile(br'(^|\n)<init[\s>]').search(mm)
+                if not match:
+                    raise ValueError('No <init> block found in {0}'.format(lhe_file))
+                init_offset = match.start() if match.group(1) == b'' else match.start() + 1
+                init_end = mm.find(b'</init>', init_offset)
+                if init_end < 0:
+                    raise ValueError('No </init> found in {0}'.format(lhe_file))
+                init_end = cls._end_of_line(mm, init_end)
+                pos = init_end - 1
+                while True:
+                    start = mm.find(b'\n<event', pos)
+                    if start < 0: break
+                    start += 1
+                    end = mm.find(b'</event>', start)
+                    if end < 0:
+                        raise ValueError(
+                            'Incomplete event at byte {0} in {1}'.format(start, lhe_file)
+                            )
+                    end = cls._end_of_line(mm, end)
+                    starts.append(start)
+                    ends.append(end)
+                    pos = end - 1
+            finally:
+                mm.close()
+        inst = cls(lhe_file, init_offset, init_end - init_offset, starts, ends, index_file)
+        logger.info('Indexed {0} events'.format(len(inst)))
+        if save: inst.save()
+        return inst
+
+    @staticmethod
+    def _end_of_line(mm, pos):
+        """
+        Returns the offset just after the newline that ends the line containing pos
+        """
+        eol = mm.find(b'\n', pos)
+        return len(mm) if eol < 0 else eol + 1
+
+    def _get_file_signature(self):
+        stat = os.stat(self.lhe_file)
+        return stat.st_size, int(stat.st_mtime)
+
+    def save(self):
+        size, mtime = self._get_file_signature()
+        metadata = {
+            'magic' : INDEX_MAGIC,
+            'version' : INDEX_VERSION,
+            'lhe_size' : size,
+            'lhe_mtime' : mtime,
+            'n_events' : len(self),
+            'init_offset' : self.init_offset,
+            'init_length' : self.init_length,
+            'itemsize' : self.starts.itemsize,
+            }
+        tmp = self.index_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(metadata, sort_keys=True).encode('ascii') + b'\n')
+            self.starts.tofile(f)
+            self.ends.tofile(f)
+        os.rename(tmp, self.index_file)
+        logger.info('Saved event index to {0}'.format(self.index_file))
+
+    @classmethod
+    def read_metadata(cls, lhe_file, index_file=None):
+        """
+        Returns the json metadata of the saved index (n_events, init_offset, ...) without
+        reading the offset arrays, or None if there is no up to date index for lhe_file
+        """
+        if index_file is None: index_file = cls.default_index_file(lhe_file)
+        if not osp.isfile(index_file): return None
+        with open(index_file, 'rb') as f:
+            try:
+                metadata = json.loads(f.readline().decode('ascii'))
+            except ValueError:
+                return None
+        if metadata.get('magic') != INDEX_MAGIC or metadata.get('version') != INDEX_VERSION:
+            return None
+        stat = os.stat(lhe_file)
+        if (stat.st_size, int(stat.st_mtime)) != (metadata['lhe_size'], metadata['lhe_mtime']):
+            return None
+        return metadata
+
+    @classmethod
+    def load(cls, lhe_file, index_file=None):
+        """
+        Loads a saved index; raises ValueError if it does not match lhe_file anymore
+        """
+        if index_file is None: index_file = cls.default_index_file(lhe_file)
+        with open(index_file, 'rb') as f:
+            metadata = json.loads(f.readline().decode('ascii'))
+            if metadata.get('magic') != INDEX_MAGIC or metadata.get('version') != INDEX_VERSION:
+                raise ValueError('{0} is not a valid index file'.format(index_file))
+            starts = array(OFFSET_TYPECODE)
+            ends = array(OFFSET_TYPECODE)
+            if metadata['itemsize'] != starts.itemsize:
+                raise ValueError('{0} was written with a different integer size'.format(index_file))
+            starts.fromfile(f, metadata['n_events'])
+            ends.fromfile(f, metadata['n_events'])
+        inst = cls(lhe_file, metadata['init_offset'], metadata['init_length'], starts, ends, index_file)
+        if inst._get_file_signature() != (metadata['lhe_size'], metadata['lhe_mtime']):
+            raise ValueError('{0} is out of date for {1}'.format(index_file, lhe_file))
+        return inst
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _read(self, offset, length):
+        with open(self.lhe_file, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def get_header(self):
+        """
+        Returns everything up to and including the <init> block
+        """
+        return self._read(0, self.init_offset + self.init_length)
+
+    def get_init(self):
+        return self._read(self.init_offset, self.init_length)
+
+    def _normalize_range(self, start, stop):
+        start, stop, step = slice(start, stop).indices(len(self))
+        return start, max(start, stop)
+
+    def get_event(self, i):
+        """
+        Returns the bytes of event i (negative numbers count from the end)
+        """
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Event {0} out of range; {1} events'.format(i, len(self)))
+        return self._read(self.starts[i], self.ends[i] - self.starts[i])
+
+    def get_events(self, start=None, stop=None):
+        """
+        Returns the bytes of events start up to (excluding) stop
+        """
+        start, stop = self._normalize_range(start, stop)
+        if start == stop: return b''
+        return self._read(self.starts[start], self.ends[stop-1] - self.starts[start])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if not key.step in [ None, 1 ]:
+                raise ValueError('Only contiguous slices are supported')
+            return self.get_events(key.start, key.stop)
+        return self.get_event(key)
+
+    def shard_ranges(self, n_shards):
+        """
+        Returns n_shards (start, stop) event ranges of (nearly) equal size
+        """
+        n_shards = max(1, min(n_shards, len(self)))
+        ranges = []
+        start = 0
+        for i in range(n_shards):
+            stop = start + len(self) // n_shards + (1 if i < len(self) % n_shards else 0)
+            ranges.append((start, stop))
+            start = stop
+        return ranges
+
+    def write_subset(self, dst, start=None, stop=None, blocksize=16*1024*1024):
+        """
+        Writes a valid .lhe file with the header and <init> block and the events start
+        up to (excluding) stop. The events are copied as one byte range, and the number
+        of events in the header is set to stop - start.
+        Returns the number of events written.
+        """
+        start, stop = self._normalize_range(start, stop)
+        header = svj.genprod.lhetools.set_n_events_in_header(self.get_header(), stop - start)
+        with open(self.lhe_file, 'rb') as f_in:
+            with open(dst, 'wb') as f_out:
+                f_out.write(header)
+                if stop > start:
+                    f_in.seek(self.starts[start])
+                    remaining = self.ends[stop-1] - self.starts[start]
+                    while remaining > 0:
+                        block = f_in.read(min(blocksize, remaining))
+                        if not block: break
+                        f_out.write(block)
+                        remaining -= len(block)
+                f_out.write(b'</LesHouchesEvents>\n')
+        return stop - start
+
+    def shard(self, n_shards, out_dir=None, basename=None):
+        """
+        Splits the file in n_shards valid .lhe files `<basename>_shard<i>.lhe` in out_dir
+        (default: next to the input file). Returns a list of (path, start, n_events).
+        """
+        if out_dir is None: out_dir = osp.dirname(osp.abspath(self.lhe_file))
+        if basename is None: basename = osp.basename(self.lhe_file).replace('.lhe', '')
+        svj.core.utils.create_directory(out_dir)
+        shards = []
+        for i, (start, stop) in enumerate(self.shard_ranges(n_shards)):
+            dst = osp.join(out_dir, '{0}_shard{1}.lhe'.format(basename, i))
+            self.write_subset(dst, start, stop)
+            shards.append((dst, start, stop - start))
+        logger.info('Wrote {0} shards of {1} to {2}'.format(len(shards), self.lhe_file, out_dir))
+        return shards
@@ -5,12 +5,21 @@ from __future__ import print_function
 import os, shutil, sys, glob, subprocess, re, logging
 import os.path as osp
 from time import strftime
+from multiprocessing.pool import ThreadPool
 
 import svj.core
 import svj.genprod
 
 logger = logging.getLogger('root')
 
+
+def split_evenly(n, n_chunks):
+    """
+    Splits the integer n in n_chunks integers that differ by at most 1
+    """
+    return [ n // n_chunks + (1 if i < n % n_chunks else 0) for i in range(n_chunks) ]
+
+
 #____________________________________________________________________
 class LHEMaker(object):
     """docstring for LHEMaker"""
@@ -32,8 +41,21 @@ class LHEMaker(object):
 
         self.run_gridpack_dir = svj.genprod.RUN_GRIDPACK_DIR
 
-        self.log_file = osp.join(osp.dirname(self.tarball), self.model_name + '.log')
+        # The MadGraph log is next to a local tarball; otherwise it is taken from the
+        # extracted gridpack (see `set_log_file_from_gridpack`)
+        self.log_file = (
+            None if self.tarball.startswith(svj.genprod.semanager.MGM_PREFIXES)
+            else osp.join(osp.dirname(self.tarball), self.model_name + '.log')
+            )
         self.force_renew_tarball = True
+        # Patch pids in place through an mmap instead of rewriting the .lhe file
+        self.replace_pids_inplace = False
+        # Number of concurrent runcmsgrid.sh processes; see run_lhe_generation_chunked
+        self.n_chunks = 1
+        # Share one extraction per tarball on the node; see ExtractedGridpackCache
+        self.use_extracted_gridpack_cache = False
+        # Compression of the output .lhe file: None, 'gz' or 'zst'
+        self.compression = None
 
     def get_process_type(self):
         match = re.match(r'\w+?_(\w)', osp.basename(self.tarball))
@@ -50,51 +72,79 @@ class LHEMaker(object):
         logger.info('Retrieved process_type {0} from {1}'.format(process_type, self.tarball))
         return process_type
 
-    def get_mg_cross_section(self):
+    def get_mg_cross_section(self, with_error=False):
         """Gets the madgraph cross section from the log file that was created when creating the gridpack"""
-        with open(self.log_file) as f:
-            match = re.search(r'(?<=Cross-section :   )(\d*.\d+)', f.read())
-            if not match:
-                raise ValueError(
-                    'Could not determine cross section from log_file {0}'.format(self.log_file)
-                    )
-        xs = match.group(1)
-        logger.info('Found cross section {0} from log_file'.format(xs))
-        return xs
+        if self.log_file is None:
+            raise RuntimeError(
+                'No MadGraph log for {0}; it is taken from the gridpack once it is extracted'
+                .format(self.tarball)
+                )
+        return svj.genprod.utils.get_mg_crosssection_from_logfile(self.log_file, with_error=with_error)
+
+    def set_log_file_from_gridpack(self, extracted_tarball):
+        """
+        If there is no MadGraph log next to the tarball (e.g. for a tarball on the SE),
+        copies the gridpack_generation log that genproductions packs in the tarball
+        to the run directory and uses that
+        """
+        if not(self.log_file is None) and osp.isfile(self.log_file): return
+        logs = sorted(glob.glob(osp.join(extracted_tarball, 'gridpack_generation*.log')))
+        if not logs:
+            logger.warning('No MadGraph log found next to {0} or in the gridpack'.format(self.tarball))
+            return
+        self.log_file = osp.join(self.run_gridpack_dir, self.model_name + '.log')
+        logger.info('Using MadGraph log {0} ==> {1}'.format(logs[0], self.log_file))
+        shutil.copyfile(logs[0], self.log_file)
+
+    def get_lhe_metadata(self):
+        """Reads the cross section, process ids and number of events from the output .lhe file"""
+        return svj.genprod.lhetools.read_lhe_metadata(self.out_lhe_file)
 
     def extract_and_run_tarball(self):
-        copied_tarball = osp.join(self.run_gridpack_dir, osp.basename(self.tarball))
-        extracted_tarball = copied_tarball.replace('.tar.xz', '')
-        self.copy_tarball(copied_tarball)
-        self.extract_tarball(copied_tarball, dst = extracted_tarball)
-        self.run_lhe_generation(extracted_tarball)
-
-    def copy_tarball(self, dst):
-        def copy():
-            logger.warning('Copying {0} ==> {1}'.format(self.tarball, dst))
-            shutil.copyfile(self.tarball, dst)
-        svj.core.utils.create_directory(osp.dirname(dst))
-        if osp.isfile(dst):
-            if self.force_renew_tarball:
-                logger.warning('Removing previously existing {0}'.format(dst))
-                os.remove(dst)
-                copy()
-            else:
-                logger.warning('Not copying tarball; {0} already exists'.format(dst))
+        if self.use_extracted_gridpack_cache:
+            self.run_from_extracted_gridpack_cache()
+            return
+        extracted_tarball = osp.join(
+            self.run_gridpack_dir,
+            osp.basename(self.tarball).replace('.tar.xz', '')
+            )
+        self.extract_tarball(self.tarball, dst = extracted_tarball)
+        self._run(extracted_tarball)
+
+    def run_from_extracted_gridpack_cache(self):
+        """
+        Runs in a working copy of the extraction in the `ExtractedGridpackCache`,
+        instead of copying and extracting the tarball for this job only
+        """
+        cache = svj.genprod.ExtractedGridpackCache()
+        workdir = osp.join(
+            self.run_gridpack_dir,
+            '{0}_seed{1}'.format(self.model_name, self.seed)
+            )
+        with cache.working_copy(self.tarball, workdir):
+            self._run(workdir)
+
+    def _run(self, extracted_tarball):
+        self.set_log_file_from_gridpack(extracted_tarball)
+        if self.n_chunks > 1:
+            self.run_lhe_generation_chunked(extracted_tarball)
         else:
-            copy()
-        return dst
+            self.run_lhe_generation(extracted_tarball)
 
     def extract_tarball(self, tarball, dst=None):
+        """
+        Extracts the tarball, which may be a local path or an SE url, straight from its
+        original location into dst (see `utils.extract_tarball`); the tarball is not
+        copied first.
+        """
         if not tarball.endswith('.tar.xz'):
             raise ValueError('Unexpected file extension for tarball {0}'.format(tarball))
-        if dst is None: dst = tarball.replace('.tar.xz', '')
+        if dst is None: dst = osp.join(self.run_gridpack_dir, osp.basename(tarball).replace('.tar.xz', ''))
 
         newly_created = svj.core.utils.create_directory(dst, force=self.force_renew_tarball)
         if newly_created:
             logger.warning('Extracting tarball')
-            cmd = [ 'tar', 'xf', tarball, '--directory', dst ]
-            svj.core.utils.run_command(cmd)
+            svj.genprod.utils.extract_tarball(tarball, dst)
             logger.info('Done extracting tarball')
 
         return dst
@@ -111,29 +161,82 @@ class LHEMaker(object):
         self.out_lhe_file = osp.join(extracted_tarball, 'cmsgrid_final.lhe')
         self.replace_pids(self.out_lhe_file)
 
+    def run_lhe_generation_chunked(self, extracted_tarball):
+        """
+        Splits n_events over `n_chunks` runcmsgrid.sh processes that run concurrently,
+        each in its own copy of the extracted tarball and with its own seed (see
+        `utils.derive_chunk_seeds`; the base seed must be below
+        MG_MAX_SEED / CHUNK_SEED_STRIDE), and merges the outputs into one
+        cmsgrid_final.lhe (see `lhetools.merge_lhe_files`).
+        """
+        if not osp.isfile(osp.join(extracted_tarball, 'runcmsgrid.sh')):
+            raise RuntimeError(
+                'File \'runcmsgrid.sh\' does not exist in {0}'
+                .format(extracted_tarball)
+                )
+        n_events_per_chunk = [ n for n in split_evenly(self.n_events, self.n_chunks) if n > 0 ]
+        seeds = svj.genprod.utils.derive_chunk_seeds(
+            self.seed, len(n_events_per_chunk), max_seed=svj.genprod.utils.MG_MAX_SEED
+            )
+        chunk_dirs = [ '{0}_chunk{1}'.format(extracted_tarball, i) for i in range(len(seeds)) ]
+
+        env = svj.core.utils.get_clean_env()
+        def run_chunk(args):
+            chunk_dir, n_events, seed = args
+            cmd = [
+                'bash', '-c',
+                'cd {0} && bash runcmsgrid.sh {1} {2} 1'.format(chunk_dir, n_events, seed)
+                ]
+            svj.core.utils.run_command(cmd, env=env)
+            return osp.join(chunk_dir, 'cmsgrid_final.lhe')
+
+        # The chunk directories are full copies of the gridpack, so they are removed
+        # also if a chunk or the merge fails
+        try:
+            for chunk_dir in chunk_dirs:
+                if osp.isdir(chunk_dir):
+                    logger.warning('Removing previously existing {0}'.format(chunk_dir))
+                    shutil.rmtree(chunk_dir)
+                svj.genprod.gridpackcache.make_working_copy(extracted_tarball, chunk_dir)
+            logger.info(
+                'Running {0} LHE chunks with n_events {1} and seeds {2}'
+                .format(len(seeds), n_events_per_chunk, seeds)
+                )
+            pool = ThreadPool(len(seeds))
+            try:
+                chunk_lhe_files = pool.map(run_chunk, zip(chunk_dirs, n_events_per_chunk, seeds))
+            finally:
+                pool.close()
+                pool.join()
+            self.out_lhe_file = osp.join(extracted_tarball, 'cmsgrid_final.lhe')
+            svj.genprod.lhetools.merge_lhe_files(chunk_lhe_files, self.out_lhe_file)
+        finally:
+            for chunk_dir in chunk_dirs:
+                if osp.isdir(chunk_dir):
+                    logger.info('Removing {0}'.format(chunk_dir))
+                    shutil.rmtree(chunk_dir)
+        self.replace_pids(self.out_lhe_file)
+
     def replace_pids(self, lhe_file):
-        logger.info('Going to replace pids. Opening {0} and reading contents'.format(lhe_file))
-        with open(lhe_file, 'r') as f:
-            contents = f.read()
-        def replace(contents, src, dst):
-            logger.info('Replacing "{0}" ==> "{1}"'.format(src, dst))
-            return contents.replace(src, dst)
-        if self.config['process_type'].startswith('s'):
-            contents = replace(contents, '5000521', '4900101')
-        elif self.config['process_type'].startswith('t'):
-            contents = replace(contents, '49001010', '4900101')
-            contents = replace(contents, '49001011', '4900101')
-            contents = replace(contents, '49001012', '4900101')
-            contents = replace(contents, '49001013', '4900101')
-            contents = replace(contents, '49001014', '4900101')
+        """
+        Replaces the MadGraph dark quark pids by the ones Pythia expects, in a single
+        streaming pass over the file (see `lhetools.replace_pids_streaming`), or in
+        place if `replace_pids_inplace` is True (see `lhetools.replace_pids_inplace`).
+        If `compression` is set, the output is compressed in the same pass and
+        `out_lhe_file` is updated to the compressed file.
+        """
+        replacements = svj.genprod.lhetools.get_pid_replacements(self.config['process_type'])
+        if self.compression:
+            if self.replace_pids_inplace:
+                logger.warning('Output is compressed; not replacing pids in place')
+            dst = lhe_file + svj.genprod.lhetools.COMPRESSION_EXTENSIONS[self.compression]
+            svj.genprod.lhetools.replace_pids_streaming(lhe_file, replacements, dst=dst)
+            os.remove(lhe_file)
+            self.out_lhe_file = dst
+        elif self.replace_pids_inplace:
+            svj.genprod.lhetools.replace_pids_inplace(lhe_file, replacements)
         else:
-            raise NotImplementedError(
-                'Process type \'{0}\' is not implemented, only s- and t-channel are.'
-                .format(self.config['process_type'])
-                )
-        logger.warning('Overwriting {0} with replacements'.format(lhe_file))
-        with open(lhe_file, 'w') as f:
-            f.write(contents)
+            svj.genprod.lhetools.replace_pids_streaming(lhe_file, replacements)
 
     def _get_dst(self, output_dir, dry):
         """
@@ -146,6 +249,8 @@ class LHEMaker(object):
             output_dir,
             'lhe_{0}_N{1}_seed{2}.lhe'.format(self.model_name, self.n_events, self.seed)
             )
+        if self.compression:
+            dst += svj.genprod.lhetools.COMPRESSION_EXTENSIONS[self.compression]
         return dst
 
     def copy_to_output(self, output_dir=None, dry=False):
@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tools to manipulate .lhe files without loading them in memory
+"""
+from __future__ import print_function
+
+import os, re, logging, tempfile, mmap, math, gzip, io, shutil
+import os.path as osp
+
+import svj.core
+import svj.genprod
+
+logger = logging.getLogger('root')
+
+# Approximate number of bytes processed at a time by the streaming functions
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def get_pid_replacements(process_type):
+    """
+    Returns a list of (src, dst) pid strings that should be replaced in the .lhe file
+    produced by MadGraph, so that Pythia recognizes the dark quarks
+    """
+    if process_type.startswith('s'):
+        return [ ('5000521', '4900101') ]
+    elif process_type.startswith('t'):
+        return [ ('4900101{0}'.format(i), '4900101') for i in range(5) ]
+    else:
+        raise NotImplementedError(
+            'Process type \'{0}\' is not implemented, only s- and t-channel are.'
+            .format(process_type)
+            )
+
+
+def compile_pid_pattern(replacements):
+    """
+    Compiles a single bytes regex matching any of the src pids as a whole token,
+    i.e. not as part of a longer number or a float
+    """
+    alternatives = b'|'.join(
+        re.escape(src.encode('ascii'))
+        for src, dst in sorted(replacements, key=lambda r: -len(r[0]))
+        )
+    return re.compile(br'(?<![\w.])(?:' + alternatives + br')(?![\w.])')
+
+
+# Supported compressions of .lhe files; the compression is inferred from the extension
+COMPRESSION_EXTENSIONS = { 'gz' : '.gz', 'zst' : '.zst' }
+COMPRESSION_MAGIC = { 'gz' : b'\x1f\x8b', 'zst' : b'\x28\xb5\x2f\xfd' }
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+
+def get_compression(path):
+    """
+    Returns 'gz', 'zst' or None. Existing files are identified by their magic bytes,
+    other paths by their extension.
+    """
+    if osp.isfile(path):
+        with open(path, 'rb') as f:
+            start = f.read(4)
+        for compression, magic in COMPRESSION_MAGIC.items():
+            if start.startswith(magic): return compression
+        return None
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if path.endswith(extension): return compression
+    return None
+
+
+def strip_compression_extension(path):
+    for extension in COMPRESSION_EXTENSIONS.values():
+        if path.endswith(extension): return path[:-len(extension)]
+    return path
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        logger.error(
+            'zstandard is not installed; install it with '
+            '\'pip install zstandard\', or use gzip compression.'
+            )
+        raise
+    return zstandard
+
+
+class CompressedFile(object):
+    """
+    File-like wrapper around a gzip or zstd (de)compressing stream on top of fileobj.
+    Closing it closes both the stream and fileobj.
+    """
+    def __init__(self, fileobj, compression, mode='rb'):
+        self.fileobj = fileobj
+        self.name = getattr(fileobj, 'name', None)
+        if compression == 'gz':
+            self.stream = gzip.GzipFile(
+                filename = '', mode = mode, fileobj = fileobj, compresslevel = GZIP_LEVEL
+                )
+        elif compression == 'zst':
+            zstandard = _import_zstandard()
+            if mode.startswith('r'):
+                self.stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fileobj))
+            else:
+                self.stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(fileobj)
+        else:
+            raise ValueError('Unknown compression {0}'.format(compression))
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            if not self.fileobj.closed: self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_lhe(path, mode='rb', compression=None):
+    """
+    Opens an .lhe file in binary mode, transparently (de)compressing gzip and zstd.
+    If compression is None it is inferred with `get_compression`.
+    """
+    if compression is None: compression = get_compression(path)
+    if compression is None: return open(path, mode)
+    return CompressedFile(open(path, mode), compression, mode)
+
+
+def check_uncompressed(lhe_file):
+    if not get_compression(lhe_file) is None:
+        raise ValueError(
+            '{0} is compressed; decompress it first (e.g. with lhetools.decompress_lhe)'
+            .format(lhe_file)
+            )
+
+
+def decompress_lhe(src, dst=None):
+    """
+    Decompresses src into dst (default: src without the compression extension)
+    """
+    if dst is None: dst = strip_compression_extension(src)
+    logger.info('Decompressing {0} ==> {1}'.format(src, dst))
+    out, tmp = atomic_output(dst, compression=False)
+    try:
+        with open_lhe(src, 'rb') as f_in:
+            with out:
+                for block in iter(lambda: f_in.read(CHUNK_SIZE), b''):
+                    out.write(block)
+        os.rename(tmp, dst)
+    except:
+        if osp.isfile(tmp): os.remove(tmp)
+        raise
+    return dst
+
+
+def atomic_output(dst, compression=None):
+    """
+    Returns a (file object, tmp path) pair of a temporary file in the same directory
+    as dst. Rename the tmp path to dst once writing is done.
+    The output is compressed according to the extension of dst, unless
+    compression=False is passed.
+    """
+    fd, tmp = tempfile.mkstemp(
+        prefix = '.' + osp.basename(dst) + '.',
+        suffix = '.tmp',
+        dir = osp.dirname(osp.abspath(dst))
+        )
+    # mkstemp creates files readable only by the user; apply the usual umask instead
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp, 0o666 & ~umask)
+    f = os.fdopen(fd, 'wb')
+    if compression is None:
+        # dst may be an existing file that is being overwritten, so go by its extension
+        compression = [ c for c, e in COMPRESSION_EXTENSIONS.items() if dst.endswith(e) ] + [None]
+        compression = compression[0]
+    if compression:
+        logger.info('Compressing output with {0}'.format(compression))
+        return CompressedFile(f, compression, 'wb'), tmp
+    return f, tmp
+
+
+def replace_pids_streaming(src, replacements, dst=None, chunk_size=None):
+    """
+    Replaces pids in a single pass over the .lhe file `src`, processing line-aligned
+    chunks of about `chunk_size` bytes, so memory use does not depend on the number
+    of events. The output is written to a temporary file that is renamed to `dst`
+    (default: `src`) when done. Returns the number of replacements made.
+    src may be compressed, and dst is compressed if it has a .gz or .zst extension,
+    so decompression and compression are fused with the replacement pass.
+    """
+    if dst is None: dst = src
+    if chunk_size is None: chunk_size = CHUNK_SIZE
+    pattern = compile_pid_pattern(replacements)
+    lookup = dict((s.encode('ascii'), d.encode('ascii')) for s, d in replacements)
+    n_replaced = [0]
+    def repl(match):
+        n_replaced[0] += 1
+        return lookup[match.group(0)]
+
+    logger.info(
+        'Replacing pids {0} in {1} ==> {2}'
+        .format(', '.join('{0}->{1}'.format(s, d) for s, d in replacements), src, dst)
+        )
+    out, tmp = atomic_output(dst)
+    try:
+        with open_lhe(src, 'rb') as f_in:
+            with out:
+                for lines in iter(lambda: f_in.readlines(chunk_size), []):
+                    out.write(pattern.sub(repl, b''.join(lines)))
+        os.rename(tmp, dst)
+    except:
+        if osp.isfile(tmp): os.remove(tmp)
+        raise
+    logger.info('Made {0} pid replacements'.format(n_replaced[0]))
+    return n_replaced[0]
+
+
+def replace_pids_inplace(lhe_file, replacements):
+    """
+    Patches pids directly in `lhe_file` through an mmap, without rewriting the file.
+    Replacements that are shorter than the pid they replace are right-padded with
+    spaces (e.g. '49001010' -> '4900101 '), which LHE readers ignore since all
+    fields are whitespace separated; padding on the right keeps a minus sign
+    attached to the pid. Returns the number of replacements made.
+    """
+    for src, dst in replacements:
+        if len(dst) > len(src):
+            raise ValueError(
+                'Cannot replace {0} by the longer {1} in place'
+                .format(src, dst)
+                )
+    pattern = compile_pid_pattern(replacements)
+    lookup = dict(
+        (s.encode('ascii'), d.ljust(len(s)).encode('ascii')) for s, d in replacements
+        )
+    logger.info(
+        'Replacing pids {0} in place in {1}'
+        .format(', '.join('{0}->{1}'.format(s, d) for s, d in replacements), lhe_file)
+        )
+    check_uncompressed(lhe_file)
+    n_replaced = 0
+    if osp.getsize(lhe_file) == 0:
+        logger.warning('{0} is empty; nothing to replace'.format(lhe_file))
+        return n_replaced
+    with open(lhe_file, 'r+b') as f:
+        mm = mmap.mmap(f.fileno(), 0)
+        try:
+            for match in pattern.finditer(mm):
+                mm[match.start():match.end()] = lookup[match.group(0)]
+                n_replaced += 1
+            mm.flush()
+        finally:
+            mm.close()
+    logger.info('Made {0} pid replacements'.format(n_replaced))
+    return n_replaced
+
+
+init_tag_pattern = re.compile(br'\s*<init[\s>]')
+
+def read_header_and_init(f):
+    """
+    Reads an .lhe file object (binary mode) up to and including the </init> line.
+    Returns a tuple (header_lines, init_lines), where header_lines is everything
+    before the <init> line and init_lines is the <init> block including its tags.
+    The file object is left positioned at the first line after </init>.
+    """
+    header_lines = []
+    init_lines = []
+    in_init = False
+    for line in iter(f.readline, b''):
+        # Careful not to match <initrwgt> in the header
+        if init_tag_pattern.match(line):
+            in_init = True
+        if in_init:
+            init_lines.append(line)
+            if line.lstrip().startswith(b'</init>'):
+                return header_lines, init_lines
+        else:
+            header_lines.append(line)
+    raise ValueError('No complete <init> block found in {0}'.format(f.name))
+
+
+def parse_init(init_lines):
+    """
+    Parses the <init> block. Returns a tuple (beam_tokens, processes, extra_lines),
+    where processes is a list of [xsecup, xerrup, xmaxup, lprup] and extra_lines
+    contains all lines after the process lines (e.g. <generator> tags and </init>).
+    """
+    body = init_lines[1:]
+    beam_tokens = body[0].split()
+    n_processes = abs(int(beam_tokens[-1]))
+    processes = []
+    for line in body[1:1+n_processes]:
+        xsecup, xerrup, xmaxup, lprup = line.split()[:4]
+        processes.append([ float(xsecup), float(xerrup), float(xmaxup), int(lprup) ])
+    extra_lines = body[1+n_processes:]
+    return beam_tokens, processes, extra_lines
+
+
+def format_init(init_line, beam_tokens, processes, extra_lines):
+    lines = [ init_line, b' '.join(beam_tokens) + b'\n' ]
+    for xsecup, xerrup, xmaxup, lprup in processes:
+        lines.append(
+            '{0:.6e} {1:.6e} {2:.6e} {3}\n'
+            .format(xsecup, xerrup, xmaxup, lprup).encode('ascii')
+            )
+    return lines + list(extra_lines)
+
+
+def iter_event_chunks(f, chunk_size=None):
+    """
+    Yields chunks of bytes from the current position of f (typically just after
+    </init>) up to, but not including, the </LesHouchesEvents> line.
+    Chunks are about chunk_size bytes and always end on an event boundary.
+    """
+    if chunk_size is None: chunk_size = CHUNK_SIZE
+    pending = []
+    for lines in iter(lambda: f.readlines(chunk_size), []):
+        # Drop the closing tag and blank lines at the end of the batch
+        end = len(lines)
+        while end > 0 and (
+                not lines[end-1].strip()
+                or lines[end-1].lstrip().startswith(b'</LesHouchesEvents')
+                ):
+            end -= 1
+        pending.extend(lines[:end])
+        for i in range(len(pending)-1, -1, -1):
+            if pending[i].lstrip().startswith(b'</event'):
+                yield b''.join(pending[:i+1])
+                pending = pending[i+1:]
+                break
+    if pending: yield b''.join(pending)
+
+
+def iter_events(f, chunk_size=None):
+    """
+    Yields the bytes of every event block from the current position of f
+    (typically just after </init>)
+    """
+    for chunk in iter_event_chunks(f, chunk_size):
+        pos = 0
+        while True:
+            end = chunk.find(b'</event>', pos)
+            if end < 0: break
+            end = chunk.find(b'\n', end)
+            end = len(chunk) if end < 0 else end + 1
+            yield chunk[pos:end]
+            pos = end
+
+
+n_events_header_pattern = re.compile(br'(#\s*Number of Events\s*:\s*)(\d+)')
+
+def get_n_events_from_header(header_lines):
+    """
+    Returns the number of events as written by MadGraph in <MGGenerationInfo>,
+    or None if it is not there
+    """
+    match = n_events_header_pattern.search(b''.join(header_lines))
+    return None if match is None else int(match.group(2))
+
+
+def set_n_events_in_header(header, n_events):
+    """
+    Returns header (bytes) with the number of events in <MGGenerationInfo> set to
+    n_events; a header without it is returned unchanged
+    """
+    return n_events_header_pattern.sub(
+        lambda m: m.group(1) + str(n_events).encode('ascii'), header, count=1
+        )
+
+
+def count_events(lhe_file):
+    """
+    Counts the number of <event> blocks in a streaming pass
+    """
+    n_events = 0
+    with open_lhe(lhe_file, 'rb') as f:
+        for line in f:
+            if line.startswith(b'<event'): n_events += 1
+    return n_events
+
+
+def read_lhe_metadata(lhe_file, use_index=True, count=False):
+    """
+    Reads the metadata of an .lhe file from its header and <init> block only, without
+    touching the events. Returns a dict with the beams, the processes (id, xs, error,
+    xmax), the total cross section and its error, and the number of events.
+
+    The number of events comes from an up to date `LHEIndex` sidecar if there is one
+    (use_index=True), otherwise from the MadGraph header; if neither has it, it is None,
+    unless count=True, in which case the events are counted (reading the whole file).
+    The header count is kept correct by `split_lhe`, `merge_lhe_files` and
+    `LHEIndex.write_subset`, but files cut by other tools may carry the count of the
+    file they were taken from; use an index or count=True for those.
+    """
+    index_metadata = None
+    if use_index and get_compression(lhe_file) is None:
+        index_metadata = svj.genprod.LHEIndex.read_metadata(lhe_file)
+    if index_metadata is None:
+        with open_lhe(lhe_file, 'rb') as f:
+            header_lines, init_lines = read_header_and_init(f)
+        n_events = get_n_events_from_header(header_lines)
+    else:
+        with open(lhe_file, 'rb') as f:
+            f.seek(index_metadata['init_offset'])
+            init_lines = f.read(index_metadata['init_length']).splitlines(True)
+        n_events = index_metadata['n_events']
+    if n_events is None and count:
+        n_events = count_events(lhe_file)
+
+    beam_tokens, processes, extra_lines = parse_init(init_lines)
+    metadata = {
+        'lhe_file' : lhe_file,
+        'beam_ids' : (int(beam_tokens[0]), int(beam_tokens[1])),
+        'beam_energies' : (float(beam_tokens[2]), float(beam_tokens[3])),
+        'idwtup' : int(beam_tokens[8]),
+        'processes' : [
+            { 'id' : lprup, 'xs' : xsecup, 'error' : xerrup, 'xmax' : xmaxup }
+            for xsecup, xerrup, xmaxup, lprup in processes
+            ],
+        'cross_section' : sum(p[0] for p in processes),
+        'cross_section_error' : math.sqrt(sum(p[1]**2 for p in processes)),
+        'n_events' : n_events,
+        }
+    return metadata
+
+
+def merge_lhe_files(srcs, dst, weight_norm='average', chunk_size=None):
+    """
+    Merges .lhe files produced with the same gridpack (but different seeds) into dst,
+    in a streaming way. The header of the first file is kept; the <init> block is
+    recomputed: per process, the cross section is the event-weighted average of
+    the inputs, the error is combined accordingly, and xmaxup is the maximum.
+
+    With weight_norm='average' (the MadGraph default, used in our run cards) the
+    event weights are kept as is. With weight_norm='sum', the event weights (and
+    <wgt> reweighting values) of every input are scaled by n_i/N, so that the sum
+    of weights stays equal to the cross section.
+
+    Every input is read once: its events are copied to a temporary file next to dst
+    while they are counted, and the temporary files are appended to dst once the
+    merged header and <init> block are known.
+    """
+    if weight_norm not in ['average', 'sum']:
+        raise ValueError('Unknown weight_norm {0}'.format(weight_norm))
+    n_events = []
+    inits = []
+    bodies = []
+    try:
+        for src in srcs:
+            body, body_tmp = atomic_output(dst, compression=False)
+            bodies.append(body_tmp)
+            n = 0
+            with open_lhe(src, 'rb') as f:
+                header_lines, init_lines = read_header_and_init(f)
+                with body:
+                    for chunk in iter_event_chunks(f, chunk_size):
+                        n += chunk.count(b'\n<event') + (1 if chunk.startswith(b'<event') else 0)
+                        body.write(chunk)
+            if not inits: first_header_lines, first_init_lines = header_lines, init_lines
+            inits.append(parse_init(init_lines))
+            n_events.append(n)
+        n_total = sum(n_events)
+        if n_total == 0:
+            raise ValueError('No events found in {0}'.format(srcs))
+        logger.info(
+            'Merging {0} files with {1} events in total into {2}'
+            .format(len(srcs), n_total, dst)
+            )
+
+        # Combine the cross sections of the init blocks
+        beam_tokens, processes, extra_lines = inits[0]
+        merged_processes = []
+        for i_proc, (_, _, _, lprup) in enumerate(processes):
+            xsec = 0.
+            err2 = 0.
+            xmax = 0.
+            for n, (_, src_processes, _) in zip(n_events, inits):
+                src_xsec, src_err, src_xmax, src_lprup = src_processes[i_proc]
+                if src_lprup != lprup:
+                    raise ValueError('Inconsistent process ids in the <init> blocks of {0}'.format(srcs))
+                xsec += n * src_xsec
+                err2 += (n * src_err)**2
+                xmax = max(xmax, src_xmax)
+            merged_processes.append([ xsec/n_total, math.sqrt(err2)/n_total, xmax, lprup ])
+        total_xsec = sum(p[0] for p in merged_processes)
+        logger.info('Merged cross section: {0} pb'.format(total_xsec))
+
+        header = set_n_events_in_header(b''.join(first_header_lines), n_total)
+        header = re.sub(
+            br'(#\s*Integrated weight \(pb\)\s*:\s*)\S+',
+            lambda m: m.group(1) + '{0:.6e}'.format(total_xsec).encode('ascii'),
+            header
+            )
+
+        weight_pattern = re.compile(br'(<event[^\n]*\n\s*\S+\s+\S+\s+)(\S+)')
+        wgt_pattern = re.compile(br'(<wgt[^>]*>\s*)(\S+)(\s*</wgt>)')
+        out, tmp = atomic_output(dst)
+        try:
+            with out:
+                out.write(header)
+                out.writelines(format_init(first_init_lines[0], beam_tokens, merged_processes, extra_lines))
+                for body_tmp, n in zip(bodies, n_events):
+                    scale = float(n) / n_total
+                    def rescale(match):
+                        value = float(match.group(2)) * scale
+                        tail = match.group(3) if match.lastindex == 3 else b''
+                        return match.group(1) + '{0:+.10e}'.format(value).encode('ascii') + tail
+                    with open(body_tmp, 'rb') as f:
+                        if weight_norm == 'sum':
+                            for chunk in iter_event_chunks(f, chunk_size):
+                                chunk = weight_pattern.sub(rescale, chunk)
+                                chunk = wgt_pattern.sub(rescale, chunk)
+                                out.write(chunk)
+                        else:
+                            shutil.copyfileobj(f, out, CHUNK_SIZE)
+                out.write(b'</LesHouchesEvents>\n')
+            os.rename(tmp, dst)
+        except:
+            if osp.isfile(tmp): os.remove(tmp)
+            raise
+    finally:
+        for body_tmp in bodies:
+            if osp.isfile(body_tmp): os.remove(body_tmp)
+    return n_total
+
+
+def split_lhe(lhe_file, out_dir=None, n_shards=None, events_per_shard=None, basename=None, chunk_size=None):
+    """
+    Splits lhe_file in one streaming pass into valid .lhe files
+    `<basename>_shard<i>.lhe` in out_dir (default: next to the input file), each with
+    the full header and <init> block and a contiguous range of events. The number of
+    events in the header of every shard is set to the number of events in the shard.
+
+    Pass either events_per_shard, or n_shards; in the latter case the number of
+    events is taken from the MadGraph header, or counted if it is not there.
+    Returns a list of (path, first_event, n_events), like `LHEIndex.shard`.
+    """
+    if (n_shards is None) == (events_per_shard is None):
+        raise ValueError('Pass exactly one of n_shards and events_per_shard')
+    if out_dir is None: out_dir = osp.dirname(osp.abspath(lhe_file))
+    if basename is None: basename = osp.basename(strip_compression_extension(lhe_file)).replace('.lhe', '')
+    svj.core.utils.create_directory(out_dir)
+
+    with open_lhe(lhe_file, 'rb') as f:
+        header_lines, init_lines = read_header_and_init(f)
+        header = b''.join(header_lines + init_lines)
+        if events_per_shard is None:
+            n_events = get_n_events_from_header(header_lines)
+            if n_events is None: n_events = count_events(lhe_file)
+            events_per_shard = max(1, -(-n_events // n_shards))
+        logger.info(
+            'Splitting {0} in shards of {1} events in {2}'
+            .format(lhe_file, events_per_shard, out_dir)
+            )
+
+        # Shards are written with events_per_shard in the header, which is patched in
+        # place for a shard that ends up shorter (the number is right-aligned, so fits)
+        header = set_n_events_in_header(header, events_per_shard)
+        match = n_events_header_pattern.search(header)
+        n_events_offset = None if match is None else match.start(2)
+        n_events_width = len(str(events_per_shard))
+        def finish_shard(out, n):
+            out.write(b'</LesHouchesEvents>\n')
+            if not(n_events_offset is None) and n != events_per_shard:
+                out.seek(n_events_offset)
+                out.write(str(n).rjust(n_events_width).encode('ascii'))
+
+        shards = []
+        out = None
+        n_written = 0
+        try:
+            for event in iter_events(f, chunk_size):
+                if out is None or shards[-1][2] == events_per_shard:
+                    if out:
+                        finish_shard(out, shards[-1][2])
+                        out.close()
+                    path = osp.join(out_dir, '{0}_shard{1}.lhe'.format(basename, len(shards)))
+                    out = open(path, 'wb')
+                    out.write(header)
+                    shards.append([path, n_written, 0])
+                out.write(event)
+                shards[-1][2] += 1
+                n_written += 1
+            if out: finish_shard(out, shards[-1][2])
+        finally:
+            if out: out.close()
+    logger.info('Wrote {0} events in {1} shards'.format(n_written, len(shards)))
+    return [ tuple(shard) for shard in shards ]
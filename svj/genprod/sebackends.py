@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Backends that carry out the storage element operations of `SEManager`:
+the xrootd command line tools, the XRootD python bindings, and a local
+filesystem stand-in for file:// paths
+"""
+from __future__ import print_function
+
+import os, shutil, logging, subprocess, threading
+import os.path as osp
+
+import svj.core
+import svj.genprod
+
+logger = logging.getLogger('root')
+
+
+def xrootd_bindings_available():
+    try:
+        import XRootD.client
+        return True
+    except ImportError:
+        return False
+
+
+#____________________________________________________________________
+class SEBackendBase(object):
+    """
+    Interface of a backend; every operation takes the mgm and lfn separately.
+    Operations that fail raise an OSError (or a CalledProcessError for the CLI).
+    """
+    name = 'base'
+
+    def mkdir(self, mgm, lfn):
+        """
+        Creates lfn, including missing parents
+        """
+        raise NotImplementedError
+
+    def is_directory(self, mgm, lfn):
+        raise NotImplementedError
+
+    def list_directory(self, mgm, lfn):
+        """
+        Returns a dict of lfn -> (is_dir, size, mtime) of the contents of lfn, or
+        None if it does not exist
+        """
+        raise NotImplementedError
+
+    def checksum(self, mgm, lfn):
+        """
+        Returns the adler32 checksum of lfn as a hex string
+        """
+        raise NotImplementedError
+
+    def copy(self, src, mgm, lfn, n_streams=1, checksum=None, force=False):
+        """
+        Copies the local file src to lfn; if checksum (adler32 as hex) is given,
+        the copy is verified against it
+        """
+        raise NotImplementedError
+
+    def get_stream_cmd(self, mgm, lfn):
+        """
+        Returns a command that writes the contents of lfn to stdout
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def join(mgm, lfn):
+        if not mgm.endswith('/'): mgm += '/'
+        return mgm + lfn
+
+
+#____________________________________________________________________
+class CLIBackend(SEBackendBase):
+    """
+    Runs `xrdfs` and `xrdcp`; one process per operation
+    """
+    name = 'cli'
+
+    def mkdir(self, mgm, lfn):
+        svj.core.utils.run_command([ 'xrdfs', mgm, 'mkdir', '-p', lfn ])
+
+    def is_directory(self, mgm, lfn):
+        cmd = [ 'xrdfs', mgm, 'stat', '-q', 'IsDir', lfn ]
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(cmd, stdout=devnull, stderr=devnull) == 0
+
+    def list_directory(self, mgm, lfn):
+        cmd = [ 'xrdfs', mgm, 'ls', '-l', lfn ]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            logger.debug('Could not list {0}: {1}'.format(lfn, stderr.decode('utf-8', 'replace').strip()))
+            return None
+        entries = {}
+        for line in stdout.decode('utf-8', 'replace').splitlines():
+            parsed = svj.genprod.semanager.parse_ls_line(line)
+            if parsed is None: continue
+            path, is_dir, size, mtime = parsed
+            entries[osp.normpath(path)] = (is_dir, size, mtime)
+        return entries
+
+    def checksum(self, mgm, lfn):
+        # Prints e.g. 'adler32 0a1b2c3d'
+        output = subprocess.check_output([ 'xrdfs', mgm, 'query', 'checksum', lfn ])
+        return output.decode('utf-8').split()[-1]
+
+    def get_copy_cmd(self, src, dst, n_streams=1, checksum=None, force=False):
+        cmd = [ 'xrdcp', '-s' ]
+        if n_streams > 1: cmd.extend([ '--streams', str(n_streams) ])
+        if checksum: cmd.extend([ '--cksum', 'adler32:' + checksum ])
+        if force: cmd.append('--force')
+        cmd.extend([ src, dst ])
+        return cmd
+
+    def copy(self, src, mgm, lfn, n_streams=1, checksum=None, force=False):
+        svj.core.utils.run_command(
+            self.get_copy_cmd(src, self.join(mgm, lfn), n_streams, checksum, force)
+            )
+
+    def get_stream_cmd(self, mgm, lfn):
+        return [ 'xrdcp', '-s', self.join(mgm, lfn), '-' ]
+
+
+#____________________________________________________________________
+class XRootDBackend(SEBackendBase):
+    """
+    Uses the XRootD python bindings, with one FileSystem per mgm shared by all
+    instances and threads in the process, so the connection and authentication
+    are set up once per mgm rather than once per operation
+    """
+    name = 'xrootd'
+
+    _filesystems = {}
+    _filesystems_lock = threading.Lock()
+
+    def __init__(self):
+        super(XRootDBackend, self).__init__()
+        from XRootD import client
+        from XRootD.client import flags
+        self.client = client
+        self.flags = flags
+
+    def get_filesystem(self, mgm):
+        mgm = mgm.rstrip('/')
+        with self._filesystems_lock:
+            if not mgm in self._filesystems:
+                logger.debug('Opening XRootD connection to {0}'.format(mgm))
+                self._filesystems[mgm] = self.client.FileSystem(mgm)
+            return self._filesystems[mgm]
+
+    @staticmethod
+    def _raise_if_failed(status, what):
+        if not status.ok:
+            raise OSError('{0} failed: {1}'.format(what, status.message))
+
+    def mkdir(self, mgm, lfn):
+        status, _ = self.get_filesystem(mgm).mkdir(lfn, self.flags.MkDirFlags.MAKEPATH)
+        self._raise_if_failed(status, 'mkdir {0}'.format(self.join(mgm, lfn)))
+
+    def is_directory(self, mgm, lfn):
+        status, info = self.get_filesystem(mgm).stat(lfn)
+        return status.ok and bool(info.flags & self.flags.StatInfoFlags.IS_DIR)
+
+    def list_directory(self, mgm, lfn):
+        status, listing = self.get_filesystem(mgm).dirlist(lfn, self.flags.DirListFlags.STAT)
+        if not status.ok:
+            logger.debug('Could not list {0}: {1}'.format(lfn, status.message))
+            return None
+        entries = {}
+        for entry in listing:
+            info = entry.statinfo
+            is_dir = bool(info.flags & self.flags.StatInfoFlags.IS_DIR) if info else False
+            entries[osp.normpath(osp.join(lfn, entry.name))] = (
+                is_dir, info.size if info else None, info.modtime if info else None
+                )
+        return entries
+
+    def checksum(self, mgm, lfn):
+        status, response = self.get_filesystem(mgm).query(self.flags.QueryCode.CHECKSUM, lfn)
+        self._raise_if_failed(status, 'Checksum of {0}'.format(self.join(mgm, lfn)))
+        # Response is e.g. b'adler32 0a1b2c3d\x00'
+        return response.decode('utf-8').strip('\x00').split()[-1]
+
+    def copy(self, src, mgm, lfn, n_streams=1, checksum=None, force=False):
+        dst = self.join(mgm, lfn)
+        kwargs = { 'force' : force, 'parallelchunks' : max(1, n_streams) }
+        if checksum:
+            kwargs.update(checksummode='target', checksumtype='adler32', checksumpreset=checksum)
+        process = self.client.CopyProcess()
+        process.add_job(osp.abspath(src), dst, **kwargs)
+        status = process.prepare()
+        self._raise_if_failed(status, 'Preparing copy {0} to {1}'.format(src, dst))
+        status, results = process.run()
+        self._raise_if_failed(status, 'Copying {0} to {1}'.format(src, dst))
+        for result in results:
+            self._raise_if_failed(result['status'], 'Copying {0} to {1}'.format(src, dst))
+
+    def get_stream_cmd(self, mgm, lfn):
+        # Streams are read by a shell pipeline, so this needs a process anyway
+        return CLIBackend().get_stream_cmd(mgm, lfn)
+
+
+#____________________________________________________________________
+class LocalBackend(SEBackendBase):
+    """
+    Stand-in for a storage element on the local filesystem: the mgm
+    'file:///some/dir' maps the lfn /store/... to /some/dir/store/...
+    """
+    name = 'local'
+
+    @staticmethod
+    def get_path(mgm, lfn):
+        if not mgm.startswith('file://'):
+            raise ValueError('Local backend needs a file:// mgm, not {0}'.format(mgm))
+        return mgm[len('file://'):].rstrip('/') + lfn
+
+    def mkdir(self, mgm, lfn):
+        path = self.get_path(mgm, lfn)
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Also when another thread created it in the meantime
+            if not osp.isdir(path): raise
+
+    def is_directory(self, mgm, lfn):
+        return osp.isdir(self.get_path(mgm, lfn))
+
+    def list_directory(self, mgm, lfn):
+        path = self.get_path(mgm, lfn)
+        if not osp.isdir(path): return None
+        entries = {}
+        for name in os.listdir(path):
+            full_path = osp.join(path, name)
+            is_dir = osp.isdir(full_path)
+            stat = os.stat(full_path)
+            entries[osp.normpath(osp.join(lfn, name))] = (is_dir, stat.st_size, stat.st_mtime)
+        return entries
+
+    def checksum(self, mgm, lfn):
+        return svj.genprod.semanager.adler32_of_file(self.get_path(mgm, lfn))
+
+    def copy(self, src, mgm, lfn, n_streams=1, checksum=None, force=False):
+        dst = self.get_path(mgm, lfn)
+        if osp.exists(dst) and not force:
+            raise OSError('{0} already exists'.format(dst))
+        if not osp.isdir(osp.dirname(dst)):
+            raise OSError('No directory {0}'.format(osp.dirname(dst)))
+        tmp = dst + '.tmp{0}'.format(os.getpid())
+        shutil.copyfile(src, tmp)
+        if checksum:
+            dst_checksum = svj.genprod.semanager.adler32_of_file(tmp)
+            if dst_checksum != checksum:
+                os.remove(tmp)
+                raise OSError(
+                    'Checksum mismatch copying {0} to {1}: {2} != {3}'
+                    .format(src, dst, dst_checksum, checksum)
+                    )
+        os.rename(tmp, dst)
+
+    def get_stream_cmd(self, mgm, lfn):
+        return [ 'cat', self.get_path(mgm, lfn) ]
+
+
+BACKENDS = {
+    'cli' : CLIBackend,
+    'xrootd' : XRootDBackend,
+    'local' : LocalBackend,
+    }
+
+def get_backend(name=None):
+    """
+    Returns a backend instance by name; without a name, the SVJ_SE_BACKEND
+    environment variable is used, and otherwise the XRootD bindings if they are
+    importable and the command line tools if not
+    """
+    if name is None: name = os.environ.get('SVJ_SE_BACKEND', None)
+    if name is None:
+        name = 'xrootd' if xrootd_bindings_available() else 'cli'
+    if not name in BACKENDS:
+        raise ValueError(
+            'Unknown SE backend {0}; choose from {1}'.format(name, ', '.join(sorted(BACKENDS)))
+            )
+    logger.debug('Using SE backend {0}'.format(name))
+    return BACKENDS[name]()
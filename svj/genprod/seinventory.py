@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local SQLite index of the outputs on the SE, so that resubmissions can skip work
+whose output was already staged out (see `FullSimRunnerBase.get_stageout_dst`)
+"""
+from __future__ import print_function
+
+import os, re, time, sqlite3, logging
+import os.path as osp
+from multiprocessing.pool import ThreadPool
+
+import svj.core
+import svj.genprod
+
+logger = logging.getLogger('root')
+
+
+# <cluster>_<date>_<substage>_<model_name>, see `FullSimRunnerBase.get_stageout_dst`
+STAGEOUT_DIRECTORY_PATTERN = re.compile(
+    r'^(?P<cluster>\d+|local)_(?P<date>[^_]+)_(?P<substage>.+?)_(?P<model_name>SVJ_.+)$'
+    )
+# N<n_events>[_<procid>]_seed<seed>.root
+STAGEOUT_FILE_PATTERN = re.compile(
+    r'^N(?P<n_events>\d+)(?:_(?P<procid>\d+))?_seed(?P<seed>\d+)\.root$'
+    )
+
+
+def parse_stageout_path(lfn):
+    """
+    Returns a dict with cluster, date, substage, model_name, n_events, procid and
+    seed parsed from a stageout path; fields that cannot be parsed are None
+    """
+    fields = dict.fromkeys(
+        [ 'cluster', 'date', 'substage', 'model_name', 'n_events', 'procid', 'seed' ]
+        )
+    match = STAGEOUT_DIRECTORY_PATTERN.match(osp.basename(osp.dirname(lfn)))
+    if match: fields.update(match.groupdict())
+    match = STAGEOUT_FILE_PATTERN.match(osp.basename(lfn))
+    if match:
+        for key, value in match.groupdict().items():
+            fields[key] = None if value is None else int(value)
+    return fields
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT,
+    size INTEGER,
+    mtime REAL,
+    checksum TEXT,
+    cluster TEXT,
+    date TEXT,
+    substage TEXT,
+    model_name TEXT,
+    n_events INTEGER,
+    procid INTEGER,
+    seed INTEGER,
+    last_seen REAL,
+    complete INTEGER DEFAULT 0
+    );
+CREATE INDEX IF NOT EXISTS files_work_item ON files (model_name, substage, seed);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime REAL,
+    last_listed REAL
+    );
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+"""
+
+
+#____________________________________________________________________
+class SEInventory(object):
+    """
+    Index of the files below one or more SE directories, in an SQLite database.
+
+    `update` lists the directories recursively, a level at a time with n_workers
+    parallel listings. The modification time of a directory only changes when entries
+    are added or removed, not when a file in it grows, so a directory is only skipped
+    if its modification time did not change since it was last listed and all its
+    files are complete (its files and subdirectories are then taken from the index).
+    Checksums are only queried for files that are new or whose size or modification
+    time changed.
+
+    A non-empty file counts as complete (see `query`) if it was last modified more
+    than complete_after seconds ago, if checksums are queried and the SE returned
+    one (it only has a checksum for files that were closed), or if its size and
+    modification time did not change since the previous update. A file that is still
+    being written is thus not taken as output, while finished outputs are recognized
+    in the first update.
+    """
+
+    def __init__(self, db_file=None, semanager=None):
+        super(SEInventory, self).__init__()
+        self.db_file = (
+            osp.join(svj.genprod.SVJ_CACHE_DIR, 'se_inventory.sqlite')
+            if db_file is None else db_file
+            )
+        self.semanager = svj.genprod.SEManager() if semanager is None else semanager
+        svj.core.utils.create_directory(osp.dirname(osp.abspath(self.db_file)))
+        self.connection = sqlite3.connect(self.db_file)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+        # Seconds since the last modification after which a file is taken as complete
+        self.complete_after = 900.
+
+    def close(self):
+        self.connection.close()
+
+    def _key(self, path):
+        """
+        Paths are stored as full urls, so areas on different mgms do not mix
+        """
+        mgm, lfn = self.semanager._safe_split_mgm(path)
+        return self.semanager._join_mgm_lfn(mgm, osp.normpath(lfn))
+
+    def _needs_listing(self, directory, mtime, full):
+        if full or mtime is None: return True
+        row = self.connection.execute(
+            'SELECT mtime FROM directories WHERE path = ?', (directory,)
+            ).fetchone()
+        if row is None or row['mtime'] != mtime: return True
+        # Files that are not complete yet may still grow without changing the directory mtime
+        n_incomplete = self.connection.execute(
+            'SELECT COUNT(*) FROM files WHERE directory = ? AND NOT complete', (directory,)
+            ).fetchone()[0]
+        return n_incomplete > 0
+
+    def _list(self, directory):
+        try:
+            return self.semanager.list_directory(directory)
+        except Exception as e:
+            logger.error('Could not list {0}: {1}'.format(directory, e))
+            return None
+
+    def update(self, directories, n_workers=8, with_checksums=False, full=False):
+        """
+        Updates the index with the contents of directories (recursively);
+        returns the number of directories that were listed
+        """
+        now = time.time()
+        # (directory, parent, mtime as seen in the parent listing)
+        frontier = [ (self._key(directory), None, None) for directory in directories ]
+        n_listed = 0
+        pool = ThreadPool(n_workers)
+        try:
+            while frontier:
+                to_list = [ item for item in frontier if self._needs_listing(item[0], item[2], full) ]
+                skipped = [ item for item in frontier if not item in to_list ]
+                listings = pool.map(self._list, [ item[0] for item in to_list ])
+                n_listed += len(to_list)
+                next_frontier = []
+                for (directory, parent, mtime), listing in zip(to_list, listings):
+                    if listing is None:
+                        logger.warning('Directory {0} does not exist (anymore)'.format(directory))
+                        self._remove_directory(directory)
+                        continue
+                    subdirectories = self._store_listing(directory, parent, mtime, listing, now, with_checksums)
+                    next_frontier.extend(subdirectories)
+                for directory, parent, mtime in skipped:
+                    # Unchanged; its subdirectories may still have changed
+                    next_frontier.extend(
+                        (row['path'], directory, row['mtime']) for row in self.connection.execute(
+                            'SELECT path, mtime FROM directories WHERE parent = ?', (directory,)
+                            )
+                        )
+                frontier = next_frontier
+                self.connection.commit()
+        finally:
+            pool.close()
+            pool.join()
+        logger.info(
+            'Updated inventory {0}: listed {1} directories, {2} files indexed'
+            .format(self.db_file, n_listed, self.count())
+            )
+        return n_listed
+
+    def _store_listing(self, directory, parent, mtime, listing, now, with_checksums):
+        """
+        Stores the files of a listing in the index, removes files and directories
+        that are gone, and returns the subdirectories as (path, parent, mtime)
+        """
+        mgm, _ = self.semanager._safe_split_mgm(directory)
+        known_files = dict(
+            (row['path'], row) for row in self.connection.execute(
+                'SELECT path, size, mtime, checksum FROM files WHERE directory = ?', (directory,)
+                )
+            )
+        subdirectories = []
+        files = []
+        for lfn, (is_dir, size, entry_mtime) in listing.items():
+            path = self.semanager._join_mgm_lfn(mgm, lfn)
+            if is_dir:
+                subdirectories.append((path, directory, entry_mtime))
+                continue
+            known = known_files.get(path)
+            unchanged = not(known is None) and (known['size'], known['mtime']) == (size, entry_mtime)
+            checksum = known['checksum'] if unchanged else None
+            if with_checksums and checksum is None:
+                try:
+                    checksum = self.semanager.get_checksum(path)
+                except Exception as e:
+                    logger.warning('Could not get checksum of {0}: {1}'.format(path, e))
+            complete = bool(size) and (
+                unchanged
+                or (not(entry_mtime is None) and now - entry_mtime > self.complete_after)
+                or (with_checksums and not(checksum is None))
+                )
+            fields = parse_stageout_path(lfn)
+            files.append((
+                path, directory, size, entry_mtime, checksum,
+                fields['cluster'], fields['date'], fields['substage'], fields['model_name'],
+                fields['n_events'], fields['procid'], fields['seed'], now, int(complete)
+                ))
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', files
+            )
+        # Files and directories that disappeared
+        present = set(path for path, _, _ in subdirectories)
+        for row in self.connection.execute(
+                'SELECT path FROM directories WHERE parent = ?', (directory,)
+                ).fetchall():
+            if not row['path'] in present: self._remove_directory(row['path'])
+        self.connection.execute(
+            'DELETE FROM files WHERE directory = ? AND last_seen < ?', (directory, now)
+            )
+        self.connection.execute(
+            'INSERT OR REPLACE INTO directories VALUES (?,?,?,?)',
+            (directory, parent, mtime, now)
+            )
+        return subdirectories
+
+    def _remove_directory(self, directory):
+        """
+        Removes a directory and everything below it from the index
+        """
+        prefix = directory.rstrip('/') + '/'
+        self.connection.execute(
+            'DELETE FROM files WHERE directory = ? OR substr(directory, 1, ?) = ?',
+            (directory, len(prefix), prefix)
+            )
+        self.connection.execute(
+            'DELETE FROM directories WHERE path = ? OR substr(path, 1, ?) = ?',
+            (directory, len(prefix), prefix)
+            )
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def query(self, model_name=None, substage=None, seed=None, n_events=None, complete=True):
+        """
+        Returns the indexed files (as dicts) matching all given fields; unless
+        complete=False, files that are not complete yet (see `SEInventory`) are left out
+        """
+        conditions = [ 'complete' ] if complete else [ '1' ]
+        values = []
+        for column, value in [
+                ('model_name', model_name), ('substage', substage),
+                ('seed', seed), ('n_events', n_events)
+                ]:
+            if value is None: continue
+            conditions.append('{0} = ?'.format(column))
+            values.append(value)
+        rows = self.connection.execute(
+            'SELECT * FROM files WHERE ' + ' AND '.join(conditions) + ' ORDER BY path', values
+            )
+        return [ dict(zip(row.keys(), row)) for row in rows ]
+
+    def get_existing_seeds(self, model_name, substage, n_events=None):
+        return set(row['seed'] for row in self.query(model_name, substage, n_events=n_events))
+
+    def has_output(self, model_name, substage, seed, n_events=None):
+        return len(self.query(model_name, substage, seed, n_events)) > 0
+
+    def drop_completed(self, work_items):
+        """
+        Returns the work items that have no output in the index yet. Work items are
+        dicts with model_name, substage and seed, and optionally n_events.
+        """
+        missing = [
+            item for item in work_items
+            if not self.has_output(item['model_name'], item['substage'], item['seed'], item.get('n_events'))
+            ]
+        logger.info(
+            '{0} of {1} work items already have output; {2} left'
+            .format(len(work_items) - len(missing), len(work_items), len(missing))
+            )
+        return missing
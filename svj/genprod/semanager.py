@@ -3,14 +3,25 @@
 
 
 import os.path as osp
-import logging, subprocess, os, shutil, re, pprint, csv
+import logging, subprocess, os, shutil, re, pprint, csv, zlib, time, json
+from multiprocessing.pool import ThreadPool
 import svj.genprod
 
 logger = logging.getLogger('root')
 
 
+# Prefixes of paths that include the mgm
+MGM_PREFIXES = ('root://', 'file://')
+
+
 def split_mgm(filename):
-    if not filename.startswith('root://'):
+    """
+    Splits filename in the mgm and the lfn (starting at '/store'). Besides root://
+    mgms, file:// mgms are supported for a storage element on the local filesystem
+    (see `sebackends.LocalBackend`): 'file:///some/dir/store/x' splits in
+    'file:///some/dir' and '/store/x'.
+    """
+    if not filename.startswith(MGM_PREFIXES):
         raise ValueError(
             'Cannot split mgm; passed filename: {0}'
             .format(filename)
@@ -26,11 +37,148 @@ def split_mgm(filename):
     return mgm, lfn
 
 
+def adler32_of_file(path, chunk_size=8*1024*1024):
+    """
+    Returns the adler32 checksum of a local file as an 8 digit hex string,
+    the format xrootd uses
+    """
+    checksum = 1
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk: break
+            checksum = zlib.adler32(chunk, checksum)
+    return '{0:08x}'.format(checksum & 0xffffffff)
+
+
+def parse_ls_line(line):
+    """
+    Parses a line of `xrdfs ls -l` output into (path, is_dir, size, mtime); returns
+    None for lines that do not look like an entry. Handles both the older
+    `<flags> <date> <time> <size> <path>` and the newer
+    `<mode> <owner> <group> <size> <date> <time> <path>` formats.
+    """
+    parts = line.split()
+    if len(parts) < 5 or not parts[-1].startswith('/'): return None
+    sizes = [ part for part in parts[1:-1] if part.isdigit() ]
+    size = int(sizes[-1]) if sizes else None
+    mtime = None
+    for date, clock in zip(parts[1:-2], parts[2:-1]):
+        if re.match(r'^\d{4}-\d{2}-\d{2}$', date) and re.match(r'^\d{2}:\d{2}:\d{2}$', clock):
+            mtime = time.mktime(time.strptime(date + ' ' + clock, '%Y-%m-%d %H:%M:%S'))
+            break
+    return parts[-1], parts[0].startswith('d'), size, mtime
+
+
+class SEDirectoryCache(object):
+    """
+    Directories on the SE that are known to exist, so they need not be created or
+    checked again. Entries expire after ttl seconds. If cache_file is given, the
+    entries are also shared between processes through a json file.
+    """
+    def __init__(self, cache_file=None, ttl=24*3600.):
+        super(SEDirectoryCache, self).__init__()
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.directories = {}
+
+    @staticmethod
+    def get_key(mgm, lfn):
+        return mgm.rstrip('/') + '/' + osp.normpath(lfn)
+
+    def _is_fresh(self, timestamp):
+        return time.time() - timestamp < self.ttl
+
+    def _read(self):
+        if self.cache_file is None or not osp.isfile(self.cache_file): return {}
+        try:
+            with open(self.cache_file, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning('Could not read SE directory cache {0}; ignoring it'.format(self.cache_file))
+            return {}
+
+    def __contains__(self, key):
+        if key in self.directories and self._is_fresh(self.directories[key]):
+            return True
+        if not(self.cache_file is None):
+            for other_key, timestamp in self._read().items():
+                if self._is_fresh(timestamp) and self.directories.get(other_key, 0.) < timestamp:
+                    self.directories[other_key] = timestamp
+            return key in self.directories and self._is_fresh(self.directories[key])
+        return False
+
+    def add(self, mgm, lfn):
+        """
+        Marks the directory lfn and all its parents as existing
+        """
+        now = time.time()
+        lfn = osp.normpath(lfn)
+        keys = []
+        while lfn.startswith('/store'):
+            keys.append(self.get_key(mgm, lfn))
+            lfn = osp.dirname(lfn)
+        for key in keys: self.directories[key] = now
+        if self.cache_file is None: return
+        svj.core.utils.create_directory(osp.dirname(osp.abspath(self.cache_file)))
+        with svj.genprod.utils.file_lock(self.cache_file + '.lock'):
+            directories = dict(
+                (key, timestamp) for key, timestamp in self._read().items() if self._is_fresh(timestamp)
+                )
+            for key in keys: directories[key] = now
+            tmp = self.cache_file + '.tmp{0}'.format(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(directories, f)
+            os.rename(tmp, self.cache_file)
+
+    def discard(self, mgm, lfn):
+        """
+        Forgets the directory lfn and everything below it, e.g. because it was removed
+        """
+        key = self.get_key(mgm, lfn)
+        def is_discarded(other_key):
+            return other_key == key or other_key.startswith(key + '/')
+        for other_key in [ k for k in self.directories if is_discarded(k) ]:
+            del self.directories[other_key]
+        if self.cache_file is None or not osp.isfile(self.cache_file): return
+        with svj.genprod.utils.file_lock(self.cache_file + '.lock'):
+            directories = dict(
+                (other_key, timestamp) for other_key, timestamp in self._read().items()
+                if self._is_fresh(timestamp) and not is_discarded(other_key)
+                )
+            tmp = self.cache_file + '.tmp{0}'.format(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(directories, f)
+            os.rename(tmp, self.cache_file)
+
+    def clear(self):
+        self.directories = {}
+
+
+# Shared by all SEManager instances in this process, unless another cache is passed
+_process_directory_cache = SEDirectoryCache()
+
+
 class SEManager(object):
     """docstring for SEManager"""
-    def __init__(self, mgm='root://cmseos.fnal.gov'):
+    def __init__(self, mgm='root://cmseos.fnal.gov', directory_cache=None, backend=None):
         super(SEManager, self).__init__()
         self.mgm = mgm
+        self.directory_cache = (
+            _process_directory_cache if directory_cache is None else directory_cache
+            )
+        # Name or instance of the backend for root:// mgms (see `sebackends.get_backend`)
+        self.backend = (
+            svj.genprod.sebackends.get_backend(backend) if backend is None or isinstance(backend, str)
+            else backend
+            )
+        self._local_backend = svj.genprod.sebackends.LocalBackend()
+
+    def get_backend(self, mgm):
+        """
+        Returns the backend for mgm; file:// mgms always use the local backend
+        """
+        return self._local_backend if mgm.startswith('file://') else self.backend
 
     def _safe_split_mgm(self, path, mgm=None):
         """
@@ -39,7 +187,7 @@ class SEManager(object):
         if mgm is passed, it is used as is
         if mgm is None and path has no mgm, the class var is taken
         """
-        if path.startswith('root://'):
+        if path.startswith(MGM_PREFIXES):
             _mgm, lfn = split_mgm(path)
             if not(mgm is None) and not _mgm == mgm:
                 raise ValueError(
@@ -73,37 +221,214 @@ class SEManager(object):
         if not mgm.endswith('/'): mgm += '/'
         return mgm + lfn
 
-    def create_directory(self, directory):
+    def create_directory(self, directory, use_cache=True):
         """
-        Creates a directory on the SE
-        Does not check if directory already exists
+        Creates a directory on the SE, unless it is known to exist from the
+        directory cache (see `SEDirectoryCache`)
         """
         mgm, directory = self._safe_split_mgm(directory)
+        if use_cache and self.directory_cache.get_key(mgm, directory) in self.directory_cache:
+            logger.debug('Directory {0} known to exist; not creating it'.format(directory))
+            return
         logger.warning('Creating directory on SE: {0}'.format(self._join_mgm_lfn(mgm, directory)))
-        cmd = [ 'xrdfs', mgm, 'mkdir', '-p', directory ]
-        svj.core.utils.run_command(cmd)
+        self.get_backend(mgm).mkdir(mgm, directory)
+        self.directory_cache.add(mgm, directory)
 
-    def is_directory(self, directory):
+    def is_directory(self, directory, use_cache=True):
         """
         Returns a boolean indicating whether the directory exists
         """
         mgm, directory = self._safe_split_mgm(directory)
-        cmd = [ 'xrdfs', mgm, 'stat', '-q', 'IsDir', directory ]
-        status = (subprocess.check_output(cmd) == 0)
-        if not status:
+        if use_cache and self.directory_cache.get_key(mgm, directory) in self.directory_cache:
+            return True
+        status = self.get_backend(mgm).is_directory(mgm, directory)
+        if status:
+            self.directory_cache.add(mgm, directory)
+        else:
             logger.info('Directory {0} does not exist'.format(self._join_mgm_lfn(mgm, directory)))
         return status
 
+    def list_directory(self, directory, mgm=None):
+        """
+        Lists a directory in one operation; returns a dict of lfn -> (is_dir, size, mtime),
+        or None if the directory does not exist
+        """
+        mgm, directory = self._safe_split_mgm(directory, mgm)
+        entries = self.get_backend(mgm).list_directory(mgm, directory)
+        if entries is None: return None
+        self.directory_cache.add(mgm, directory)
+        for path, (is_dir, size, mtime) in entries.items():
+            if is_dir: self.directory_cache.add(mgm, path)
+        return entries
+
+    def stat_many(self, paths, n_workers=8):
+        """
+        Returns a dict path -> { 'is_dir' : bool, 'size' : int, 'mtime' : float } (None
+        for paths that do not exist) for many paths at once. Paths are grouped by their parent
+        directory, and each parent is listed once, n_workers at a time, so the cost
+        scales with the number of directories rather than the number of files.
+
+        The listings are not batched in a single session: with the xrootd backend all
+        threads share the one FileSystem per mgm (see `sebackends.XRootDBackend`), with
+        the CLI backend every listing is a separate `xrdfs ls`. Parents above '/store'
+        (i.e. for '/store' itself) are not listed; those paths are stat'ed one by one.
+        """
+        paths = list(paths)
+        by_parent = {}
+        for path in paths:
+            mgm, lfn = self._safe_split_mgm(path)
+            lfn = osp.normpath(lfn)
+            by_parent.setdefault((mgm, osp.dirname(lfn)), []).append((path, lfn))
+        parents = list(by_parent.keys())
+        if not parents: return {}
+        def list_parent(mgm_and_parent):
+            mgm, parent = mgm_and_parent
+            if parent == '/store' or parent.startswith('/store/'):
+                return self.list_directory(parent, mgm=mgm)
+            return dict(
+                (lfn, (True, None, None)) for _, lfn in by_parent[mgm_and_parent]
+                if self.get_backend(mgm).is_directory(mgm, lfn)
+                )
+        pool = ThreadPool(max(1, min(n_workers, len(parents))))
+        try:
+            listings = pool.map(list_parent, parents)
+        finally:
+            pool.close()
+            pool.join()
+        stats = {}
+        for parent, listing in zip(parents, listings):
+            for path, lfn in by_parent[parent]:
+                if listing is None or not lfn in listing:
+                    stats[path] = None
+                else:
+                    is_dir, size, mtime = listing[lfn]
+                    stats[path] = { 'is_dir' : is_dir, 'size' : size, 'mtime' : mtime }
+        return stats
+
+    def exists_many(self, paths, n_workers=8):
+        """
+        Returns a dict path -> bool, see `stat_many`
+        """
+        return dict((path, not(stat is None)) for path, stat in self.stat_many(paths, n_workers).items())
+
+    def get_checksum(self, path):
+        """
+        Returns the adler32 checksum of a file on the SE as a hex string
+        """
+        mgm, lfn = self._safe_split_mgm(path)
+        return self.get_backend(mgm).checksum(mgm, lfn)
+
+    def get_stream_cmd(self, path):
+        """
+        Returns a command that writes the contents of a file on the SE to stdout
+        """
+        mgm, lfn = self._safe_split_mgm(path)
+        return self.get_backend(mgm).get_stream_cmd(mgm, lfn)
+
     def copy_to_se(self, src, dst, create_parent_directory=True):
         """
         Copies a file `src` to the storage element
         """
-        mgm, dst = self._safe_split_mgm(dst)
-        dst = self._join_mgm_lfn(mgm, dst)
+        mgm, lfn = self._safe_split_mgm(dst)
+        dst = self._join_mgm_lfn(mgm, lfn)
         if create_parent_directory:
             parent_directory = osp.dirname(dst)
             self.create_directory(parent_directory)
         logger.warning('Copying {0} to {1}'.format(src, dst))
-        cmd = [ 'xrdcp', '-s', src, dst ]
-        svj.core.utils.run_command(cmd)
+        try:
+            self.get_backend(mgm).copy(src, mgm, lfn)
+        except (subprocess.CalledProcessError, EnvironmentError):
+            if not(create_parent_directory and self._recreate_parent_directory(mgm, lfn)): raise
+            logger.warning('Retrying copy of {0} to {1}'.format(src, dst))
+            self.get_backend(mgm).copy(src, mgm, lfn)
+
+    def _recreate_parent_directory(self, mgm, lfn):
+        """
+        Called when a copy to lfn failed: if its parent directory was taken from the
+        directory cache, it may have been removed since, so it is dropped from the
+        cache and created again. Returns whether that was done.
+        """
+        parent = osp.dirname(osp.normpath(lfn))
+        if not self.directory_cache.get_key(mgm, parent) in self.directory_cache: return False
+        logger.warning(
+            'Copy failed; creating {0} again in case it was removed'
+            .format(self._join_mgm_lfn(mgm, parent))
+            )
+        self.directory_cache.discard(mgm, parent)
+        self.get_backend(mgm).mkdir(mgm, parent)
+        self.directory_cache.add(mgm, parent)
+        return True
+
+    def _copy_with_retries(
+            self, src, dst, n_streams, verify_checksum, n_attempts, backoff,
+            recreate_parent_directory=True
+            ):
+        """
+        Copies src to dst, retrying with exponential backoff; returns None on
+        success and the last error otherwise. After the first failed attempt, the
+        parent directory is created again if it was taken from the directory cache
+        (see `_recreate_parent_directory`).
+        """
+        checksum = adler32_of_file(src) if verify_checksum else None
+        error = None
+        for i_attempt in range(n_attempts):
+            if i_attempt > 0:
+                wait = backoff * 2**(i_attempt-1)
+                logger.warning(
+                    'Copying {0} to {1} failed ({2}); retrying in {3:.0f}s'
+                    .format(src, dst, error, wait)
+                    )
+                time.sleep(wait)
+            try:
+                # A failed attempt may leave a partial file, so overwrite on retries
+                mgm, lfn = self._safe_split_mgm(dst)
+                self.get_backend(mgm).copy(src, mgm, lfn, n_streams, checksum, force=(i_attempt > 0))
+                return None
+            except (subprocess.CalledProcessError, EnvironmentError) as e:
+                error = e
+                if i_attempt == 0 and recreate_parent_directory and n_attempts > 1:
+                    try:
+                        self._recreate_parent_directory(mgm, lfn)
+                    except (subprocess.CalledProcessError, EnvironmentError) as mkdir_error:
+                        logger.warning('Could not create the parent directory of {0}: {1}'.format(dst, mkdir_error))
+        logger.error('Giving up copying {0} to {1} after {2} attempts'.format(src, dst, n_attempts))
+        return error
 
+    def copy_many_to_se(
+            self, pairs, n_workers=4, n_streams=1, verify_checksum=True,
+            n_attempts=3, backoff=5., create_parent_directories=True
+            ):
+        """
+        Copies a list of (src, dst) pairs to the storage element.
+        Every distinct parent directory is created once, files are copied by
+        n_workers concurrent copies with n_streams each, and the adler32 checksum of
+        every file (computed locally, by the same worker) is verified at the destination.
+        Failed copies are retried with backoff; raises a RuntimeError listing the
+        copies that failed after all attempts.
+        """
+        pairs = [ (src, self._join_mgm_lfn(*self._safe_split_mgm(dst))) for src, dst in pairs ]
+        if not pairs: return
+        if create_parent_directories:
+            for parent_directory in sorted(set(osp.dirname(dst) for src, dst in pairs)):
+                self.create_directory(parent_directory)
+        logger.warning(
+            'Copying {0} files to the SE with {1} workers'
+            .format(len(pairs), min(n_workers, len(pairs)))
+            )
+        def copy(pair):
+            return self._copy_with_retries(
+                pair[0], pair[1], n_streams, verify_checksum, n_attempts, backoff,
+                recreate_parent_directory=create_parent_directories
+                )
+        pool = ThreadPool(max(1, min(n_workers, len(pairs))))
+        try:
+            errors = pool.map(copy, pairs)
+        finally:
+            pool.close()
+            pool.join()
+        failed = [ (pair, error) for pair, error in zip(pairs, errors) if not(error is None) ]
+        if failed:
+            raise RuntimeError(
+                'Failed to copy {0}/{1} files to the SE:\n'.format(len(failed), len(pairs))
+                + '\n'.join('{0} -> {1}: {2}'.format(src, dst, error) for (src, dst), error in failed)
+                )
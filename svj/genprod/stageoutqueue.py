@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stages out files to the SE in the background, so the transfer of one output
+overlaps with the next stage or job
+"""
+from __future__ import print_function
+
+import os, json, uuid, socket, atexit, logging, threading
+import os.path as osp
+from time import strftime
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import svj.core
+import svj.genprod
+
+logger = logging.getLogger('root')
+
+# Ids of the transfers handled by a queue in this process
+_transfers_in_process = set()
+
+
+#____________________________________________________________________
+class StageoutQueue(object):
+    """
+    Queue of (src, dst) transfers, carried out by background threads with
+    `SEManager.copy_many_to_se` (so with checksums and retries).
+
+    Every transfer is recorded in a journal (json lines) when it is queued and when
+    it is done or failed, and the journal is synced to disk. Records carry the host
+    and pid of the process that owns them. If a job crashes, transfers that were
+    queued but not done are claimed and queued again when a queue with the same
+    journal is created (see `resume`); transfers owned by a process that is still
+    running are left alone, so processes can share a journal.
+
+    The source files must stay in place until the transfer is done (see `wait` and
+    `wait_all`). If the process exits with transfers still pending, a warning is
+    logged; they stay in the journal and are picked up by the next `resume`.
+    """
+
+    def __init__(self, journal_file=None, n_workers=1, semanager=None, resume=True):
+        super(StageoutQueue, self).__init__()
+        self.journal_file = (
+            osp.join(svj.genprod.RUN_FULLSIM_DIR, 'stageout_journal.jsonl')
+            if journal_file is None else journal_file
+            )
+        self.semanager = svj.genprod.SEManager() if semanager is None else semanager
+        self.queue = queue.Queue()
+        self.failed = []
+        self.owner = { 'host' : socket.gethostname(), 'pid' : os.getpid() }
+        self._journal_lock = threading.Lock()
+        # id -> [ threading.Event set when the transfer finished, status ]
+        self._transfers = {}
+        atexit.register(self._warn_pending)
+        self._threads = []
+        for i in range(n_workers):
+            thread = threading.Thread(target=self._work, name='stageout{0}'.format(i))
+            # Unfinished transfers are in the journal, so they need not block exit
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        if resume: self.resume()
+
+    def get_lock_file(self):
+        return self.journal_file + '.lock'
+
+    def _append(self, record):
+        """
+        Appends a record to the journal; the journal lock must be held
+        """
+        record['time'] = strftime('%Y-%m-%d %H:%M:%S')
+        svj.core.utils.create_directory(osp.dirname(osp.abspath(self.journal_file)))
+        with open(self.journal_file, 'a+') as f:
+            # Start a new line if a crash left the last one unfinished
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                if f.read(1) != '\n': f.write('\n')
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _journal(self, record):
+        with self._journal_lock:
+            with svj.genprod.utils.file_lock(self.get_lock_file()):
+                self._append(record)
+
+    def read_journal(self):
+        """
+        Returns a dict of id -> last record of every transfer in the journal
+        """
+        transfers = {}
+        if not osp.isfile(self.journal_file): return transfers
+        with open(self.journal_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut off by a crash
+                    logger.warning('Skipping corrupt line in {0}'.format(self.journal_file))
+                    continue
+                transfers[record['id']] = record
+        return transfers
+
+    def get_pending(self):
+        return [ record for record in self.read_journal().values() if record['status'] == 'queued' ]
+
+    def owner_is_alive(self, record):
+        """
+        Whether the process that owns record is still running. Owners on other hosts
+        cannot be checked, and are assumed to be alive.
+        """
+        owner = record.get('owner')
+        if owner is None: return False
+        if owner['host'] != self.owner['host']: return True
+        if owner['pid'] == self.owner['pid']: return False
+        try:
+            os.kill(owner['pid'], 0)
+        except OSError:
+            return False
+        return True
+
+    def resume(self):
+        """
+        Claims and queues the transfers in the journal that were not done yet and
+        whose owner is gone. The journal is locked while claiming, so a transfer is
+        claimed by one process only.
+        """
+        claimed = []
+        with self._journal_lock:
+            with svj.genprod.utils.file_lock(self.get_lock_file()):
+                for record in self.get_pending():
+                    if record['id'] in _transfers_in_process: continue
+                    if self.owner_is_alive(record):
+                        logger.debug(
+                            'Stageout of {0} is owned by running process {1}; not resuming'
+                            .format(record['src'], record['owner'])
+                            )
+                        continue
+                    if not osp.isfile(record['src']):
+                        logger.error(
+                            'Cannot resume stageout of {0}: the file is gone'.format(record['src'])
+                            )
+                        self._append(dict(record, status='failed', error='source file gone'))
+                        continue
+                    record = dict(record, owner=self.owner)
+                    self._append(record)
+                    claimed.append(record)
+        for record in claimed:
+            logger.info('Resuming stageout {0} ==> {1}'.format(record['src'], record['dst']))
+            self._enqueue(record)
+
+    def _enqueue(self, record):
+        self._transfers[record['id']] = [ threading.Event(), 'queued' ]
+        _transfers_in_process.add(record['id'])
+        self.queue.put(record)
+
+    def put(self, src, dst):
+        """
+        Queues the transfer of src to dst and returns immediately
+        """
+        record = {
+            'id' : uuid.uuid4().hex, 'src' : osp.abspath(src), 'dst' : dst,
+            'status' : 'queued', 'owner' : self.owner,
+            }
+        self._journal(record)
+        logger.info('Queued stageout {0} ==> {1}'.format(src, dst))
+        self._enqueue(record)
+        return record['id']
+
+    def _work(self):
+        while True:
+            record = self.queue.get()
+            transfer = self._transfers[record['id']]
+            try:
+                self.semanager.copy_many_to_se([ (record['src'], record['dst']) ], n_workers=1)
+                transfer[1] = 'done'
+                self._journal(dict(record, status='done'))
+            except Exception as e:
+                logger.error('Stageout {0} ==> {1} failed: {2}'.format(record['src'], record['dst'], e))
+                transfer[1] = 'failed'
+                self.failed.append(record)
+                self._journal(dict(record, status='failed', error=str(e)))
+            finally:
+                transfer[0].set()
+                self.queue.task_done()
+
+    def get_status(self, transfer_id):
+        """
+        Returns 'queued', 'done' or 'failed' for a transfer queued by this queue
+        """
+        return self._transfers[transfer_id][1]
+
+    def wait(self, transfer_id):
+        """
+        Blocks until one transfer is finished, and returns its status
+        """
+        self._transfers[transfer_id][0].wait()
+        return self.get_status(transfer_id)
+
+    def n_pending(self):
+        return len([ t for t in self._transfers.values() if not t[0].is_set() ])
+
+    def _warn_pending(self):
+        n_pending = self.n_pending()
+        if n_pending:
+            logger.warning(
+                'Exiting with {0} stageouts still pending; call wait_all() before the job ends. '
+                'They are kept in {1} and will be resumed by the next StageoutQueue on it.'
+                .format(n_pending, self.journal_file)
+                )
+
+    def wait_all(self):
+        """
+        Blocks until all queued transfers are done; raises a RuntimeError if any failed
+        """
+        logger.info('Waiting for {0} queued stageouts'.format(self.queue.qsize()))
+        self.queue.join()
+        if self.failed:
+            failed = self.failed
+            self.failed = []
+            raise RuntimeError(
+                'Failed to stage out {0} files:\n'.format(len(failed))
+                + '\n'.join('{0} ==> {1}'.format(record['src'], record['dst']) for record in failed)
+                )
+
+
+_stageout_queue = None
+
+def get_stageout_queue():
+    """
+    Returns the stageout queue of this process, created on first use
+    """
+    global _stageout_queue
+    if _stageout_queue is None:
+        _stageout_queue = StageoutQueue()
+    return _stageout_queue
+
+def wait_all():
+    """
+    Waits for the stageout queue of this process, if there is one
+    """
+    if not(_stageout_queue is None):
+        _stageout_queue.wait_all()
@@ -3,7 +3,13 @@
 from __future__ import print_function
 
 import os.path as osp
-import logging, subprocess, os, shutil, re, pprint, csv
+import logging, subprocess, os, shutil, re, pprint, csv, fcntl, multiprocessing, glob, json, hashlib
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
 import svj.core
 import svj.genprod
 logger = logging.getLogger('root')
@@ -41,19 +47,27 @@ def get_model_name_from_tarball(tarball):
     return model_name
 
 
-def get_mg_crosssection_from_logfile(log_file):
+# Matches e.g. 'Cross-section :   0.1234 +- 0.0056 pb'; the error is optional
+mg_crosssection_pattern = re.compile(
+    r'Cross-section :\s+(\d*\.?\d+(?:[eE][-+]?\d+)?)(?:\s*\+-\s*(\d*\.?\d+(?:[eE][-+]?\d+)?))?'
+    )
+
+def get_mg_crosssection_from_logfile(log_file, with_error=False):
     """
-    Gets the madgraph cross section from the log file that was created when creating a gridpack
+    Gets the madgraph cross section from the log file that was created when creating a gridpack.
+    If with_error is True, returns a tuple (xs, error), where error is None if it is not in the log.
     """
     with open(log_file) as f:
-        match = re.search(r'(?<=Cross-section :   )(\d*.\d+)', f.read())
+        match = mg_crosssection_pattern.search(f.read())
         if not match:
             raise ValueError(
                 'Could not determine cross section from log_file {0}'.format(log_file)
                 )
-    xs = match.group(1)
-    logger.info('Found cross section %s from log_file %s', xs, log_file)
-    return float(xs)
+    xs = float(match.group(1))
+    error = None if match.group(2) is None else float(match.group(2))
+    logger.info('Found cross section %s +- %s from log_file %s', xs, error, log_file)
+    if with_error: return xs, error
+    return xs
 
 
 def copy_to_output(file, change_name=None, dry=False):
@@ -68,3 +82,243 @@ def copy_to_output(file, change_name=None, dry=False):
     if not dry:
         shutil.copyfile(file, dst)
 
+
+
+@contextmanager
+def file_lock(lock_file):
+    """
+    Context manager that holds an exclusive lock on `lock_file` (created if needed).
+    Blocks until the lock is acquired; works across processes on the same node.
+    """
+    svj.core.utils.create_directory(osp.dirname(osp.abspath(lock_file)))
+    with open(lock_file, 'a') as f:
+        logger.debug('Acquiring lock on {0}'.format(lock_file))
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            logger.debug('Released lock on {0}'.format(lock_file))
+
+
+def get_xz_decompress_cmd():
+    """
+    Returns a shell command that decompresses xz from stdin to stdout using multiple
+    threads, or None if no multi-threaded xz decompressor is available
+    """
+    if find_executable('xz'):
+        try:
+            xz_help = subprocess.check_output([ 'xz', '--help' ])
+        except (OSError, subprocess.CalledProcessError):
+            xz_help = b''
+        if b'--threads' in xz_help:
+            return 'xz -dc -T0'
+    if find_executable('pixz'):
+        return 'pixz -d'
+    return None
+
+
+def extract_tarball(src, dst):
+    """
+    Extracts the tarball src into the directory dst, streaming it directly from its
+    original location: src may be a local path or an SE url (root://...), which is
+    then read with `xrdcp ... -`. No intermediate copy of the tarball is made, and
+    .xz tarballs are decompressed with multiple threads if possible.
+    """
+    if src.startswith('root://'):
+        reader = ' '.join(svj.genprod.SEManager().get_stream_cmd(src))
+    else:
+        if not osp.isfile(src):
+            raise OSError('Tarball {0} does not exist'.format(src))
+        reader = None
+    xz = get_xz_decompress_cmd() if src.endswith('.xz') else None
+    if xz:
+        # Always decompress from stdin; pixz given a file argument writes to disk
+        decompress = xz if reader else '{0} < {1}'.format(xz, quote(src))
+        pipeline = [ reader, decompress, 'tar -x -C {0}'.format(quote(dst)) ]
+    elif reader:
+        # tar cannot detect the compression of a stream, so pass it explicitly
+        compression_flag = ''
+        for extension, flag in [ ('.xz', 'J'), ('.gz', 'z'), ('.tgz', 'z'), ('.bz2', 'j') ]:
+            if src.endswith(extension): compression_flag = flag
+        pipeline = [ reader, 'tar -x{0} -f - -C {1}'.format(compression_flag, quote(dst)) ]
+    else:
+        pipeline = [ 'tar -x -f {0} -C {1}'.format(quote(src), quote(dst)) ]
+    cmd = 'set -o pipefail; ' + ' | '.join([ c for c in pipeline if c ])
+    logger.info('Extracting {0} ==> {1}'.format(src, dst))
+    svj.core.utils.run_command([ 'bash', '-c', cmd ])
+    return dst
+
+
+# Chunk/shard i of a job with base seed s uses seed s*CHUNK_SEED_STRIDE + i
+CHUNK_SEED_STRIDE = 1000
+# MadGraph's random number generator (ranmar) only takes seeds below this
+MG_MAX_SEED = 900000000
+
+def derive_chunk_seeds(seed, n_chunks, max_seed=None):
+    """
+    Returns n_chunks seeds derived from seed. Seeds of different base seeds do not
+    overlap as long as n_chunks <= CHUNK_SEED_STRIDE. Raises a ValueError if a derived
+    seed would not be below max_seed (e.g. MG_MAX_SEED for MadGraph).
+    """
+    if n_chunks > CHUNK_SEED_STRIDE:
+        raise ValueError(
+            'Cannot derive more than {0} non-overlapping seeds'
+            .format(CHUNK_SEED_STRIDE)
+            )
+    seeds = [ int(seed) * CHUNK_SEED_STRIDE + i for i in range(n_chunks) ]
+    if not(max_seed is None) and seeds and seeds[-1] >= max_seed:
+        raise ValueError(
+            'Base seed {0} is too large: the chunk seeds must be below {1}, so the base '
+            'seed must be below {2}'.format(seed, max_seed, max_seed // CHUNK_SEED_STRIDE)
+            )
+    return seeds
+
+
+def _get_cgroup_cpu_limit():
+    """
+    Returns the cpu limit of the cgroup of this process (ceiled), or None if unlimited
+    """
+    quota_files = [
+        # cgroup v2: '<quota> <period>' or 'max <period>'
+        ('/sys/fs/cgroup/cpu.max', None),
+        # cgroup v1
+        ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us'),
+        ('/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us'),
+        ]
+    for quota_file, period_file in quota_files:
+        try:
+            with open(quota_file) as f:
+                values = f.read().split()
+            if not(period_file is None):
+                with open(period_file) as f:
+                    values.append(f.read().strip())
+        except (IOError, OSError):
+            continue
+        if len(values) < 2 or values[0] in [ 'max', '-1' ]: return None
+        quota, period = int(values[0]), int(values[1])
+        if quota <= 0 or period <= 0: return None
+        return max(1, -(-quota // period))
+    return None
+
+
+def _get_condor_request_cpus():
+    """
+    Returns RequestCpus from the condor job ad, or None if not running in condor
+    """
+    job_ad = os.environ.get('_CONDOR_JOB_AD', None)
+    if job_ad is None or not osp.isfile(job_ad): return None
+    with open(job_ad) as f:
+        for line in f:
+            match = re.match(r'\s*RequestCpus\s*=\s*(\d+)\s*$', line)
+            if match: return int(match.group(1))
+    return None
+
+
+# Default number of cores used outside of batch mode, when nothing says how many
+# cores the job may use; set $SVJ_NTHREADS to use more
+LOCAL_MAX_CORES = 4
+
+def detect_available_cores():
+    """
+    Returns a tuple (n_cores, source) with the number of cores this job may use.
+    In order of precedence: the $SVJ_NTHREADS environment variable, RequestCpus in
+    the condor job ad, $OMP_NUM_THREADS (set by condor as well), and otherwise the
+    cores this process may run on, capped by the cgroup cpu limit. Outside of batch
+    mode, that last fallback is also capped by LOCAL_MAX_CORES, so a local test run
+    does not take all cores of a shared interactive node.
+    """
+    if os.environ.get('SVJ_NTHREADS', None):
+        return int(os.environ['SVJ_NTHREADS']), 'SVJ_NTHREADS'
+    n_cores = _get_condor_request_cpus()
+    if n_cores:
+        return n_cores, 'condor RequestCpus'
+    if os.environ.get('OMP_NUM_THREADS', None):
+        return int(os.environ['OMP_NUM_THREADS']), 'OMP_NUM_THREADS'
+    if hasattr(os, 'sched_getaffinity'):
+        n_cores, source = len(os.sched_getaffinity(0)), 'cpu affinity'
+    else:
+        n_cores, source = multiprocessing.cpu_count(), 'cpu count'
+    cgroup_limit = _get_cgroup_cpu_limit()
+    if not(cgroup_limit is None) and cgroup_limit < n_cores:
+        n_cores, source = cgroup_limit, 'cgroup cpu limit'
+    if not svj.genprod.BATCH_MODE and n_cores > LOCAL_MAX_CORES:
+        n_cores, source = LOCAL_MAX_CORES, 'local default; set $SVJ_NTHREADS to use more'
+    return n_cores, source
+
+
+CMSSW_BUILD_STATE_BASENAME = '.svj_build_state.json'
+
+def get_cmssw_src_state(cmssw_src):
+    """
+    Returns a dict with a hash of the python files and a hash of everything else
+    (including the list of packages) in the packages of cmssw_src, and the hash that
+    everything else would have if the packages held only python files.
+    Files directly in cmssw_src (cfgs, outputs) are not part of any package and ignored.
+    """
+    python_hashes = {}
+    other_hashes = {}
+    package_hashes = {}
+    for package in sorted(glob.glob(osp.join(cmssw_src, '*', '*'))):
+        if not osp.isdir(package): continue
+        other_hashes[osp.relpath(package, cmssw_src)] = 'package'
+        package_hashes[osp.relpath(package, cmssw_src)] = 'package'
+        for relpath, sha in svj.genprod.gridpackcache.hash_directory(package, ignore_extensions=('.pyc',)).items():
+            relpath = osp.join(osp.relpath(package, cmssw_src), relpath)
+            if relpath.endswith('.py'):
+                python_hashes[relpath] = sha
+            else:
+                other_hashes[relpath] = sha
+    def digest(hashes):
+        return hashlib.sha1(json.dumps(hashes, sort_keys=True).encode('utf-8')).hexdigest()
+    return {
+        'python' : digest(python_hashes),
+        'other' : digest(other_hashes),
+        'python_only' : digest(package_hashes),
+        }
+
+
+def compile_cmssw_src_if_needed(cmssw_src, arch):
+    """
+    Compares the state of cmssw_src (see `get_cmssw_src_state`) with the state of the
+    last build, recorded in the release directory, and runs:
+    - nothing if nothing changed,
+    - only `scram b python` if only python files changed (e.g. a new fragment),
+    - a full `scram b` otherwise.
+    A fresh release area, without a recorded build, only gets `scram b python` if
+    its packages hold nothing but python files.
+    Returns 'none', 'python' or 'full'.
+    """
+    state_file = osp.join(osp.dirname(osp.abspath(cmssw_src)), CMSSW_BUILD_STATE_BASENAME)
+    state = get_cmssw_src_state(cmssw_src)
+    previous_state = None
+    if osp.isfile(state_file):
+        with open(state_file, 'r') as f:
+            previous_state = json.load(f)
+    if previous_state == state:
+        logger.info('Nothing changed in {0} since the last build; not compiling'.format(cmssw_src))
+        return 'none'
+    if previous_state is None:
+        python_only = state['other'] == state['python_only']
+    else:
+        python_only = previous_state.get('other') == state['other']
+    if python_only:
+        logger.info('Only python files changed in {0}; running scram b python'.format(cmssw_src))
+        svj.core.utils.run_multiple_commands(
+            [
+                'export SCRAM_ARCH={0}'.format(arch),
+                'shopt -s expand_aliases',
+                'source /cvmfs/cms.cern.ch/cmsset_default.sh',
+                'cd {0}'.format(cmssw_src),
+                'eval `scramv1 runtime -sh`',
+                'scram b python',
+                ],
+            env = svj.core.utils.get_clean_env()
+            )
+        build = 'python'
+    else:
+        svj.core.utils.compile_cmssw_src(cmssw_src, arch)
+        build = 'full'
+    with open(state_file, 'w') as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+    return build
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os.path as osp
+import pytest
+
+
+LHE_HEADER = """<LesHouchesEvents version="3.0">
+<header>
+<MGGenerationInfo>
+#  Number of Events        :       {n_events}
+#  Integrated weight (pb)  :       0.123
+</MGGenerationInfo>
+</header>
+<init>
+2212 2212 6.500000e+03 6.500000e+03 0 0 247000 247000 -4 1
+1.230000e-01 4.000000e-03 1.230000e-01 1
+</init>
+"""
+
+LHE_EVENT = """<event>
+ 5      1 +1.2300000e-01 1.00000000e+03 7.54677100e-03 1.15000000e-01
+       21 -1    0    0  501  502 +0.0000000000e+00 +0.0000000000e+00 +4.5e+02 4.5e+02 0.0e+00 0.0000e+00 -1.0000e+00
+       21 -1    0    0  502  501 -0.0000000000e+00 -0.0000000000e+00 -4.5e+02 4.5e+02 0.0e+00 0.0000e+00 1.0000e+00
+  5000001  2    1    2    0    0 +0.0e+00 +0.0e+00 +0.0e+00 9.26873e+02 1.01952e+03 0.0000e+00 0.0000e+00
+  {pid1}  1    3    3  501    0 +{px:.4e} +1.0e+02 +0.0e+00 4.5e+02 2.0e+01 0.0000e+00 1.0000e+00
+ {pid2}  1    3    3    0  501 -{px:.4e} -1.0e+02 +0.0e+00 4.5e+02 2.0e+01 0.0000e+00 -1.0000e+00
+<mgrwt>
+<rscale>  0 0.1E+04</rscale>
+</mgrwt>
+</event>
+"""
+
+
+def make_lhe_contents(n_events, pid1='5000521', pid2='-5000521'):
+    """
+    Returns the contents of a small MadGraph-like .lhe file with n_events events
+    """
+    contents = LHE_HEADER.format(n_events=n_events)
+    for i in range(n_events):
+        contents += LHE_EVENT.format(pid1=pid1, pid2=pid2, px=float(i+1))
+    return contents + '</LesHouchesEvents>\n'
+
+
+@pytest.fixture
+def make_lhe(tmpdir):
+    """
+    Returns a function that writes a small .lhe file and returns its path
+    """
+    def make(n_events=10, basename='test.lhe', **kwargs):
+        path = osp.join(str(tmpdir), basename)
+        with open(path, 'w') as f:
+            f.write(make_lhe_contents(n_events, **kwargs))
+        return path
+    return make
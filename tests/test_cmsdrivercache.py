@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from svj.genprod.cmsdrivercache import CMSDriverCache, get_pileup_filelists
+
+
+class FakeRunner(object):
+    cmssw_version = 'CMSSW_9_4_7'
+    arch = 'slc6_amd64_gcc630'
+    stage = 'aod'
+    substage = 'AOD'
+    year = 2017
+    gensimfragment_file = None
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+
+
+def get_key(tmpdir, workdir_name, filelist_contents):
+    runner = FakeRunner(str(tmpdir.join(workdir_name)))
+    tmpdir.join(workdir_name, 'pileup_filelist_2017.txt').write(filelist_contents, ensure=True)
+    cmd = [
+        'cmsDriver.py step1',
+        '--pileup_input filelist:"{0}/pileup_filelist_2017.txt"'.format(runner.workdir),
+        ]
+    assert get_pileup_filelists(cmd) == [ runner.workdir + '/pileup_filelist_2017.txt' ]
+    return CMSDriverCache(str(tmpdir.join('cache'))).get_key(runner, cmd)
+
+
+def test_key_depends_on_pileup_filelist(tmpdir):
+    key = get_key(tmpdir, 'a', 'pu1.root\n')
+    assert get_key(tmpdir, 'b', 'pu2.root\n') != key
+    # Same file list in another workdir
+    assert get_key(tmpdir, 'c', 'pu1.root\n') == key
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import os.path as osp
+
+from svj.genprod.gridpackscan import create_genprod_working_copy
+
+
+def test_working_copy_skips_outputs_of_models(tmpdir):
+    genprod_dir = tmpdir.join('genprod')
+    for name in [ 'gridpack_generation.sh', 'cards', 'SVJ_patches', 'SVJ_s_mZ250', 'SVJ_s_mZ250.log', 'old_tarball.tar.xz' ]:
+        genprod_dir.join(name).write('', ensure=True)
+    dst = create_genprod_working_copy(str(genprod_dir), str(tmpdir.join('copy')), model_names=[ 'SVJ_s_mZ250' ])
+    assert sorted(os.listdir(dst)) == [ 'SVJ_patches', 'cards', 'gridpack_generation.sh' ]
+    assert osp.islink(osp.join(dst, 'cards'))
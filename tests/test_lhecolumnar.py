@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os.path as osp
+import pytest
+np = pytest.importorskip('numpy')
+
+import svj.genprod
+from svj.genprod.lhecolumnar import LHEColumns, convert_lhe
+
+
+@pytest.fixture
+def columns(make_lhe):
+    return LHEColumns.from_lhe(make_lhe(6, pid1='4900101', pid2='-4900101'), chunk_size=2000)
+
+
+def test_from_lhe(columns):
+    assert len(columns) == 6
+    assert list(columns.offsets) == list(range(0, 31, 5))
+    assert list(columns.events['n_particles']) == [ 5 ] * 6
+    assert list(columns.get_event(2)['pid']) == [ 21, 21, 5000001, 4900101, -4900101 ]
+    assert list(columns.event_index()[:6]) == [ 0, 0, 0, 0, 0, 1 ]
+
+
+def test_parallel_parsing(make_lhe):
+    lhe_file = make_lhe(6)
+    serial = LHEColumns.from_lhe(lhe_file, chunk_size=2000)
+    parallel = LHEColumns.from_lhe(lhe_file, chunk_size=2000, n_workers=2)
+    assert np.array_equal(serial.particles, parallel.particles)
+    assert np.array_equal(serial.events, parallel.events)
+
+
+def test_multiplicity_and_leading_pt(columns):
+    assert list(columns.dark_quark_multiplicity()) == [ 2 ] * 6
+    # Only the outgoing gluons and dark quarks have status 1
+    assert list(columns.multiplicity([ 21 ])) == [ 0 ] * 6
+    assert np.allclose(columns.leading_pt(), np.hypot(np.arange(1., 7.), 100.))
+    assert np.allclose(columns.mediator_mass(), 1019.52)
+
+
+def test_summary(columns):
+    summary = columns.summary()
+    assert summary['n_events'] == 6
+    assert summary['n_particles'] == 30
+    assert abs(summary['sum_of_weights'] - 6*0.123) < 1e-9
+    assert summary['dark_quark_multiplicity']['mean'] == 2.
+    assert abs(summary['mediator_mass']['median'] - 1019.52) < 1e-6
+
+
+@pytest.mark.parametrize('basename', [ 'columns.npz', 'columns' ])
+def test_save_and_load(columns, tmpdir, basename):
+    dst = str(tmpdir.join(basename))
+    columns.save(dst)
+    loaded = LHEColumns.load(dst)
+    assert len(loaded) == len(columns)
+    for name in [ 'pid', 'status', 'px', 'm' ]:
+        assert np.array_equal(loaded.particles[name], columns.particles[name])
+    assert np.array_equal(loaded.events['weight'], columns.events['weight'])
+    assert loaded.summary() == columns.summary()
+
+
+def test_convert_gzipped(make_lhe, tmpdir):
+    lhe_file = make_lhe(3)
+    gz = str(tmpdir.join('lhe.files', 'test.lhe.gz'))
+    tmpdir.mkdir('lhe.files')
+    svj.genprod.lhetools.replace_pids_streaming(lhe_file, [ ('5000521', '4900101') ], dst=gz)
+    columns = convert_lhe(gz)
+    assert osp.isdir(str(tmpdir.join('lhe.files', 'test_columns')))
+    assert list(columns.dark_quark_multiplicity()) == [ 2 ] * 3
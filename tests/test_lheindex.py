@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+import svj.genprod
+from svj.genprod import lhetools
+from svj.genprod.lheindex import LHEIndex
+
+
+def get_events(path):
+    with lhetools.open_lhe(path, 'rb') as f:
+        lhetools.read_header_and_init(f)
+        return list(lhetools.iter_events(f))
+
+
+def test_offsets_match_events(make_lhe):
+    lhe_file = make_lhe(6)
+    index = LHEIndex.build(lhe_file)
+    events = get_events(lhe_file)
+    assert len(index) == 6
+    assert [ index[i] for i in range(6) ] == events
+    assert index[-1] == events[-1]
+    assert index[2:5] == b''.join(events[2:5])
+    assert index.get_init().startswith(b'<init>')
+
+
+def test_write_subset_sets_event_count(make_lhe, tmpdir):
+    lhe_file = make_lhe(6)
+    index = LHEIndex.build(lhe_file)
+    dst = str(tmpdir.join('subset.lhe'))
+    assert index.write_subset(dst, 1, 4) == 3
+    assert get_events(dst) == get_events(lhe_file)[1:4]
+    assert lhetools.read_lhe_metadata(dst, use_index=False)['n_events'] == 3
+    shards = index.shard(4, str(tmpdir.join('shards')))
+    for path, start, n in shards:
+        assert lhetools.read_lhe_metadata(path, use_index=False)['n_events'] == n
+
+
+def test_sidecar_invalidation(make_lhe):
+    lhe_file = make_lhe(3)
+    LHEIndex.build(lhe_file)
+    assert LHEIndex.read_metadata(lhe_file)['n_events'] == 3
+    assert len(LHEIndex.load(lhe_file)) == 3
+    # Changing the file makes the sidecar stale
+    with open(lhe_file, 'w') as f:
+        f.write(open(make_lhe(5, basename='other.lhe')).read())
+    assert LHEIndex.read_metadata(lhe_file) is None
+    with pytest.raises(ValueError):
+        LHEIndex.load(lhe_file)
+    assert len(LHEIndex.for_file(lhe_file)) == 5
+
+
+def test_offsets_are_64_bit():
+    from svj.genprod.lheindex import OFFSET_TYPECODE
+    from array import array
+    assert array(OFFSET_TYPECODE).itemsize == 8
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+import svj.genprod
+from svj.genprod import lhetools
+
+
+T_CHANNEL_REPLACEMENTS = lhetools.get_pid_replacements('t-channel')
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_pid_pattern_matches_whole_tokens():
+    pattern = lhetools.compile_pid_pattern(T_CHANNEL_REPLACEMENTS)
+    line = b' 49001010 -49001011 149001010 49001010.5 1.49001010e+03 x49001012\n'
+    assert pattern.findall(line) == [ b'49001010', b'49001011' ]
+
+
+def test_streaming_replacement(make_lhe, tmpdir):
+    lhe_file = make_lhe(10)
+    replacements = lhetools.get_pid_replacements('s-channel')
+    dst = str(tmpdir.join('replaced.lhe'))
+    assert lhetools.replace_pids_streaming(lhe_file, replacements, dst=dst) == 20
+    # Tiny chunks give the same result, in place
+    assert lhetools.replace_pids_streaming(lhe_file, replacements, chunk_size=100) == 20
+    assert read(lhe_file) == read(dst)
+    assert b'5000521' not in read(dst)
+    assert read(dst).count(b' 4900101 ') == 10
+    assert read(dst).count(b' -4900101 ') == 10
+
+
+def test_inplace_matches_streaming_for_signed_pids(make_lhe, tmpdir):
+    lhe_file = make_lhe(5, pid1='49001010', pid2='-49001011')
+    streamed = str(tmpdir.join('streamed.lhe'))
+    n_streamed = lhetools.replace_pids_streaming(lhe_file, T_CHANNEL_REPLACEMENTS, dst=streamed)
+    n_inplace = lhetools.replace_pids_inplace(lhe_file, T_CHANNEL_REPLACEMENTS)
+    assert n_streamed == n_inplace == 10
+    assert b'- 4900101' not in read(lhe_file)
+    # Identical up to the padding of the shortened pids
+    assert read(lhe_file).split() == read(streamed).split()
+
+
+def get_events(path):
+    with lhetools.open_lhe(path, 'rb') as f:
+        lhetools.read_header_and_init(f)
+        return list(lhetools.iter_events(f))
+
+
+def get_header_n_events(path):
+    with lhetools.open_lhe(path, 'rb') as f:
+        header_lines, init_lines = lhetools.read_header_and_init(f)
+    return lhetools.get_n_events_from_header(header_lines)
+
+
+def test_split_sets_shard_event_counts(make_lhe, tmpdir):
+    lhe_file = make_lhe(10)
+    shards = lhetools.split_lhe(lhe_file, str(tmpdir.join('shards')), n_shards=3)
+    assert [ n for _, _, n in shards ] == [ 4, 4, 2 ]
+    for path, first_event, n in shards:
+        assert get_header_n_events(path) == n
+        assert lhetools.count_events(path) == n
+        assert lhetools.read_lhe_metadata(path, use_index=False)['n_events'] == n
+
+
+def test_split_merge_roundtrip(make_lhe, tmpdir):
+    lhe_file = make_lhe(7)
+    shards = lhetools.split_lhe(lhe_file, str(tmpdir.join('shards')), events_per_shard=3)
+    merged = str(tmpdir.join('merged.lhe'))
+    n = lhetools.merge_lhe_files([ path for path, _, _ in shards ], merged)
+    assert n == 7
+    assert get_events(merged) == get_events(lhe_file)
+    assert get_header_n_events(merged) == 7
+    metadata = lhetools.read_lhe_metadata(merged, use_index=False)
+    assert abs(metadata['cross_section'] - 0.123) < 1e-9
+
+
+def test_merge_sum_normalization(make_lhe, tmpdir):
+    srcs = [ make_lhe(n, basename='in{0}.lhe'.format(n)) for n in [ 1, 3 ] ]
+    merged = str(tmpdir.join('merged.lhe.gz'))
+    assert lhetools.merge_lhe_files(srcs, merged, weight_norm='sum', chunk_size=500) == 4
+    weights = [ float(event.split(b'\n')[1].split()[2]) for event in get_events(merged) ]
+    # Every input is scaled by its share of the events
+    expected = [ 0.123 * 1/4. ] + [ 0.123 * 3/4. ] * 3
+    assert len(weights) == len(expected)
+    assert all(abs(w - e) < 1e-12 for w, e in zip(weights, expected))
+    # Only the inputs and the output are left
+    assert sorted(p.basename for p in tmpdir.listdir()) == [ 'in1.lhe', 'in3.lhe', 'merged.lhe.gz' ]
+
+
+def test_compressed_roundtrip(make_lhe, tmpdir):
+    lhe_file = make_lhe(4)
+    gz = str(tmpdir.join('test.lhe.gz'))
+    lhetools.replace_pids_streaming(lhe_file, [ ('5000521', '4900101') ], dst=gz)
+    assert lhetools.get_compression(gz) == 'gz'
+    events = get_events(gz)
+    assert len(events) == 4
+    assert all(b'5000521' not in event for event in events)
+    decompressed = lhetools.decompress_lhe(gz, str(tmpdir.join('decompressed.lhe')))
+    assert get_events(decompressed) == events
+    with pytest.raises(ValueError):
+        lhetools.check_uncompressed(gz)
+
+
+def test_zstd_roundtrip(make_lhe, tmpdir):
+    pytest.importorskip('zstandard')
+    lhe_file = make_lhe(4)
+    zst = str(tmpdir.join('test.lhe.zst'))
+    replaced = str(tmpdir.join('replaced.lhe'))
+    lhetools.replace_pids_streaming(lhe_file, [ ('5000521', '4900101') ], dst=zst)
+    lhetools.replace_pids_streaming(lhe_file, [ ('5000521', '4900101') ], dst=replaced)
+    assert lhetools.get_compression(zst) == 'zst'
+    assert get_events(zst) == get_events(replaced)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time, zlib
+import os.path as osp
+import pytest
+
+import svj.genprod
+from svj.genprod import sebackends
+from svj.genprod.semanager import parse_ls_line, split_mgm, adler32_of_file
+
+
+def test_parse_ls_line_old_format():
+    path, is_dir, size, mtime = parse_ls_line(
+        '-rw- 2020-01-02 03:04:05      1234 /store/user/x/N10_seed1.root'
+        )
+    assert (path, is_dir, size) == ('/store/user/x/N10_seed1.root', False, 1234)
+    assert mtime == time.mktime((2020, 1, 2, 3, 4, 5, 0, 0, -1))
+
+
+def test_parse_ls_line_new_format():
+    path, is_dir, size, mtime = parse_ls_line(
+        'drwxrwxr-x user group 4096 2020-01-02 03:04:05 /store/user/x/subdir'
+        )
+    assert (path, is_dir, size) == ('/store/user/x/subdir', True, 4096)
+    assert mtime == time.mktime((2020, 1, 2, 3, 4, 5, 0, 0, -1))
+
+
+def test_parse_ls_line_ignores_other_lines():
+    assert parse_ls_line('') is None
+    assert parse_ls_line('[ERROR] Server responded with an error') is None
+
+
+def test_split_file_mgm():
+    assert split_mgm('file:///some/dir/store/x/y.root') == ('file:///some/dir', '/store/x/y.root')
+
+
+def test_get_backend():
+    assert isinstance(sebackends.get_backend('local'), sebackends.LocalBackend)
+    with pytest.raises(ValueError):
+        sebackends.get_backend('ftp')
+
+
+def test_cli_copy_cmd():
+    cmd = sebackends.CLIBackend().get_copy_cmd('a.root', 'root://eos//store/a.root', 4, '0a1b2c3d', True)
+    assert cmd == [
+        'xrdcp', '-s', '--streams', '4', '--cksum', 'adler32:0a1b2c3d', '--force',
+        'a.root', 'root://eos//store/a.root'
+        ]
+
+
+def test_adler32_of_file(tmpdir):
+    path = str(tmpdir.join('f'))
+    with open(path, 'wb') as f:
+        f.write(b'x' * 1000)
+    assert adler32_of_file(path, chunk_size=7) == '{0:08x}'.format(zlib.adler32(b'x' * 1000) & 0xffffffff)
+
+
+@pytest.fixture
+def local_se(tmpdir):
+    mgm = 'file://' + str(tmpdir.join('se'))
+    src = str(tmpdir.join('src.txt'))
+    with open(src, 'w') as f:
+        f.write('contents')
+    return sebackends.LocalBackend(), mgm, src
+
+
+def test_local_mkdir_and_list(local_se):
+    backend, mgm, src = local_se
+    assert backend.list_directory(mgm, '/store/x') is None
+    backend.mkdir(mgm, '/store/x/y')
+    backend.mkdir(mgm, '/store/x/y')
+    assert backend.is_directory(mgm, '/store/x/y')
+    backend.copy(src, mgm, '/store/x/a.txt')
+    entries = backend.list_directory(mgm, '/store/x')
+    assert sorted(entries) == [ '/store/x/a.txt', '/store/x/y' ]
+    assert entries['/store/x/a.txt'][:2] == (False, 8)
+    assert entries['/store/x/y'][0]
+
+
+def test_local_copy(local_se):
+    backend, mgm, src = local_se
+    with pytest.raises(OSError):
+        # No parent directory
+        backend.copy(src, mgm, '/store/x/a.txt')
+    backend.mkdir(mgm, '/store/x')
+    backend.copy(src, mgm, '/store/x/a.txt', checksum=adler32_of_file(src))
+    assert backend.checksum(mgm, '/store/x/a.txt') == adler32_of_file(src)
+    with pytest.raises(OSError):
+        backend.copy(src, mgm, '/store/x/a.txt')
+    with pytest.raises(OSError):
+        backend.copy(src, mgm, '/store/x/a.txt', checksum='00000000', force=True)
+    # A failed verification leaves the existing file alone
+    assert backend.checksum(mgm, '/store/x/a.txt') == adler32_of_file(src)
+    backend.copy(src, mgm, '/store/x/a.txt', force=True)
+
+
+def test_semanager_on_local_se(local_se):
+    backend, mgm, src = local_se
+    semanager = svj.genprod.SEManager(mgm, directory_cache=svj.genprod.semanager.SEDirectoryCache())
+    semanager.copy_many_to_se([ (src, '/store/x/a.txt'), (src, '/store/y/b.txt') ], n_workers=2)
+    stats = semanager.stat_many([ '/store/x/a.txt', '/store/y/b.txt', '/store/y/c.txt' ])
+    assert stats['/store/x/a.txt']['size'] == 8
+    assert stats['/store/y/c.txt'] is None
+    assert semanager.get_checksum('/store/y/b.txt') == adler32_of_file(src)
+    assert osp.isfile(backend.get_path(mgm, '/store/y/b.txt'))
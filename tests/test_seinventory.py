@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, time
+import os.path as osp
+
+import svj.genprod
+from svj.genprod.seinventory import SEInventory, parse_stageout_path
+
+
+LFN_DIRECTORY = '/store/user/test/semivis/1_20-01-01_GEN_SVJ_mz250'
+LFN = LFN_DIRECTORY + '/N10_seed1.root'
+
+
+def make_inventory(tmpdir):
+    semanager = svj.genprod.SEManager(
+        'file://' + str(tmpdir.join('se')),
+        directory_cache=svj.genprod.semanager.SEDirectoryCache()
+        )
+    return SEInventory(str(tmpdir.join('inventory.sqlite')), semanager=semanager)
+
+
+def get_top_directory(tmpdir):
+    return 'file://' + str(tmpdir.join('se')) + '/store/user/test'
+
+
+def write(tmpdir, contents, mode='w'):
+    path = str(tmpdir.join('se')) + LFN
+    if not osp.isdir(osp.dirname(path)): os.makedirs(osp.dirname(path))
+    with open(path, mode) as f:
+        f.write(contents)
+    return path
+
+
+def test_parse_stageout_path():
+    fields = parse_stageout_path(LFN)
+    assert fields['cluster'] == '1'
+    assert fields['substage'] == 'GEN'
+    assert fields['model_name'] == 'SVJ_mz250'
+    assert (fields['n_events'], fields['seed'], fields['procid']) == (10, 1, None)
+
+
+def test_finished_output_is_complete_in_one_update(tmpdir):
+    inventory = make_inventory(tmpdir)
+    path = write(tmpdir, 'abcdefg')
+    an_hour_ago = time.time() - 3600.
+    os.utime(path, (an_hour_ago, an_hour_ago))
+    inventory.update([ get_top_directory(tmpdir) ])
+    assert [ row['size'] for row in inventory.query() ] == [ 7 ]
+    assert inventory.has_output('SVJ_mz250', 'GEN', 1)
+    work_items = [ { 'model_name' : 'SVJ_mz250', 'substage' : 'GEN', 'seed' : seed } for seed in [1, 2] ]
+    assert [ item['seed'] for item in inventory.drop_completed(work_items) ] == [ 2 ]
+    # Nothing changed and everything is complete, so only the top directory is listed
+    assert inventory.update([ get_top_directory(tmpdir) ]) == 1
+    inventory.close()
+
+
+def test_growing_file_is_refreshed_and_not_complete(tmpdir):
+    inventory = make_inventory(tmpdir)
+    write(tmpdir, 'abc')
+    inventory.update([ get_top_directory(tmpdir) ])
+    assert [ row['size'] for row in inventory.query(complete=False) ] == [ 3 ]
+    assert inventory.query() == []
+    # Appending does not change the mtime of the directory
+    write(tmpdir, 'defg', mode='a')
+    inventory.update([ get_top_directory(tmpdir) ])
+    assert [ row['size'] for row in inventory.query(complete=False) ] == [ 7 ]
+    assert not inventory.has_output('SVJ_mz250', 'GEN', 1)
+    # Unchanged since the previous update, so complete
+    inventory.update([ get_top_directory(tmpdir) ])
+    assert inventory.has_output('SVJ_mz250', 'GEN', 1)
+    inventory.close()
+
+
+def test_complete_with_checksums(tmpdir):
+    inventory = make_inventory(tmpdir)
+    path = write(tmpdir, 'abcdefg')
+    inventory.update([ get_top_directory(tmpdir) ], with_checksums=True)
+    rows = inventory.query()
+    assert len(rows) == 1 and rows[0]['checksum'] == svj.genprod.semanager.adler32_of_file(path)
+    inventory.close()
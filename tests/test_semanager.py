@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import shutil
+import os.path as osp
+import pytest
+
+import svj.genprod
+from svj.genprod.semanager import SEDirectoryCache
+
+
+MGM = 'root://cmseos.fnal.gov'
+
+
+def test_directory_cache_add_and_discard(tmpdir):
+    cache_file = str(tmpdir.join('directories.json'))
+    cache = SEDirectoryCache(cache_file)
+    cache.add(MGM, '/store/user/x/y')
+    assert cache.get_key(MGM, '/store/user') in cache
+    # Shared with other processes through the file
+    assert cache.get_key(MGM, '/store/user/x/y') in SEDirectoryCache(cache_file)
+    cache.discard(MGM, '/store/user/x')
+    for c in [ cache, SEDirectoryCache(cache_file) ]:
+        assert not cache.get_key(MGM, '/store/user/x') in c
+        assert not cache.get_key(MGM, '/store/user/x/y') in c
+        assert cache.get_key(MGM, '/store/user') in c
+
+
+def test_directory_cache_expires():
+    cache = SEDirectoryCache(ttl=-1.)
+    cache.add(MGM, '/store/user/x')
+    assert not cache.get_key(MGM, '/store/user/x') in cache
+
+
+@pytest.fixture
+def local_semanager(tmpdir):
+    src = str(tmpdir.join('src.txt'))
+    with open(src, 'w') as f:
+        f.write('contents')
+    semanager = svj.genprod.SEManager(
+        'file://' + str(tmpdir.join('se')),
+        directory_cache=SEDirectoryCache(str(tmpdir.join('directories.json')))
+        )
+    return semanager, src, str(tmpdir.join('se'))
+
+
+def test_copy_recreates_removed_cached_directory(local_semanager):
+    semanager, src, se_dir = local_semanager
+    semanager.create_directory('/store/x')
+    shutil.rmtree(osp.join(se_dir, 'store', 'x'))
+    # The directory is still in the cache, so it is not created before the copy
+    semanager.copy_to_se(src, '/store/x/a.txt')
+    assert osp.isfile(osp.join(se_dir, 'store', 'x', 'a.txt'))
+
+
+def test_copy_many_recreates_removed_cached_directory(local_semanager):
+    semanager, src, se_dir = local_semanager
+    semanager.create_directory('/store/x')
+    shutil.rmtree(osp.join(se_dir, 'store', 'x'))
+    semanager.copy_many_to_se([ (src, '/store/x/a.txt'), (src, '/store/x/b.txt') ], backoff=0.)
+    assert osp.isfile(osp.join(se_dir, 'store', 'x', 'a.txt'))
+    assert osp.isfile(osp.join(se_dir, 'store', 'x', 'b.txt'))
+
+
+def test_copy_failure_is_raised(local_semanager):
+    semanager, src, se_dir = local_semanager
+    semanager.copy_to_se(src, '/store/x/a.txt')
+    # Existing files are not overwritten, also not on the retry
+    with pytest.raises(OSError):
+        semanager.copy_to_se(src, '/store/x/a.txt')
+
+
+def test_stat_many_top_level(local_semanager):
+    semanager, src, se_dir = local_semanager
+    semanager.copy_to_se(src, '/store/x/a.txt')
+    stats = semanager.stat_many([ '/store', '/store/x', '/store/y', '/store/x/a.txt' ])
+    assert stats['/store']['is_dir'] and stats['/store/x']['is_dir']
+    assert stats['/store/y'] is None
+    assert stats['/store/x/a.txt']['size'] == 8
+    # The listed parent is cached under the mgm of the SEManager
+    cache = semanager.directory_cache
+    assert cache.get_key(semanager.mgm, '/store') in cache
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, json, socket
+import os.path as osp
+
+import svj.genprod
+from svj.genprod.stageoutqueue import StageoutQueue
+
+
+def make_queue(tmpdir, **kwargs):
+    semanager = svj.genprod.SEManager(
+        'file://' + str(tmpdir.join('se')),
+        directory_cache=svj.genprod.semanager.SEDirectoryCache()
+        )
+    return StageoutQueue(str(tmpdir.join('journal.jsonl')), semanager=semanager, **kwargs)
+
+
+def write_record(tmpdir, src, owner_pid):
+    record = {
+        'id' : 'abc{0}'.format(owner_pid), 'src' : src, 'dst' : '/store/x/resumed.lhe',
+        'status' : 'queued', 'owner' : { 'host' : socket.gethostname(), 'pid' : owner_pid },
+        }
+    with open(str(tmpdir.join('journal.jsonl')), 'w') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+
+def get_dead_pid():
+    pid = os.fork()
+    if pid == 0: os._exit(0)
+    os.waitpid(pid, 0)
+    return pid
+
+
+def test_put_and_wait(make_lhe, tmpdir):
+    queue = make_queue(tmpdir)
+    transfer_id = queue.put(make_lhe(3), '/store/x/a.lhe')
+    assert queue.wait(transfer_id) == 'done'
+    queue.wait_all()
+    assert osp.isfile(str(tmpdir.join('se/store/x/a.lhe')))
+    assert queue.n_pending() == 0
+    assert queue.read_journal()[transfer_id]['status'] == 'done'
+
+
+def test_resume_claims_orphaned_transfers(make_lhe, tmpdir):
+    record = write_record(tmpdir, make_lhe(3), get_dead_pid())
+    queue = make_queue(tmpdir)
+    queue.wait_all()
+    assert osp.isfile(str(tmpdir.join('se/store/x/resumed.lhe')))
+    assert queue.read_journal()[record['id']]['status'] == 'done'
+
+
+def test_resume_leaves_transfers_of_running_processes(make_lhe, tmpdir):
+    record = write_record(tmpdir, make_lhe(3), os.getppid())
+    queue = make_queue(tmpdir)
+    queue.wait_all()
+    assert not osp.isfile(str(tmpdir.join('se/store/x/resumed.lhe')))
+    assert queue.read_journal()[record['id']]['status'] == 'queued'
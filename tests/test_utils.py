@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pytest
+
+import svj.genprod
+from svj.genprod import utils
+
+
+@pytest.fixture
+def many_cores(monkeypatch):
+    for var in [ 'SVJ_NTHREADS', '_CONDOR_JOB_AD', 'OMP_NUM_THREADS' ]:
+        monkeypatch.delenv(var, raising=False)
+    if hasattr(os, 'sched_getaffinity'):
+        monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(32)))
+    monkeypatch.setattr(utils.multiprocessing, 'cpu_count', lambda: 32)
+    monkeypatch.setattr(utils, '_get_cgroup_cpu_limit', lambda: None)
+
+
+def test_local_default_is_capped(many_cores, monkeypatch):
+    monkeypatch.setattr(svj.genprod, 'BATCH_MODE', False)
+    assert utils.detect_available_cores()[0] == utils.LOCAL_MAX_CORES
+    monkeypatch.setenv('SVJ_NTHREADS', '12')
+    assert utils.detect_available_cores() == (12, 'SVJ_NTHREADS')
+
+
+def test_batch_mode_uses_all_cores(many_cores, monkeypatch):
+    monkeypatch.setattr(svj.genprod, 'BATCH_MODE', True)
+    assert utils.detect_available_cores()[0] == 32
+    monkeypatch.setenv('OMP_NUM_THREADS', '8')
+    assert utils.detect_available_cores() == (8, 'OMP_NUM_THREADS')
+
+
+def test_derive_chunk_seeds():
+    assert utils.derive_chunk_seeds(3, 2) == [ 3000, 3001 ]
+    with pytest.raises(ValueError):
+        utils.derive_chunk_seeds(3, utils.CHUNK_SEED_STRIDE + 1)
+    assert utils.derive_chunk_seeds(899999, 2, max_seed=utils.MG_MAX_SEED) == [ 899999000, 899999001 ]
+    with pytest.raises(ValueError):
+        utils.derive_chunk_seeds(900000, 2, max_seed=utils.MG_MAX_SEED)
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    """
+    Records the builds instead of running scram
+    """
+    builds = []
+    monkeypatch.setattr(
+        svj.core.utils, 'run_multiple_commands',
+        lambda cmds, env=None: builds.append([ cmd for cmd in cmds if cmd.startswith('scram b') ])
+        )
+    monkeypatch.setattr(
+        svj.core.utils, 'compile_cmssw_src',
+        lambda cmssw_src, arch: builds.append([ 'scram b' ]), raising=False
+        )
+    return builds
+
+
+def make_package_file(cmssw_src, relpath, contents='x = 1\n'):
+    path = cmssw_src.join(relpath)
+    path.write(contents, ensure=True)
+
+
+def test_fresh_python_only_release_skips_full_build(tmpdir, builds):
+    cmssw_src = tmpdir.join('CMSSW_10_6_0', 'src')
+    make_package_file(cmssw_src, 'Configuration/GenProduction/python/fragment_cff.py')
+    assert utils.compile_cmssw_src_if_needed(str(cmssw_src), 'slc7_amd64_gcc700') == 'python'
+    assert builds == [ [ 'scram b python' ] ]
+    assert utils.compile_cmssw_src_if_needed(str(cmssw_src), 'slc7_amd64_gcc700') == 'none'
+    make_package_file(cmssw_src, 'Configuration/GenProduction/python/other_cff.py')
+    assert utils.compile_cmssw_src_if_needed(str(cmssw_src), 'slc7_amd64_gcc700') == 'python'
+    make_package_file(cmssw_src, 'Configuration/GenProduction/plugins/Filter.cc', 'int f();\n')
+    assert utils.compile_cmssw_src_if_needed(str(cmssw_src), 'slc7_amd64_gcc700') == 'full'
+    assert builds[-1] == [ 'scram b' ]
+
+
+def test_fresh_release_with_sources_gets_full_build(tmpdir, builds):
+    cmssw_src = tmpdir.join('CMSSW_10_6_0', 'src')
+    make_package_file(cmssw_src, 'Configuration/GenProduction/python/fragment_cff.py')
+    make_package_file(cmssw_src, 'SVJ/Filter/plugins/Filter.cc', 'int f();\n')
+    assert utils.compile_cmssw_src_if_needed(str(cmssw_src), 'slc7_amd64_gcc700') == 'full'
+    assert builds == [ [ 'scram b' ] ]